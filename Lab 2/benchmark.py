@@ -0,0 +1,1016 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the grade retrieval server in main.py.
+
+Run from this directory, e.g.:
+
+    python3 benchmark.py -b averages
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from os import path
+
+from main import (
+    FRAME_TYPE,
+    FN_HEADER,
+    GRADE_HEADERS,
+    ID_HEADER,
+    L1_HEADER,
+    LN_HEADER,
+    MT_HEADER,
+    PW_HEADER,
+    decode_frames,
+    encode_frame,
+    ColumnarGradebook,
+    CourseCatalog,
+    GradeRetrievalServer,
+    GradeUpdateLog,
+    Gradebook,
+    SnapshotGradebook,
+    SqliteGradebook,
+    compile_snapshot,
+    np,
+    parse_csv_rows,
+    raise_open_file_limit,
+    resource,
+)
+
+ROSTER_SIZES = (10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+SERVER_ADDRESS = ("127.0.0.1", GradeRetrievalServer.PORT)
+SERVER_START_TIMEOUT = 10
+
+
+def make_rows(count, seed=4, grade_headers=GRADE_HEADERS):
+    # Synthetic rows shaped like the ones csv.DictReader produces from
+    # grades.csv, i.e. every field is a string.
+    rng = random.Random(seed)
+    for i in range(count):
+        row = {
+            ID_HEADER: str(1_000_000 + i),
+            PW_HEADER: f"pw{i:08d}",
+            LN_HEADER: "Last",
+            FN_HEADER: "First",
+        }
+        for header in grade_headers:
+            row[header] = str(rng.randint(0, 100))
+        yield row
+
+
+def write_csv(filename, count, seed=4, grade_headers=GRADE_HEADERS):
+    # Write a synthetic roster atomically, the way a grade correction
+    # should be published to a server running with --watch.
+    partial_filename = filename + ".partial"
+    with open(partial_filename, "w", newline="") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=[ID_HEADER, PW_HEADER, LN_HEADER, FN_HEADER, *grade_headers])
+        writer.writeheader()
+        writer.writerows(make_rows(count, seed, grade_headers))
+    os.replace(partial_filename, filename)
+
+
+def load_credential_hashes(filename=GradeRetrievalServer.CSV_FILENAME):
+    # Valid GG requests for the students in the server's CSV file.
+    with open(filename) as csvfile:
+        return [Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER]) for row in csv.DictReader(csvfile)]
+
+
+def time_per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def build_gradebook(store, size):
+    gradebook = store()
+    fieldnames = [ID_HEADER, PW_HEADER, LN_HEADER, FN_HEADER, *GRADE_HEADERS]
+    records, _ = parse_csv_rows(fieldnames, (list(row.values()) for row in make_rows(size)))
+    gradebook.add_records(records)
+    return gradebook
+
+
+def offline_server(gradebook):
+    # A GradeRetrievalServer serving gradebook without any sockets, for
+    # timing the request handlers in process.
+    server = GradeRetrievalServer.__new__(GradeRetrievalServer)
+    server.gradebook = gradebook
+    server.cache_hits = 0
+    server.cache_misses = 0
+    server.weights = None
+    server.instructors = None
+    server.update_log = None
+    server.courses = None
+    return server
+
+
+def scan_average(rows, grade_header):
+    # The server's original AVG: a pass over every row, converting the
+    # grade field each time.
+    return sum(int(row[grade_header]) for row in rows) / len(rows)
+
+
+def bench_averages(args):
+    # The original scan against the running ColumnAggregate that AVG
+    # now reads. The scan is repeated less often for large rosters.
+    print(f"{'rows':>10} {'scan (us)':>12} {'avg latency (us)':>18}")
+    for size in args.sizes:
+        rows = list(make_rows(size))
+        gradebook = build_gradebook(Gradebook, size)
+        scan = time_per_call(lambda: scan_average(rows, MT_HEADER), max(1, min(args.repeat, 10_000_000 // size)))
+        latency = time_per_call(lambda: gradebook.average(MT_HEADER), args.repeat)
+        print(f"{size:>10} {scan * 1e6:>12.1f} {latency * 1e6:>18.3f}")
+
+
+def bench_statistics(args):
+    stores = {"dict": Gradebook}
+    if np is not None:
+        stores["columnar"] = ColumnarGradebook
+    else:
+        print("numpy is not installed, only benchmarking the dict store")
+
+    statistics = {
+        "median": lambda gradebook: gradebook.median(MT_HEADER),
+        "std_dev": lambda gradebook: gradebook.std_dev(MT_HEADER),
+        "pct 90": lambda gradebook: gradebook.percentile(MT_HEADER, 90),
+        "min/max": lambda gradebook: (gradebook.minimum(MT_HEADER), gradebook.maximum(MT_HEADER)),
+        "hist 10": lambda gradebook: gradebook.histogram(MT_HEADER, 10),
+    }
+
+    print(f"{'store':>9} {'rows':>9} {'bytes/row':>10} {'first (ms)':>11} "
+          + " ".join(f"{name + ' (us)':>14}" for name in statistics))
+    for size in args.sizes:
+        for name, store in stores.items():
+            tracemalloc.start()
+            gradebook = build_gradebook(store, size)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            # The first order statistic pays for sorting the column,
+            # the rest are answered from the sorted copy.
+            first = time_per_call(lambda: gradebook.median(L1_HEADER), 1)
+            latencies = [time_per_call(lambda: statistic(gradebook), args.repeat)
+                         for statistic in statistics.values()]
+            print(f"{name:>9} {size:>9} {memory / size:>10.1f} {first * 1e3:>11.3f} "
+                  + " ".join(f"{latency * 1e6:>14.3f}" for latency in latencies))
+
+
+@contextlib.contextmanager
+def running_server(*server_args, log=None, start_timeout=SERVER_START_TIMEOUT):
+    # Run main.py as a server in a child process and wait until it
+    # accepts connections. Its output goes to the log file if one is
+    # given (unbuffered, so it can be read while the server runs) and
+    # to /dev/null otherwise.
+    env = dict(os.environ, PYTHONUNBUFFERED="1") if log is not None else None
+    server = subprocess.Popen([sys.executable, "main.py", "-r", "server", *server_args],
+                              cwd=path.dirname(path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL if log is None else log,
+                              env=env)
+    try:
+        deadline = time.monotonic() + start_timeout
+        while True:
+            try:
+                socket.create_connection(SERVER_ADDRESS, timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("grade server did not start")
+                time.sleep(0.05)
+        yield server
+    finally:
+        # SIGTERM lets a pre-fork server stop its workers.
+        server.terminate()
+        try:
+            server.wait(timeout=SERVER_START_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+async def open_connection(timeout):
+    try:
+        return await asyncio.wait_for(asyncio.open_connection(*SERVER_ADDRESS), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+
+
+async def active_client(request, deadline, timeout, latencies):
+    connection = await open_connection(timeout)
+    if connection is None:
+        return False
+    reader, writer = connection
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            await asyncio.wait_for(reader.read(GradeRetrievalServer.RECV_BUFFER_SIZE), timeout)
+            latencies.append(time.perf_counter() - start)
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def concurrency_load(args):
+    # Park the idle connections first, as clients sitting at their
+    # "Enter a command:" prompt would, then let the active clients
+    # issue GMA requests back to back for the test duration.
+    idle = await asyncio.gather(*(open_connection(args.timeout) for _ in range(args.idle)))
+    latencies = []
+    deadline = time.monotonic() + args.duration
+    start = time.perf_counter()
+    completed = await asyncio.gather(*(active_client(b"GMA", deadline, args.timeout, latencies)
+                                       for _ in range(args.active)))
+    elapsed = time.perf_counter() - start
+    for connection in idle:
+        if connection is not None:
+            connection[1].close()
+    latencies.sort()
+    return {
+        "idle connected": sum(connection is not None for connection in idle),
+        "active ok": sum(completed),
+        "requests": len(latencies),
+        "req/s": len(latencies) / elapsed,
+        "p50 (ms)": percentile(latencies, 50) * 1e3,
+        "p99 (ms)": percentile(latencies, 99) * 1e3,
+    }
+
+
+def bench_concurrency(args):
+    raise_open_file_limit()
+    modes = {"blocking": (), "asyncio": ("--asyncio",)}
+    results = {}
+    for name, server_args in modes.items():
+        with running_server(*server_args):
+            results[name] = asyncio.run(concurrency_load(args))
+
+    print(f"{args.idle} idle + {args.active} active connections, {args.duration} s")
+    columns = list(results["asyncio"])
+    print(f"{'server':>9} " + " ".join(f"{column:>14}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:>9} " + " ".join(f"{result[column]:>14.1f}" if isinstance(result[column], float)
+                                       else f"{result[column]:>14}" for column in columns))
+
+
+def lookups_per_second_unframed(hashes, count):
+    with socket.create_connection(SERVER_ADDRESS) as connection:
+        start = time.perf_counter()
+        for i in range(count):
+            connection.sendall(hashes[i % len(hashes)])
+            connection.recv(GradeRetrievalServer.RECV_BUFFER_SIZE)
+        return count / (time.perf_counter() - start)
+
+
+def lookups_per_second_framed(hashes, count, batch):
+    frame_buffer = bytearray()
+    with socket.create_connection(SERVER_ADDRESS) as connection:
+        start = time.perf_counter()
+        for first in range(0, count, batch):
+            size = min(batch, count - first)
+            connection.sendall(b"".join(encode_frame("grades", hashes[(first + i) % len(hashes)])
+                                        for i in range(size)))
+            received = 0
+            while received < size:
+                frame_buffer += connection.recv(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE)
+                frames = decode_frames(frame_buffer)
+                assert all(frame_type == FRAME_TYPE["response"] for frame_type, _ in frames)
+                received += len(frames)
+        return count / (time.perf_counter() - start)
+
+
+def bench_pipelining(args):
+    hashes = load_credential_hashes()
+    print(f"{'protocol':>18} {'lookups/s':>12}")
+    with running_server():
+        rate = lookups_per_second_unframed(hashes, args.repeat)
+        print(f"{'unframed':>18} {rate:>12.0f}")
+    with running_server("--framed"):
+        for batch in args.batches:
+            rate = lookups_per_second_framed(hashes, args.repeat, batch)
+            print(f"{f'framed, batch {batch}':>18} {rate:>12.0f}")
+
+
+def poll_averages(stop, samples):
+    # One client issuing GMA back to back, recording when each request
+    # was sent, how long it took and the answer.
+    with socket.create_connection(SERVER_ADDRESS) as connection:
+        while not stop.is_set():
+            start = time.perf_counter()
+            connection.sendall(b"GMA")
+            answer = connection.recv(GradeRetrievalServer.RECV_BUFFER_SIZE)
+            samples.append((start, time.perf_counter() - start, answer))
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    return (f"{len(latencies):>9} {percentile(latencies, 50) * 1e3:>9.3f} "
+            f"{percentile(latencies, 99) * 1e3:>9.3f} {max(latencies, default=float('nan')) * 1e3:>9.3f}")
+
+
+def read_log(log_filename):
+    with open(log_filename) as log:
+        return log.read()
+
+
+def bench_reload(args):
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        log_filename = path.join(directory, "server.log")
+        for size in args.sizes:
+            write_csv(csv_filename, size, seed=1)
+            with open(log_filename, "w") as log, \
+                    running_server("--csv", csv_filename, "--watch", log=log):
+                stop = threading.Event()
+                samples = []
+                client = threading.Thread(target=poll_averages, args=(stop, samples))
+                client.start()
+                time.sleep(args.duration)
+
+                replaced = time.perf_counter()
+                write_csv(csv_filename, size, seed=2)
+                deadline = time.monotonic() + SERVER_START_TIMEOUT + size / 10_000
+                while "Reloaded" not in read_log(log_filename) and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                reloaded = time.perf_counter()
+                time.sleep(args.duration)
+                stop.set()
+                client.join()
+
+            match = re.search(r"Reloaded .* in ([0-9.]+) ms", read_log(log_filename))
+            reload_ms = float(match.group(1)) if match else float("nan")
+            before = [latency for start, latency, _ in samples if start < replaced]
+            during = [latency for start, latency, _ in samples if replaced <= start < reloaded]
+            after = [latency for start, latency, _ in samples if start >= reloaded]
+            answers = {answer for start, _, answer in samples if start >= reloaded}
+            print(f"{size} rows, reload took {reload_ms:.1f} ms, "
+                  f"{'answers changed' if samples and answers != {samples[0][2]} else 'answers unchanged'}")
+            print(f"{'window':>8} {'requests':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+            for name, latencies in (("before", before), ("reload", during), ("after", after)):
+                print(f"{name:>8} {latency_summary(latencies)}")
+
+
+def server_startup_time(*server_args, start_timeout):
+    start = time.perf_counter()
+    with running_server(*server_args, start_timeout=start_timeout):
+        return time.perf_counter() - start
+
+
+def bench_startup(args):
+    print(f"{'rows':>9} {'compile (s)':>12} {'csv load (ms)':>14} {'mmap load (ms)':>15} "
+          f"{'csv start (ms)':>15} {'mmap start (ms)':>16}")
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        snapshot_filename = path.join(directory, "grades.snapshot")
+        for size in args.sizes:
+            write_csv(csv_filename, size)
+            csv_stat = os.stat(csv_filename)
+
+            start = time.perf_counter()
+            compile_snapshot(csv_filename, snapshot_filename)
+            compile_time = time.perf_counter() - start
+
+            csv_load = time_per_call(lambda: Gradebook.from_csv(csv_filename), 1)
+            snapshot_load = time_per_call(
+                lambda: SnapshotGradebook(snapshot_filename, (csv_stat.st_mtime_ns, csv_stat.st_size)), 1)
+
+            # End to end, including interpreter startup and, for the CSV
+            # path, printing every row.
+            start_timeout = SERVER_START_TIMEOUT + size / 10_000
+            csv_start = server_startup_time("--csv", csv_filename, start_timeout=start_timeout)
+            snapshot_start = server_startup_time("--csv", csv_filename, "--snapshot", snapshot_filename,
+                                                 start_timeout=start_timeout)
+            print(f"{size:>9} {compile_time:>12.2f} {csv_load * 1e3:>14.1f} {snapshot_load * 1e3:>15.3f} "
+                  f"{csv_start * 1e3:>15.1f} {snapshot_start * 1e3:>16.1f}")
+
+
+def bench_ingest(args):
+    worker_counts = sorted({1, *args.workers})
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'rows':>9} {'workers':>8} {'load (s)':>9} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        for size in args.sizes:
+            write_csv(csv_filename, size)
+            serial = None
+            for workers in worker_counts:
+                load = time_per_call(lambda: Gradebook.from_csv(csv_filename, workers=workers), 1)
+                serial = serial or load
+                print(f"{size:>9} {workers:>8} {load:>9.2f} {serial / load:>8.2f}")
+
+
+def bench_responses(args):
+    hashes = load_credential_hashes()
+    server = offline_server(Gradebook.from_csv(path.join(path.dirname(path.abspath(__file__)), "grades.csv")))
+
+    def uncached_lookup():
+        server.gradebook.responses.clear()
+        for hash in hashes:
+            server.process_request(hash)
+
+    def cached_lookup():
+        for hash in hashes:
+            server.process_request(hash)
+
+    # Silence the per-request logging so that only the handler is timed.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        uncached = time_per_call(uncached_lookup, args.repeat) / len(hashes)
+        cached = time_per_call(cached_lookup, args.repeat) / len(hashes)
+    print(f"{'GG lookup':>10} {'latency (us)':>13}")
+    print(f"{'uncached':>10} {uncached * 1e6:>13.3f}")
+    print(f"{'cached':>10} {cached * 1e6:>13.3f}")
+    print(f"hits: {server.cache_hits}, misses: {server.cache_misses}")
+
+
+def bench_rank(args):
+    print(f"{'rows':>9} {'index (ms)':>11} {'rank (us)':>10} {'scan (us)':>10} {'top 10 (us)':>12}")
+    for size in args.sizes:
+        gradebook = build_gradebook(Gradebook, size)
+        hash = next(iter(gradebook.data))
+        build = time_per_call(gradebook.build_indexes, 1)
+        rank = time_per_call(lambda: gradebook.rank(hash, MT_HEADER), args.repeat)
+
+        def scan():
+            # What answering the query by walking every record costs.
+            i = gradebook.columns.index(MT_HEADER)
+            grade = gradebook.data[hash].grades[i]
+            return 1 + sum(record.grades[i] > grade for record in gradebook.data.values())
+
+        scan_time = time_per_call(scan, max(1, args.repeat // size))
+        top = time_per_call(lambda: gradebook.ranked_students(MT_HEADER, *gradebook.top_positions(MT_HEADER, 10)),
+                            args.repeat)
+        print(f"{size:>9} {build * 1e3:>11.1f} {rank * 1e6:>10.2f} {scan_time * 1e6:>10.1f} {top * 1e6:>12.2f}")
+
+
+def bench_processes(args):
+    # Closed loop GMA load against the pre-fork server for each process
+    # count. The workers run the asyncio server so that each of them can
+    # serve many of the clients, and share one compiled snapshot.
+    raise_open_file_limit()
+    args.idle = 0
+    print(f"{os.cpu_count()} CPUs, {args.active} clients, {args.duration} s per run")
+    print(f"{'processes':>9} {'req/s':>10} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_filename = path.join(directory, "grades.snapshot")
+        for processes in sorted(set(args.workers)):
+            with running_server("--processes", str(processes), "--asyncio", "--snapshot", snapshot_filename):
+                result = asyncio.run(concurrency_load(args))
+            print(f"{processes:>9} {result['req/s']:>10.0f} {result['p50 (ms)']:>9.2f} {result['p99 (ms)']:>9.2f}")
+
+
+def parse_mix(mix):
+    # "avg=2 gg=1 bad=1" -> {"avg": 2.0, "gg": 1.0, "bad": 1.0}
+    weights = {}
+    for item in mix:
+        kind, _, weight = item.partition("=")
+        if kind not in ("avg", "gg", "bad"):
+            raise ValueError(f"unknown request kind {kind}, expected avg, gg or bad")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def load_requests(args):
+    # Request bytes for each kind in the mix: the five average commands,
+    # valid ID/password hashes from the CSV file and random hashes.
+    rng = random.Random(args.seed)
+    return {
+        "avg": [command for command in GradeRetrievalServer.AVG_COMMANDS],
+        "gg": load_credential_hashes(args.csv),
+        "bad": [rng.randbytes(32) for _ in range(1_000)],
+    }
+
+
+async def load_client(args, requests, weights, deadline, samples, seed):
+    connection = await open_connection(args.timeout)
+    if connection is None:
+        samples["connect errors"] = samples.get("connect errors", 0) + 1
+        return
+    reader, writer = connection
+    rng = random.Random(seed)
+    kinds = list(weights)
+    frame_buffer = bytearray()
+    try:
+        while time.monotonic() < deadline:
+            kind = rng.choices(kinds, weights=[weights[kind] for kind in kinds])[0]
+            request = rng.choice(requests[kind])
+            start = time.perf_counter()
+            if args.framed:
+                writer.write(encode_frame("command" if kind == "avg" else "grades", request))
+                while not decode_frames(frame_buffer):
+                    recvd_bytes = await asyncio.wait_for(reader.read(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE),
+                                                         args.timeout)
+                    if not recvd_bytes:
+                        raise ConnectionError("server closed the connection")
+                    frame_buffer += recvd_bytes
+            else:
+                writer.write(request)
+                recvd_bytes = await asyncio.wait_for(reader.read(GradeRetrievalServer.RECV_BUFFER_SIZE), args.timeout)
+                if not recvd_bytes:
+                    raise ConnectionError("server closed the connection")
+            samples[kind].append(time.perf_counter() - start)
+    except (OSError, asyncio.TimeoutError):
+        samples["request errors"] = samples.get("request errors", 0) + 1
+    finally:
+        writer.close()
+
+
+async def generate_load(args, requests, weights):
+    samples = {kind: [] for kind in weights}
+    deadline = time.monotonic() + args.duration
+    start = time.perf_counter()
+    await asyncio.gather(*(load_client(args, requests, weights, deadline, samples, args.seed + i)
+                           for i in range(args.active)))
+    return samples, time.perf_counter() - start
+
+
+def summarize_load(samples, elapsed):
+    latencies = {kind: sorted(values) for kind, values in samples.items() if isinstance(values, list)}
+    latencies["all"] = sorted(latency for values in latencies.values() for latency in values)
+    summary = {}
+    for kind, values in latencies.items():
+        summary[kind] = {
+            "requests": len(values),
+            "throughput": len(values) / elapsed,
+            "p50_ms": percentile(values, 50) * 1e3,
+            "p95_ms": percentile(values, 95) * 1e3,
+            "p99_ms": percentile(values, 99) * 1e3,
+            "max_ms": max(values, default=float("nan")) * 1e3,
+        }
+    errors = {kind: count for kind, count in samples.items() if isinstance(count, int)}
+    return {"elapsed_s": elapsed, "latency": summary, "errors": errors}
+
+
+def bench_load(args):
+    # Closed loop load generator: every simulated client sends a request
+    # drawn from the mix and waits for the reply before sending the next.
+    raise_open_file_limit()
+    weights = parse_mix(args.mix)
+    requests = load_requests(args)
+    if args.external:
+        samples, elapsed = asyncio.run(generate_load(args, requests, weights))
+    else:
+        server_args = ["--csv", args.csv] + (["--framed"] if args.framed else []) + args.server_args
+        with running_server(*server_args):
+            samples, elapsed = asyncio.run(generate_load(args, requests, weights))
+    result = summarize_load(samples, elapsed)
+    result["config"] = {"clients": args.active, "duration_s": args.duration, "mix": weights,
+                        "framed": args.framed, "server_args": args.server_args}
+
+    print(f"{args.active} clients, {args.duration} s, mix {' '.join(args.mix)}")
+    print(f"{'kind':>5} {'requests':>9} {'req/s':>9} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for kind, stats in result["latency"].items():
+        print(f"{kind:>5} {stats['requests']:>9} {stats['throughput']:>9.0f} {stats['p50_ms']:>9.3f} "
+              f"{stats['p95_ms']:>9.3f} {stats['p99_ms']:>9.3f} {stats['max_ms']:>9.3f}")
+    for kind, count in result["errors"].items():
+        print(f"{kind}: {count}")
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(result, json_file, indent=2)
+        print(f"Results written to {args.json}")
+
+
+def bench_client(args):
+    # Average queries from code: a new connection per query, as every
+    # script did before, against GradeClient's pool of warm connections.
+    from grade_client import GradeClient
+
+    def connect_per_query():
+        with socket.create_connection(SERVER_ADDRESS) as connection:
+            connection.sendall(b"GMA")
+            connection.recv(GradeRetrievalServer.RECV_BUFFER_SIZE)
+
+    print(f"{'client':>18} {'latency (us)':>13}")
+    with running_server("--asyncio"), GradeClient(host=SERVER_ADDRESS[0]) as client:
+        client.get_average(MT_HEADER)
+        per_query = time_per_call(connect_per_query, args.repeat)
+        pooled = time_per_call(lambda: client.get_average(MT_HEADER), args.repeat)
+    print(f"{'connect per query':>18} {per_query * 1e6:>13.1f}")
+    print(f"{'pooled':>18} {pooled * 1e6:>13.1f}")
+
+
+def bench_udp(args):
+    # Latency of one-shot average queries on loopback: a TCP connection
+    # per query, a datagram per query, and, for reference, a warm
+    # pooled TCP connection.
+    from grade_client import DatagramGradeClient, GradeClient
+
+    def connect_per_query():
+        with socket.create_connection(SERVER_ADDRESS) as connection:
+            connection.sendall(b"GMA")
+            connection.recv(GradeRetrievalServer.RECV_BUFFER_SIZE)
+
+    print(f"{'server':>9} {'client':>18} {'latency (us)':>13}")
+    for server_args in ((), ("--asyncio",)):
+        name = "asyncio" if server_args else "blocking"
+        with running_server("--udp", *server_args), DatagramGradeClient(host=SERVER_ADDRESS[0]) as datagram_client:
+            datagram_client.get_average(MT_HEADER)
+            per_query = time_per_call(connect_per_query, args.repeat)
+            datagram = time_per_call(lambda: datagram_client.get_average(MT_HEADER), args.repeat)
+            with GradeClient(host=SERVER_ADDRESS[0]) as client:
+                client.get_average(MT_HEADER)
+                pooled = time_per_call(lambda: client.get_average(MT_HEADER), args.repeat)
+        print(f"{name:>9} {'TCP connect/query':>18} {per_query * 1e6:>13.1f}")
+        print(f"{name:>9} {'UDP datagram':>18} {datagram * 1e6:>13.1f}")
+        print(f"{name:>9} {'TCP pooled':>18} {pooled * 1e6:>13.1f}")
+
+
+def bench_memory(args):
+    # Bytes per student for the rows csv.DictReader produces, which the
+    # server used to keep as they were, and for each store.
+    stores = {"dict rows": None, "records": Gradebook}
+    if np is not None:
+        stores["columnar"] = ColumnarGradebook
+    print(f"{'store':>10} {'rows':>9} {'bytes/row':>10} {'reported':>9}")
+    for size in args.sizes:
+        for name, store in stores.items():
+            tracemalloc.start()
+            if store is None:
+                gradebook = {Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER]): row
+                             for row in make_rows(size)}
+                reported = float("nan")
+            else:
+                gradebook = build_gradebook(store, size)
+                reported = gradebook.memory_usage() / size
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"{name:>10} {size:>9} {memory / size:>10.1f} {reported:>9.1f}")
+            del gradebook
+
+
+def wide_grade_headers(count):
+    # The five lab columns followed by quizzes, count columns in all.
+    return GRADE_HEADERS + tuple(f"Quiz {i}" for i in range(1, count - len(GRADE_HEADERS) + 1))
+
+
+def bench_columns(args):
+    # Load time and AGG latency as the sheet gets wider. The AGG
+    # commands ask about the last column.
+    stores = {"dict": Gradebook}
+    if np is not None:
+        stores["columnar"] = ColumnarGradebook
+    print(f"{'store':>9} {'rows':>8} {'columns':>8} {'load (s)':>9} {'indexes (s)':>12} "
+          f"{'mean (us)':>10} {'median (us)':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        for size in args.sizes:
+            for column_count in args.columns:
+                grade_headers = wide_grade_headers(column_count)
+                write_csv(csv_filename, size, grade_headers=grade_headers)
+                mean_command = f'AGG "{grade_headers[-1]}" mean'.encode()
+                median_command = f'AGG "{grade_headers[-1]}" median'.encode()
+                for name, store in stores.items():
+                    start = time.perf_counter()
+                    server = offline_server(store.from_csv(csv_filename))
+                    load = time.perf_counter() - start
+                    indexes = time_per_call(server.gradebook.build_indexes, 1)
+                    gradebook = server.gradebook
+                    mean = time_per_call(lambda: server.calculate_aggregate(mean_command, gradebook), args.repeat)
+                    median = time_per_call(lambda: server.calculate_aggregate(median_command, gradebook), args.repeat)
+                    print(f"{name:>9} {size:>8} {column_count:>8} {load:>9.2f} {indexes:>12.2f} "
+                          f"{mean * 1e6:>10.2f} {median * 1e6:>12.2f}")
+
+
+def bench_weighted(args):
+    # DIST with a fresh weighting scheme computes the whole class's
+    # totals in one batch; repeating it, or FINAL for any student with
+    # the same weights, is answered from the cache. "loop" is the same
+    # computation done one student at a time.
+    stores = {"dict": Gradebook}
+    if np is not None:
+        stores["columnar"] = ColumnarGradebook
+    command = b"DIST MT=40 L1=15 L2=15 L3=15 L4=15"
+    weights = {MT_HEADER: 0.4, **{header: 0.15 for header in GRADE_HEADERS[1:]}}
+    print(f"{'store':>9} {'rows':>9} {'loop (ms)':>10} {'batch (ms)':>11} {'cached (us)':>12} {'FINAL (us)':>11}")
+    for size in args.sizes:
+        for name, store in stores.items():
+            server = offline_server(build_gradebook(store, size))
+            gradebook = server.gradebook
+            hashes = gradebook.grade_rows()[0]
+            final_command = f"FINAL {hashes[0].hex()} MT=40 L1=15 L2=15 L3=15 L4=15".encode()
+
+            def loop():
+                return sorted(sum(gradebook.grades(hash)[header] * weight for header, weight in weights.items())
+                              for hash in hashes)
+
+            def uncached():
+                gradebook.data_changed()
+                server.process_request(command)
+
+            repeat = max(1, args.repeat // size)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                loop_time = time_per_call(loop, repeat)
+                batch = time_per_call(uncached, repeat)
+                cached = time_per_call(lambda: server.process_request(command), args.repeat)
+                final = time_per_call(lambda: server.process_request(final_command), args.repeat)
+            print(f"{name:>9} {size:>9} {loop_time * 1e3:>10.2f} {batch * 1e3:>11.2f} "
+                  f"{cached * 1e6:>12.2f} {final * 1e6:>11.2f}")
+
+
+def measure_store(store_name, csv_filename, memory_budget, repeat):
+    # Runs in a fresh process, so that ru_maxrss is the peak resident
+    # memory of loading and querying this store alone.
+    store = GradeRetrievalServer.STORES[store_name]
+    options = {"memory_budget": memory_budget} if store is SqliteGradebook else {}
+    start = time.perf_counter()
+    server = offline_server(store.from_csv(csv_filename, **options))
+    load = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    hashes = load_credential_hashes(csv_filename)
+    rng = random.Random(4)
+    sample = [rng.choice(hashes) for _ in range(repeat)]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        cold = time_per_call(lambda: server.process_request(sample.pop()), repeat)
+        warm = time_per_call(lambda: server.process_request(hashes[0]), repeat)
+        median = time_per_call(lambda: server.process_request(b"MED MT"), max(1, repeat // 100))
+        average = time_per_call(lambda: server.process_request(b"GMA"), repeat)
+    return load, peak, cold, warm, median, average
+
+
+def bench_sqlite(args):
+    # Peak memory after loading, and latency, of the in-memory dict
+    # store and of the SQLite store (the second sqlite run reuses the
+    # database). The peak includes the interpreter and numpy. GG
+    # lookups are timed for random students ("GG cold") and for one
+    # student over and over ("GG hot").
+    memory_budget = args.memory_budget << 20
+    context = multiprocessing.get_context("spawn")
+    print(f"memory budget {args.memory_budget} MB")
+    print(f"{'store':>9} {'rows':>9} {'load (s)':>9} {'peak (MB)':>10} {'GG cold (us)':>13} "
+          f"{'GG hot (us)':>12} {'MED (us)':>9} {'GMA (us)':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        for size in args.sizes:
+            write_csv(csv_filename, size)
+            for store_name in ("dict", "sqlite", "sqlite"):
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+                    result = pool.submit(measure_store, store_name, csv_filename, memory_budget,
+                                         min(args.repeat, size)).result()
+                load, peak, cold, warm, median, average = result
+                print(f"{store_name:>9} {size:>9} {load:>9.2f} {peak:>10.1f} {cold * 1e6:>13.1f} "
+                      f"{warm * 1e6:>12.1f} {median * 1e6:>9.1f} {average * 1e6:>9.1f}")
+
+
+def update_commands(hashes, count, instructor_hash, seed=4):
+    # UPDATE commands setting random grades of random students.
+    rng = random.Random(seed)
+    codes = ("MT", "L1", "L2", "L3", "L4")
+    return [f"UPDATE {instructor_hash.hex()} {rng.choice(hashes).hex()} {rng.choice(codes)} {rng.randint(0, 100)}"
+            .encode() for _ in range(count)]
+
+
+def updates_per_second_batched(commands, batch):
+    # One connection, batch updates pipelined per round trip: each
+    # batch is made durable with one fsync.
+    with socket.create_connection(SERVER_ADDRESS) as connection:
+        frame_buffer = bytearray()
+        start = time.perf_counter()
+        for i in range(0, len(commands), batch):
+            frames = commands[i:i + batch]
+            connection.sendall(b"".join(encode_frame("command", command) for command in frames))
+            received = 0
+            while received < len(frames):
+                frame_buffer += connection.recv(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE)
+                received += len(decode_frames(frame_buffer))
+        return len(commands) / (time.perf_counter() - start)
+
+
+async def updates_per_second_concurrent(commands, clients):
+    # clients connections each sending one update at a time: updates
+    # from different connections share fsyncs (group commit).
+    async def client(share):
+        reader, writer = await asyncio.open_connection(*SERVER_ADDRESS)
+        frame_buffer = bytearray()
+        for command in share:
+            writer.write(encode_frame("command", command))
+            while not decode_frames(frame_buffer):
+                frame_buffer += await reader.read(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(commands[i::clients]) for i in range(clients)))
+    return len(commands) / (time.perf_counter() - start)
+
+
+def bench_updates(args):
+    # Throughput of logged UPDATE commands against an asyncio server
+    # with updates enabled, and how long replaying a log takes at
+    # startup (on a roster of the first size).
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        instructors_filename = path.join(directory, "instructors.csv")
+        write_csv(csv_filename, args.sizes[0])
+        with open(instructors_filename, "w") as instructors:
+            instructors.write(f"{ID_HEADER},{PW_HEADER}\ninstructor,secret\n")
+        commands = update_commands(load_credential_hashes(csv_filename), args.repeat,
+                                   Gradebook.credentials_hash("instructor", "secret"))
+
+        with running_server("--asyncio", "--framed", "--csv", csv_filename, "--instructors", instructors_filename):
+            print(f"{'batch':>9} {'updates/s':>10}")
+            for batch in args.batches:
+                print(f"{batch:>9} {updates_per_second_batched(commands, batch):>10.0f}")
+            print(f"{'clients':>9} {'updates/s':>10}")
+            for clients in args.workers:
+                print(f"{clients:>9} {asyncio.run(updates_per_second_concurrent(commands, clients)):>10.0f}")
+
+        print(f"{'entries':>9} {'replay (ms)':>12}")
+        log_filename = path.join(directory, "replay.wal")
+        hashes = load_credential_hashes(csv_filename)
+        for size in args.sizes[1:]:
+            rng = random.Random(4)
+            log = GradeUpdateLog(log_filename)
+            for _ in range(size):
+                log.append(rng.choice(hashes), rng.choice(GRADE_HEADERS), rng.randint(0, 100))
+            log.sync(log.appended)
+            log.close()
+            gradebook = Gradebook.from_csv(csv_filename)
+            replay = time_per_call(lambda: GradeUpdateLog.replay(log_filename, gradebook), 1)
+            print(f"{size:>9} {replay * 1e3:>12.1f}")
+            os.remove(log_filename)
+
+
+def bench_courses(args):
+    # A server hosting --course-count courses of the first size each,
+    # answering GMA for courses picked with a Zipf-like skew (course i
+    # is requested in proportion to 1 / (i + 1)), under each course
+    # memory ceiling.
+    courses = [f"course{i:03d}" for i in range(args.course_count)]
+    rng = random.Random(args.seed)
+    requests = [f"@{course} GMA".encode() for course in
+                rng.choices(courses, weights=[1 / (i + 1) for i in range(len(courses))], k=args.repeat)]
+    print(f"{args.course_count} courses of {args.sizes[0]} rows, {args.repeat} requests")
+    print(f"{'memory (MB)':>12} {'hit rate':>9} {'loads':>6} {'evictions':>10} {'load (ms)':>10} "
+          f"{'request (us)':>13}")
+    with tempfile.TemporaryDirectory() as directory:
+        for i, course in enumerate(courses):
+            write_csv(path.join(directory, course + ".csv"), args.sizes[0], seed=i)
+        for course_memory in args.course_memory:
+            server = offline_server(Gradebook())
+            server.courses = CourseCatalog(directory, Gradebook, memory_limit=course_memory << 20)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                pending = list(requests)
+                request_time = time_per_call(lambda: server.process_request(pending.pop()), len(requests))
+            stats = server.courses.stats.values()
+            loads = sum(course_stats.loads for course_stats in stats)
+            load_time = sum(course_stats.load_time for course_stats in stats) / max(loads, 1)
+            print(f"{course_memory:>12} {1 - loads / args.repeat:>9.1%} {loads:>6} "
+                  f"{sum(course_stats.evictions for course_stats in stats):>10} {load_time * 1e3:>10.1f} "
+                  f"{request_time * 1e6:>13.1f}")
+
+
+def bench_subscribe(args):
+    # A dashboard watching the midterm average while bursts of updates
+    # (the --batches sizes, one burst per second) change it: the
+    # notifications it receives and their delay after the last update
+    # of a burst, against the requests a dashboard polling GMA every
+    # 100 ms would have sent over the same time.
+    from grade_client import GradeClient
+
+    poll_interval = 0.1
+    with tempfile.TemporaryDirectory() as directory:
+        csv_filename = path.join(directory, "grades.csv")
+        instructors_filename = path.join(directory, "instructors.csv")
+        write_csv(csv_filename, args.sizes[0])
+        with open(instructors_filename, "w") as instructors:
+            instructors.write(f"{ID_HEADER},{PW_HEADER}\ninstructor,secret\n")
+        student_ids = [str(1_000_000 + i) for i in range(args.sizes[0])]
+        rng = random.Random(args.seed)
+
+        with running_server("--asyncio", "--csv", csv_filename, "--instructors", instructors_filename), \
+                GradeClient(host=SERVER_ADDRESS[0]) as client:
+            notifications = []
+
+            def listen():
+                # Ends when the server is stopped.
+                with contextlib.suppress(ConnectionError):
+                    for averages in client.subscribe([MT_HEADER]):
+                        notifications.append(time.monotonic())
+
+            threading.Thread(target=listen, daemon=True).start()
+            time.sleep(0.5)
+            print(f"{'burst':>9} {'notifications':>14} {'delay (ms)':>11}")
+            start = time.monotonic()
+            for burst in args.batches:
+                notified = len(notifications)
+                for _ in range(burst):
+                    client.update_grades("instructor", "secret", [(rng.choice(student_ids), "MT", rng.randint(0, 100))])
+                last_update = time.monotonic()
+                time.sleep(1)
+                delays = [notification - last_update for notification in notifications[notified:]]
+                print(f"{burst:>9} {len(delays):>14} {max(delays, default=0) * 1e3:>11.1f}")
+            elapsed = time.monotonic() - start
+        print(f"{len(notifications) - 1} notifications in {elapsed:.1f} s, "
+              f"polling every {poll_interval * 1e3:.0f} ms would have sent {elapsed / poll_interval:.0f} requests")
+
+
+BENCHMARKS = {
+    "averages": bench_averages,
+    "statistics": bench_statistics,
+    "concurrency": bench_concurrency,
+    "pipelining": bench_pipelining,
+    "reload": bench_reload,
+    "startup": bench_startup,
+    "ingest": bench_ingest,
+    "responses": bench_responses,
+    "rank": bench_rank,
+    "processes": bench_processes,
+    "load": bench_load,
+    "client": bench_client,
+    "udp": bench_udp,
+    "memory": bench_memory,
+    "columns": bench_columns,
+    "weighted": bench_weighted,
+    "sqlite": bench_sqlite,
+    "updates": bench_updates,
+    "subscribe": bench_subscribe,
+    "courses": bench_courses,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-b', '--bench',
+                        choices=BENCHMARKS,
+                        help='benchmark to run',
+                        required=True, type=str)
+    parser.add_argument('-n', '--sizes',
+                        nargs='+', type=int, default=ROSTER_SIZES,
+                        help='roster sizes to benchmark')
+    parser.add_argument('--repeat',
+                        type=int, default=10_000,
+                        help='requests timed per measurement')
+    parser.add_argument('--idle',
+                        type=int, default=10_000,
+                        help='idle connections held open (concurrency)')
+    parser.add_argument('--active',
+                        type=int, default=1_000,
+                        help='clients issuing requests (concurrency, processes, load)')
+    parser.add_argument('--duration',
+                        type=float, default=10.0,
+                        help='seconds of load per server (concurrency, processes, load)')
+    parser.add_argument('--timeout',
+                        type=float, default=5.0,
+                        help='connect/response timeout in seconds (concurrency, processes, load)')
+    parser.add_argument('--workers',
+                        nargs='+', type=int, default=(1, 2, 4, os.cpu_count()),
+                        help='process pool sizes (ingest) or server processes (processes)')
+    parser.add_argument('--columns',
+                        nargs='+', type=int, default=(5, 50, 200),
+                        help='grade columns per sheet (columns)')
+    parser.add_argument('--memory-budget',
+                        type=int, default=16,
+                        help='memory budget of the sqlite store in MB (sqlite)')
+    parser.add_argument('--course-count',
+                        type=int, default=50,
+                        help='courses hosted by the server (courses)')
+    parser.add_argument('--course-memory',
+                        nargs='+', type=int, default=(1, 4, 16, 64),
+                        help='memory ceilings of the loaded courses in MB (courses)')
+    parser.add_argument('--batches',
+                        nargs='+', type=int, default=(1, 10, 100, 1_000),
+                        help='requests per pipelined round trip (pipelining)')
+    parser.add_argument('--mix',
+                        nargs='+', default=('avg=1', 'gg=1', 'bad=1'),
+                        help='request mix as kind=weight, kinds avg, gg and bad (load)')
+    parser.add_argument('--csv',
+                        default=GradeRetrievalServer.CSV_FILENAME,
+                        help='CSV file served and used for valid credentials (load)')
+    parser.add_argument('--framed',
+                        action='store_true',
+                        help='use the framed protocol (load)')
+    parser.add_argument('--external',
+                        action='store_true',
+                        help='load a server that is already running instead of starting one (load)')
+    parser.add_argument('--server-args',
+                        nargs=argparse.REMAINDER, default=[],
+                        help='extra arguments for the started server, must come last (load)')
+    parser.add_argument('--json',
+                        help='also write the results as JSON to this file (load)')
+    parser.add_argument('--seed',
+                        type=int, default=4,
+                        help='random seed for the request mix (load)')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](args)
@@ -0,0 +1,705 @@
+#!/usr/bin/python3
+"""
+Programmatic client for the grade retrieval server in main.py.
+
+GradeClient (blocking) and AsyncGradeClient (asyncio) keep a pool of
+persistent connections to the server instead of opening one per query:
+
+    with GradeClient() as client:
+        print(client.get_average("Midterm"))
+        print(client.get_grades("1788788", "SiKoLkVb"))
+        print(client.get_aggregate("Lab 2", "pct", 90))
+
+GradeClient.subscribe() (and AsyncGradeClient.subscribe(), with async
+for) yields the averages whenever they change, instead of polling:
+
+    for averages in client.subscribe(["Midterm"]):
+        print(averages)
+
+Set framed=True when the server runs with --framed; batches are then
+pipelined over a single connection. Unframed responses carry no length,
+so a pooled connection is only reused when nothing is left unread on it;
+framed=True is the safe choice for large responses. With
+course="ece4dn4" every request goes to that course of a server started
+with --courses.
+
+DatagramGradeClient asks a server started with --udp for averages and
+other public statistics in single datagrams, with no connection setup:
+
+    client = DatagramGradeClient()
+    print(client.get_average("Midterm"))
+"""
+
+import asyncio
+import collections
+import itertools
+import os
+import re
+import shlex
+import socket
+import threading
+import time
+
+from main import (
+    COLUMN_CODES,
+    COURSE_PREFIX,
+    DATAGRAM_REQUEST_ID_LEN,
+    FRAME_TYPE,
+    GET_AGGREGATE_CMD,
+    GET_COLUMNS_CMD,
+    GET_COURSES_CMD,
+    GET_DISTRIBUTION_CMD,
+    GET_FINAL_GRADE_CMD,
+    SUBSCRIBE_CMD,
+    UPDATE_GRADE_CMD,
+    GradeRetrievalClient,
+    MAX_DATAGRAM_LEN,
+    MAX_FRAME_PAYLOAD_LEN,
+    GradeRetrievalServer,
+    Gradebook,
+    decode_frames,
+    encode_frame,
+)
+
+
+class GradeServerError(Exception):
+    pass
+
+
+# Largest unframed response read in one receive, the same as the
+# largest frame payload.
+UNFRAMED_RECV_SIZE = MAX_FRAME_PAYLOAD_LEN
+
+
+def average_command(column):
+    # Accepts a column header ("Midterm") or column code ("MT").
+    grade_header = COLUMN_CODES.get(column, column)
+    for command, header in GradeRetrievalServer.AVG_COMMANDS.items():
+        if header == grade_header:
+            return command
+    raise ValueError(f"No average command for column {column}")
+
+
+def parse_average(response):
+    try:
+        return float(response)
+    except ValueError:
+        raise GradeServerError(response.decode(GradeRetrievalServer.MSG_ENCODING)) from None
+
+
+def aggregate_command(column, statistic, argument=None):
+    # e.g. ("Quiz 3", "pct", 90) -> b"AGG 'Quiz 3' pct 90"
+    args = [GET_AGGREGATE_CMD, shlex.quote(column), statistic] + ([str(argument)] if argument is not None else [])
+    return " ".join(args).encode(GradeRetrievalServer.MSG_ENCODING)
+
+
+def parse_aggregate(response):
+    # A number, or the text of a histogram.
+    text = response.decode(GradeRetrievalServer.MSG_ENCODING)
+    if text.startswith("Error"):
+        raise GradeServerError(text)
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_columns(response):
+    return response.decode(GradeRetrievalServer.MSG_ENCODING).split("\n")
+
+
+def parse_courses(response):
+    # The per course metrics, one line per course.
+    text = response.decode(GradeRetrievalServer.MSG_ENCODING)
+    if text.startswith("Error"):
+        raise GradeServerError(text)
+    return text
+
+
+def weights_args(weights):
+    # {column: weight} -> ["MT=40", "'Quiz 1'=5", ...]; None for the
+    # server's default weighting scheme.
+    return [shlex.quote(column) + f"={weight}" for column, weight in (weights or {}).items()]
+
+
+def final_grade_command(ID, password, weights=None):
+    hash = Gradebook.credentials_hash(ID, password)
+    return " ".join([GET_FINAL_GRADE_CMD, hash.hex(), *weights_args(weights)]).encode(GradeRetrievalServer.MSG_ENCODING)
+
+
+def distribution_command(weights=None):
+    return " ".join([GET_DISTRIBUTION_CMD, *weights_args(weights)]).encode(GradeRetrievalServer.MSG_ENCODING)
+
+
+def parse_final_grade(response):
+    # None for an incorrect ID/password, otherwise (weighted total,
+    # letter grade, rank).
+    if response == GradeRetrievalServer.INCORRECT_ID_PASSWORD_MSG:
+        return None
+    text = response.decode(GradeRetrievalServer.MSG_ENCODING)
+    match = re.fullmatch(r"Weighted total: ([\d.]+), letter grade (\S+), rank (\d+) of \d+", text)
+    if match is None:
+        raise GradeServerError(text)
+    return float(match[1]), match[2], int(match[3])
+
+
+def parse_distribution(response):
+    text = response.decode(GradeRetrievalServer.MSG_ENCODING)
+    if text.startswith("Error"):
+        raise GradeServerError(text)
+    return text
+
+
+def update_command(instructor_hash, student, column, grade):
+    # The student is an ID number.
+    return " ".join([UPDATE_GRADE_CMD, instructor_hash.hex(), shlex.quote(str(student)), shlex.quote(column),
+                     str(int(grade))]).encode(GradeRetrievalServer.MSG_ENCODING)
+
+
+def parse_update(response):
+    # (old grade, new grade), the old grade None if it was missing; an
+    # incorrect instructor ID/password or a rejected update raises
+    # GradeServerError.
+    text = response.decode(GradeRetrievalServer.MSG_ENCODING)
+    match = re.fullmatch(r".*: (-?\d+|-) -> (-?\d+)", text)
+    if match is None:
+        raise GradeServerError(text)
+    return None if match[1] == "-" else int(match[1]), int(match[2])
+
+
+def parse_grades(response):
+    # None for an incorrect ID/password, otherwise {header: grade}, with
+    # None for a missing grade.
+    if response == GradeRetrievalServer.INCORRECT_ID_PASSWORD_MSG:
+        return None
+    grades = {}
+    for line in response.decode(GradeRetrievalServer.MSG_ENCODING).splitlines():
+        header, _, value = line.rpartition(": ")
+        try:
+            grades[header] = None if value == "-" else int(value)
+        except ValueError:
+            raise GradeServerError(response.decode(GradeRetrievalServer.MSG_ENCODING)) from None
+    return grades
+
+
+def subscribe_command(columns=None):
+    return " ".join([SUBSCRIBE_CMD, *(shlex.quote(column) for column in columns or ())]) \
+        .encode(GradeRetrievalServer.MSG_ENCODING)
+
+
+def parse_notification(response):
+    # {header: average} for the columns in a SUB response or notification.
+    text = response.decode(GradeRetrievalServer.MSG_ENCODING)
+    if text.startswith("Error"):
+        raise GradeServerError(text)
+    averages = {}
+    for line in text.splitlines():
+        if line:
+            header, _, value = line.rpartition(": ")
+            averages[header] = float(value)
+    return averages
+
+
+def split_notifications(buffer):
+    # Remove the complete notifications, each ending with an empty line,
+    # from the front of an unframed connection's buffer. An error
+    # response has no empty line and is returned as it is.
+    if buffer.startswith(b"Error"):
+        notifications = [bytes(buffer)]
+        buffer.clear()
+        return notifications
+    *notifications, rest = bytes(buffer).split(b"\n\n")
+    buffer[:] = rest
+    return [notification + b"\n" for notification in notifications]
+
+
+def grades_request(ID, password):
+    return "grades", Gradebook.credentials_hash(ID, password)
+
+
+def course_prefix(course):
+    # "@<course> ", or nothing for the default course (None).
+    if course is None:
+        return b""
+    return f"{COURSE_PREFIX}{course} ".encode(GradeRetrievalServer.MSG_ENCODING)
+
+
+def is_clean(sock):
+    # True if the connection is open and no bytes are waiting on it.
+    # Unframed, waiting bytes would be the tail of a response that did
+    # not arrive in one piece, and would be taken for the response to
+    # the next request, so such a connection must not be reused.
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        # Returns the waiting byte, or nothing once the server has closed.
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def check_unframed_response(response):
+    # A response that fills the whole receive may have been cut short.
+    if len(response) >= UNFRAMED_RECV_SIZE:
+        raise GradeServerError(f"Response of {len(response)} or more bytes is too long for the unframed "
+                               f"protocol, use framed=True")
+    return response
+
+
+def course_requests(course, requests):
+    if course is None:
+        return requests
+    prefix = course_prefix(course)
+    return [(frame_type, prefix + payload) for frame_type, payload in requests]
+
+
+########################################################################
+# Blocking client
+########################################################################
+
+class GradeConnection:
+    def __init__(self, address, framed, timeout):
+        self.socket = socket.create_connection(address, timeout=timeout)
+        self.framed = framed
+        self.frame_buffer = bytearray()
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.socket.close()
+
+    def is_clean(self):
+        return not self.frame_buffer and is_clean(self.socket)
+
+    def exchange(self, requests):
+        # Send (frame type, payload) requests and return the response
+        # payloads in order. Unframed, one request is sent at a time.
+        if self.framed:
+            self.socket.sendall(b"".join(encode_frame(frame_type, payload) for frame_type, payload in requests))
+            responses = []
+            while len(responses) < len(requests):
+                responses += [payload for frame_type, payload in decode_frames(self.frame_buffer)
+                              if frame_type == FRAME_TYPE["response"]]
+                if len(responses) < len(requests):
+                    self.frame_buffer += self.receive(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE)
+        else:
+            responses = []
+            for frame_type, payload in requests:
+                self.socket.sendall(payload)
+                responses.append(check_unframed_response(self.receive(UNFRAMED_RECV_SIZE)))
+        self.last_used = time.monotonic()
+        return responses
+
+    def notifications(self, command):
+        # Send a SUB command and yield its response and then every
+        # notification, as they arrive.
+        self.socket.sendall(encode_frame("command", command) if self.framed else command)
+        while True:
+            if self.framed:
+                for frame_type, payload in decode_frames(self.frame_buffer):
+                    yield payload
+            else:
+                yield from split_notifications(self.frame_buffer)
+            self.frame_buffer += self.receive(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE)
+
+    def receive(self, size):
+        recvd_bytes = self.socket.recv(size)
+        if len(recvd_bytes) == 0:
+            raise ConnectionError("Server closed the connection")
+        return recvd_bytes
+
+
+class GradeClient:
+    POOL_SIZE = 4
+    TIMEOUT = 5.0
+    HEALTH_CHECK_INTERVAL = 30.0
+    RETRIES = 1
+
+    def __init__(self, host=GradeRetrievalClient.SERVER_HOSTNAME, port=GradeRetrievalServer.PORT,
+                 framed=False, pool_size=POOL_SIZE, timeout=TIMEOUT,
+                 health_check_interval=HEALTH_CHECK_INTERVAL, course=None):
+        self.address = (host, port)
+        self.framed = framed
+        self.course = course
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.idle_connections = collections.deque()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            while self.idle_connections:
+                self.idle_connections.pop().close()
+
+    def get_average(self, column):
+        return self.get_averages([column])[0]
+
+    def get_averages(self, columns):
+        return self.request([("command", average_command(column)) for column in columns], parse_average)
+
+    def get_aggregate(self, column, statistic, argument=None):
+        return self.request([("command", aggregate_command(column, statistic, argument))], parse_aggregate)[0]
+
+    def get_columns(self):
+        command = GET_COLUMNS_CMD.encode(GradeRetrievalServer.MSG_ENCODING)
+        return self.request([("command", command)], parse_columns)[0]
+
+    def get_courses(self):
+        command = GET_COURSES_CMD.encode(GradeRetrievalServer.MSG_ENCODING)
+        return self.request([("command", command)], parse_courses)[0]
+
+    def get_final_grade(self, ID, password, weights=None):
+        return self.request([("command", final_grade_command(ID, password, weights))], parse_final_grade)[0]
+
+    def get_distribution(self, weights=None):
+        return self.request([("command", distribution_command(weights))], parse_distribution)[0]
+
+    def get_grades(self, ID, password):
+        return self.get_grades_batch([(ID, password)])[0]
+
+    def update_grades(self, ID, password, updates):
+        # Instructor credentials and (student ID, column, grade) updates.
+        # Framed, the batch is pipelined and the server makes it durable
+        # with a single log sync.
+        instructor_hash = Gradebook.credentials_hash(ID, password)
+        return self.request([("command", update_command(instructor_hash, *update)) for update in updates],
+                            parse_update)
+
+    def get_grades_batch(self, credentials):
+        return self.request([grades_request(ID, password) for ID, password in credentials], parse_grades)
+
+    def subscribe(self, columns=None):
+        # Yield {header: average}, first for every column subscribed to
+        # (all of them by default) and then for the ones that change.
+        # The subscription has a connection of its own, without a
+        # timeout, which is closed with the generator.
+        connection = GradeConnection(self.address, self.framed, None)
+        try:
+            for notification in connection.notifications(course_prefix(self.course) + subscribe_command(columns)):
+                yield parse_notification(notification)
+        finally:
+            connection.close()
+
+    def request(self, requests, parse):
+        # Send the requests and return their responses parsed by parse.
+        # Requests are idempotent, so one that fails on a broken
+        # connection is retried on a fresh one. A connection goes back
+        # to the pool only if every response parsed and nothing is left
+        # unread on it; otherwise it is closed, so that what is left of
+        # a response can never reach another request.
+        requests = course_requests(self.course, requests)
+        for attempt in range(GradeClient.RETRIES + 1):
+            with self.slots:
+                connection = self.checkout()
+                try:
+                    results = [parse(response) for response in connection.exchange(requests)]
+                except OSError:
+                    connection.close()
+                    if attempt == GradeClient.RETRIES:
+                        raise
+                    continue
+                except BaseException:
+                    connection.close()
+                    raise
+                self.checkin(connection)
+                return results
+
+    def checkout(self):
+        # Reuse the most recently used connection. Framed connections
+        # that have been idle for a while, and unframed ones always, are
+        # checked before they are reused.
+        while True:
+            with self.lock:
+                if not self.idle_connections:
+                    break
+                connection = self.idle_connections.pop()
+            if (self.framed and time.monotonic() - connection.last_used < self.health_check_interval) \
+                    or connection.is_clean():
+                return connection
+            connection.close()
+        return GradeConnection(self.address, self.framed, self.timeout)
+
+    def checkin(self, connection):
+        if not connection.is_clean():
+            connection.close()
+            return
+        with self.lock:
+            self.idle_connections.append(connection)
+
+
+########################################################################
+# UDP client
+########################################################################
+
+class DatagramGradeClient:
+    # One request per datagram. A request whose response has not
+    # arrived within the timeout is sent again, with the timeout doubled
+    # each time; responses to earlier attempts or other requests are
+    # recognized by their request ID and dropped.
+    TIMEOUT = 0.25
+    RETRIES = 3
+
+    def __init__(self, host=GradeRetrievalClient.SERVER_HOSTNAME, port=GradeRetrievalServer.PORT,
+                 timeout=TIMEOUT, retries=RETRIES, course=None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Connected, so only the server's datagrams are received.
+        self.socket.connect((host, port))
+        self.timeout = timeout
+        self.retries = retries
+        self.course = course
+        self.request_ids = itertools.count(int.from_bytes(os.urandom(DATAGRAM_REQUEST_ID_LEN), "big"))
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.socket.close()
+
+    def get_average(self, column):
+        return parse_average(self.request(average_command(column)))
+
+    def get_averages(self, columns):
+        return [self.get_average(column) for column in columns]
+
+    def get_aggregate(self, column, statistic, argument=None):
+        return parse_aggregate(self.request(aggregate_command(column, statistic, argument)))
+
+    def get_columns(self):
+        return parse_columns(self.request(GET_COLUMNS_CMD.encode(GradeRetrievalServer.MSG_ENCODING)))
+
+    def get_distribution(self, weights=None):
+        return parse_distribution(self.request(distribution_command(weights)))
+
+    def request(self, command):
+        payload = course_prefix(self.course) + command
+        with self.lock:
+            request_id = (next(self.request_ids) % (1 << 8 * DATAGRAM_REQUEST_ID_LEN)) \
+                .to_bytes(DATAGRAM_REQUEST_ID_LEN, "big")
+            timeout = self.timeout
+            for attempt in range(self.retries + 1):
+                self.socket.sendall(request_id + payload)
+                response = self.receive(request_id, time.monotonic() + timeout)
+                if response is not None:
+                    return response
+                timeout *= 2
+        raise TimeoutError(f"No response after {self.retries + 1} attempts")
+
+    def receive(self, request_id, deadline):
+        # The response to request_id, or None once the deadline passes.
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.socket.settimeout(remaining)
+            try:
+                data = self.socket.recv(MAX_DATAGRAM_LEN)
+            except socket.timeout:
+                return None
+            except ConnectionRefusedError:
+                # An ICMP port unreachable for an earlier datagram: the
+                # server is not up (yet), so wait out the attempt.
+                time.sleep(remaining)
+                return None
+            if data[:DATAGRAM_REQUEST_ID_LEN] == request_id:
+                return data[DATAGRAM_REQUEST_ID_LEN:]
+
+
+########################################################################
+# asyncio client
+########################################################################
+
+class AsyncGradeConnection:
+    # A non-blocking socket driven by the event loop, rather than a
+    # stream, so that is_clean can see what is left unread on it.
+
+    def __init__(self, sock, framed):
+        self.socket = sock
+        self.framed = framed
+        self.frame_buffer = bytearray()
+        self.last_used = time.monotonic()
+
+    @classmethod
+    async def open(cls, address, framed, timeout):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, address), timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return cls(sock, framed)
+
+    def close(self):
+        self.socket.close()
+
+    def is_clean(self):
+        return not self.frame_buffer and is_clean(self.socket)
+
+    async def exchange(self, requests, timeout):
+        loop = asyncio.get_running_loop()
+        if self.framed:
+            await loop.sock_sendall(self.socket, b"".join(encode_frame(frame_type, payload)
+                                                          for frame_type, payload in requests))
+            responses = []
+            while len(responses) < len(requests):
+                responses += [payload for frame_type, payload in decode_frames(self.frame_buffer)
+                              if frame_type == FRAME_TYPE["response"]]
+                if len(responses) < len(requests):
+                    self.frame_buffer += await self.receive(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE, timeout)
+        else:
+            responses = []
+            for frame_type, payload in requests:
+                await loop.sock_sendall(self.socket, payload)
+                responses.append(check_unframed_response(await self.receive(UNFRAMED_RECV_SIZE, timeout)))
+        self.last_used = time.monotonic()
+        return responses
+
+    async def notifications(self, command):
+        await asyncio.get_running_loop().sock_sendall(
+            self.socket, encode_frame("command", command) if self.framed else command)
+        while True:
+            if self.framed:
+                for frame_type, payload in decode_frames(self.frame_buffer):
+                    yield payload
+            else:
+                for notification in split_notifications(self.frame_buffer):
+                    yield notification
+            self.frame_buffer += await self.receive(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE, None)
+
+    async def receive(self, size, timeout):
+        recvd_bytes = await asyncio.wait_for(asyncio.get_running_loop().sock_recv(self.socket, size), timeout)
+        if len(recvd_bytes) == 0:
+            raise ConnectionError("Server closed the connection")
+        return recvd_bytes
+
+
+class AsyncGradeClient:
+    # Same API as GradeClient, with coroutines. Unframed batches are
+    # spread over the pool's connections concurrently.
+
+    def __init__(self, host=GradeRetrievalClient.SERVER_HOSTNAME, port=GradeRetrievalServer.PORT,
+                 framed=False, pool_size=GradeClient.POOL_SIZE, timeout=GradeClient.TIMEOUT,
+                 health_check_interval=GradeClient.HEALTH_CHECK_INTERVAL, course=None):
+        self.address = (host, port)
+        self.framed = framed
+        self.course = course
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.idle_connections = collections.deque()
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        while self.idle_connections:
+            self.idle_connections.pop().close()
+
+    async def get_average(self, column):
+        return (await self.get_averages([column]))[0]
+
+    async def get_averages(self, columns):
+        return await self.request_batch([("command", average_command(column)) for column in columns], parse_average)
+
+    async def get_aggregate(self, column, statistic, argument=None):
+        return (await self.request([("command", aggregate_command(column, statistic, argument))],
+                                   parse_aggregate))[0]
+
+    async def get_columns(self):
+        command = GET_COLUMNS_CMD.encode(GradeRetrievalServer.MSG_ENCODING)
+        return (await self.request([("command", command)], parse_columns))[0]
+
+    async def get_courses(self):
+        command = GET_COURSES_CMD.encode(GradeRetrievalServer.MSG_ENCODING)
+        return (await self.request([("command", command)], parse_courses))[0]
+
+    async def get_final_grade(self, ID, password, weights=None):
+        return (await self.request([("command", final_grade_command(ID, password, weights))], parse_final_grade))[0]
+
+    async def get_distribution(self, weights=None):
+        return (await self.request([("command", distribution_command(weights))], parse_distribution))[0]
+
+    async def get_grades(self, ID, password):
+        return (await self.get_grades_batch([(ID, password)]))[0]
+
+    async def update_grades(self, ID, password, updates):
+        # Sent over one connection, so updates of the same grade are
+        # applied in order.
+        instructor_hash = Gradebook.credentials_hash(ID, password)
+        return await self.request([("command", update_command(instructor_hash, *update)) for update in updates],
+                                  parse_update)
+
+    async def get_grades_batch(self, credentials):
+        return await self.request_batch([grades_request(ID, password) for ID, password in credentials], parse_grades)
+
+    async def subscribe(self, columns=None):
+        connection = await AsyncGradeConnection.open(self.address, self.framed, self.timeout)
+        try:
+            async for notification in connection.notifications(course_prefix(self.course)
+                                                               + subscribe_command(columns)):
+                yield parse_notification(notification)
+        finally:
+            connection.close()
+
+    async def request_batch(self, requests, parse):
+        if self.framed or len(requests) <= 1:
+            return await self.request(requests, parse)
+        # Deal the requests out round robin, one share per connection.
+        shares = [requests[i::self.pool_size] for i in range(min(self.pool_size, len(requests)))]
+        results = await asyncio.gather(*(self.request(share, parse) for share in shares))
+        responses = [None] * len(requests)
+        for i, share_responses in enumerate(results):
+            responses[i::self.pool_size] = share_responses
+        return responses
+
+    async def request(self, requests, parse):
+        # As GradeClient.request: only a connection with nothing left
+        # unread goes back to the pool.
+        requests = course_requests(self.course, requests)
+        for attempt in range(GradeClient.RETRIES + 1):
+            async with self.slots:
+                connection = await self.checkout()
+                try:
+                    results = [parse(response) for response in await connection.exchange(requests, self.timeout)]
+                except (OSError, asyncio.TimeoutError):
+                    connection.close()
+                    if attempt == GradeClient.RETRIES:
+                        raise
+                    continue
+                except BaseException:
+                    connection.close()
+                    raise
+                if connection.is_clean():
+                    self.idle_connections.append(connection)
+                else:
+                    connection.close()
+                return results
+
+    async def checkout(self):
+        while self.idle_connections:
+            connection = self.idle_connections.pop()
+            if (self.framed and time.monotonic() - connection.last_used < self.health_check_interval) \
+                    or connection.is_clean():
+                return connection
+            connection.close()
+        return await AsyncGradeConnection.open(self.address, self.framed, self.timeout)
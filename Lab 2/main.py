@@ -5,13 +5,41 @@
 """
 
 import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
 import csv
+import functools
 import getpass
 import hashlib
+import itertools
+import math
+import mmap
+import operator
+import os
+import shlex
+import signal
 import socket
+import sqlite3
+import struct
 import sys
+import threading
+import time
+import zlib
 from os import path
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 
 GET_MIDTERM_AVG_CMD = "GMA"
 GET_LAB_1_AVG_CMD = "GL1A"
@@ -20,6 +48,34 @@ GET_LAB_3_AVG_CMD = "GL3A"
 GET_LAB_4_AVG_CMD = "GL4A"
 GET_GRADES = "GG"
 
+GET_MEDIAN_CMD = "MED"
+GET_STD_DEV_CMD = "STD"
+GET_PERCENTILE_CMD = "PCT"
+GET_MIN_CMD = "MIN"
+GET_MAX_CMD = "MAX"
+GET_HISTOGRAM_CMD = "HIST"
+GET_CACHE_STATS_CMD = "CACHE"
+GET_MEMORY_CMD = "MEM"
+
+GET_RANK_CMD = "RANK"
+GET_TOP_CMD = "TOP"
+GET_RANGE_CMD = "RANGE"
+
+GET_AGGREGATE_CMD = "AGG"
+GET_COLUMNS_CMD = "COLS"
+
+GET_FINAL_GRADE_CMD = "FINAL"
+GET_DISTRIBUTION_CMD = "DIST"
+
+UPDATE_GRADE_CMD = "UPDATE"
+
+SUBSCRIBE_CMD = "SUB"
+
+GET_COURSES_CMD = "COURSES"
+# With --courses, a request for a course other than the default one is
+# prefixed with "@<course> ", e.g. "@ece4dn4 GMA".
+COURSE_PREFIX = "@"
+
 ID_HEADER = "ID Number"
 PW_HEADER = "Password"
 
@@ -31,16 +87,1800 @@ L2_HEADER = "Lab 2"
 L3_HEADER = "Lab 3"
 L4_HEADER = "Lab 4"
 
+GRADE_HEADERS = (MT_HEADER, L1_HEADER, L2_HEADER, L3_HEADER, L4_HEADER)
+IDENTITY_HEADERS = (ID_HEADER, PW_HEADER, LN_HEADER, FN_HEADER)
+
+# A blank grade cell is a missing grade: None in records and responses,
+# NULL in the SQLite store and this value in the 16 bit grade arrays
+# and snapshots. Missing grades are left out of a column's statistics
+# and count as 0 in weighted totals.
+MISSING_GRADE = -(1 << 15)
+
+# Lowest weighted total for each letter grade, highest first.
+LETTER_GRADES = (
+    (90, "A+"), (85, "A"), (80, "A-"),
+    (77, "B+"), (73, "B"), (70, "B-"),
+    (67, "C+"), (63, "C"), (60, "C-"),
+    (57, "D+"), (53, "D"), (50, "D-"),
+    (0, "F"),
+)
+
+# Short column names used as the argument of the statistics commands,
+# e.g. "MED MT" or "PCT L2 90".
+COLUMN_CODES = {
+    "MT": MT_HEADER,
+    "L1": L1_HEADER,
+    "L2": L2_HEADER,
+    "L3": L3_HEADER,
+    "L4": L4_HEADER,
+}
+
+# Framed protocol (--framed). Every request and response is sent as
+#
+# ----------------------------------------------------------
+# | 4 byte payload length | 1 byte frame type | payload ... |
+# ----------------------------------------------------------
+#
+# A command frame carries a command such as "GMA" or "PCT L2 90", a
+# grades frame carries the 32 byte ID/password hash of a GG request.
+# A client may send any number of request frames without waiting; the
+# server answers each with one response frame, in order. Notification
+# frames are pushed to subscribed connections (SUB) between responses.
+FRAME_LENGTH_FIELD_LEN = 4
+FRAME_TYPE_FIELD_LEN = 1
+FRAME_HEADER_LEN = FRAME_LENGTH_FIELD_LEN + FRAME_TYPE_FIELD_LEN
+MAX_FRAME_PAYLOAD_LEN = 65536
+
+FRAME_TYPE = {
+    "command": 1,
+    "grades": 2,
+    "response": 3,
+    "notification": 4,
+}
+
+# UDP queries (--udp), on the server's port number. A request datagram
+# is a 4 byte request ID chosen by the client followed by a public
+# statistics command, e.g. "GMA", "AGG L2 pct 90" or "@ece4dn4 MED MT".
+# The response datagram starts with the same request ID, so a client
+# that retries can tell a late response from the current one. A course
+# is only answered over UDP once a TCP request has loaded it.
+#
+# -----------------------------------
+# | 4 byte request ID | payload ... |
+# -----------------------------------
+DATAGRAM_REQUEST_ID_LEN = 4
+MAX_DATAGRAM_LEN = 65507
+
+
+def encode_frame(frame_type, payload):
+    return len(payload).to_bytes(FRAME_LENGTH_FIELD_LEN, byteorder='big') \
+        + FRAME_TYPE[frame_type].to_bytes(FRAME_TYPE_FIELD_LEN, byteorder='big') \
+        + payload
+
+
+def decode_frames(buffer):
+    # Remove every complete frame from the front of buffer (a bytearray)
+    # and return them as (frame type, payload) tuples. A trailing partial
+    # frame is left in buffer until more bytes arrive.
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_HEADER_LEN:
+        payload_len = int.from_bytes(buffer[offset:offset + FRAME_LENGTH_FIELD_LEN], byteorder='big')
+        if payload_len > MAX_FRAME_PAYLOAD_LEN:
+            raise ValueError(f"Frame payload of {payload_len} bytes is too large")
+        frame_end = offset + FRAME_HEADER_LEN + payload_len
+        if len(buffer) < frame_end:
+            break
+        frame_type = buffer[offset + FRAME_LENGTH_FIELD_LEN]
+        frames.append((frame_type, bytes(buffer[offset + FRAME_HEADER_LEN:frame_end])))
+        offset = frame_end
+    del buffer[:offset]
+    return frames
+
+
+def read_grade_columns(filename):
+    with open(filename, newline="") as csvfile:
+        reader = csv.reader(csvfile)
+        return grade_columns(next(reader, []), reader)
+
+
+def grade_columns(fieldnames, rows=()):
+    # The numeric columns of a CSV file, in file order: every column
+    # other than the student's ID, password and names whose values are
+    # all integers or blank. rows are lists of fields, as read by
+    # csv.reader.
+    candidates = [i for i, header in enumerate(fieldnames) if header not in IDENTITY_HEADERS]
+    for row in rows:
+        # Rows of non-negative grades are checked in one go.
+        if "".join(row[i] for i in candidates if i < len(row)).isdigit():
+            continue
+        for i in list(candidates):
+            try:
+                parse_grade(row[i] if i < len(row) else None)
+            except ValueError:
+                candidates.remove(i)
+    return tuple(fieldnames[i] for i in candidates)
+
+
+def parse_csv_rows(fieldnames, rows):
+    # Compact records (hash, ID number, last name, first name, grades)
+    # for rows of lists of fields, as read by csv.reader, with the
+    # grades of every column other than the student's ID, password and
+    # names. Also returns the positions among those grades of the
+    # columns that hold a value which is not a grade; that value is
+    # kept as None. A row too short for one of the identity fields,
+    # e.g. a truncated line, raises ValueError.
+    if not fieldnames:
+        return [], set()
+    for header in IDENTITY_HEADERS:
+        if header not in fieldnames:
+            raise ValueError(f"the CSV header has no {header} column")
+    identity = [fieldnames.index(header) for header in IDENTITY_HEADERS]
+    identity_len = max(identity) + 1
+    id_field, pw_field, ln_field, fn_field = identity
+    candidates = [i for i, header in enumerate(fieldnames) if header not in IDENTITY_HEADERS]
+    get_cells = operator.itemgetter(*candidates) if len(candidates) > 1 else \
+        lambda row: tuple(row[i] for i in candidates)
+    records = []
+    non_grades = set()
+    for row in rows:
+        if not row:
+            continue
+        if len(row) < identity_len:
+            missing = [header for header, field in zip(IDENTITY_HEADERS, identity) if field >= len(row)]
+            id_number = row[id_field] if id_field < len(row) else "(no ID)"
+            raise ValueError(f"the CSV row of student {id_number} has no {missing[0]} field")
+        if len(row) < len(fieldnames):
+            row = row + [""] * (len(fieldnames) - len(row))
+        cells = get_cells(row)
+        # Rows of non-negative grades are converted in one go.
+        if all(cells) and "".join(cells).isdecimal():
+            grades = tuple(map(int, cells))
+        else:
+            grades = []
+            for position, cell in enumerate(cells):
+                try:
+                    grades.append(parse_grade(cell))
+                except ValueError:
+                    non_grades.add(position)
+                    grades.append(None)
+            grades = tuple(grades)
+        records.append((Gradebook.credentials_hash(row[id_field], row[pw_field]),
+                        row[id_field], row[ln_field], row[fn_field], grades))
+    return records, non_grades
+
+
+def select_grades(records, positions):
+    # records with only the grades at positions, in that order.
+    get_grades = operator.itemgetter(*positions) if len(positions) > 1 else \
+        lambda grades: tuple(grades[position] for position in positions)
+    for hash, id_number, last_name, first_name, grades in records:
+        yield hash, id_number, last_name, first_name, get_grades(grades)
+
+
+def parse_grade(value):
+    # A grade cell's value, None if it is blank (or absent from a short
+    # row).
+    if value is None or not value.strip():
+        return None
+    return int(value)
+
+
+def format_grade(grade):
+    return "-" if grade is None else str(grade)
+
+
+def letter_grade(total):
+    for cutoff, letter in LETTER_GRADES:
+        if total >= cutoff:
+            return letter
+    return LETTER_GRADES[-1][1]
+
+
+def grade_matrix(rows, column_count):
+    # Students x columns numpy array of grade rows, viewing the rows in
+    # place when they are all packed bytes. Missing grades become
+    # MISSING_GRADE.
+    if all(type(row) is bytes for row in rows):
+        return np.frombuffer(b"".join(rows), dtype=np.uint8).reshape(len(rows), column_count)
+    return np.array([list(row) if type(row) is bytes or None not in row else
+                     [MISSING_GRADE if grade is None else grade for grade in row]
+                     for row in rows], dtype=np.int64).reshape(len(rows), column_count)
+
+
+def present_grades(array, axis):
+    # The number of grades that are not MISSING_GRADE along axis of a
+    # grade array, and the array with the missing grades set to 0.
+    if array.dtype == np.uint8:
+        # Packed byte grades are never missing.
+        return np.full(array.shape[1 - axis], array.shape[axis]), array
+    present = array != MISSING_GRADE
+    return present.sum(axis=axis), np.where(present, array, 0)
+
+
+def raise_open_file_limit():
+    # Every open connection holds a file descriptor, so lift the soft
+    # limit up to the hard limit on platforms that have one.
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+def csv_chunk_ranges(filename, chunk_size):
+    # Split the data lines of a CSV file into byte ranges of roughly
+    # chunk_size bytes that begin and end on line boundaries. Assumes no
+    # quoted field contains a newline, which holds for grades files.
+    with open(filename, "rb") as csvfile:
+        header = csvfile.readline()
+        file_size = os.fstat(csvfile.fileno()).st_size
+        start = csvfile.tell()
+        ranges = []
+        while start < file_size:
+            csvfile.seek(min(start + chunk_size, file_size))
+            csvfile.readline()
+            ranges.append((start, csvfile.tell()))
+            start = csvfile.tell()
+    return header.decode("utf-8-sig"), ranges
+
+
+def hash_csv_chunk(filename, fieldnames, start, end):
+    # Process pool worker for Gradebook.from_csv: parse one byte range
+    # of the CSV file into compact records, so that neither the
+    # passwords nor the rest of the raw rows go back to the parent.
+    with open(filename, "rb") as csvfile:
+        csvfile.seek(start)
+        lines = csvfile.read(end - start).decode("utf-8").splitlines()
+    return parse_csv_rows(fieldnames, csv.reader(lines))
+
+
+class ColumnAggregate:
+    # Running count, sum and sum of squares for one grade column. These
+    # are updated as records come and go so that the statistics can be
+    # answered without rescanning the data.
+
+    def __init__(self, count=0, total=0, total_sq=0):
+        self.count = count
+        self.total = total
+        self.total_sq = total_sq
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_sq += value * value
+
+    def remove(self, value):
+        self.count -= 1
+        self.total -= value
+        self.total_sq -= value * value
+
+    def replace(self, old_value, new_value):
+        if old_value is None:
+            self.add(new_value)
+            return
+        self.total += new_value - old_value
+        self.total_sq += new_value * new_value - old_value * old_value
+
+    def mean(self):
+        if self.count == 0:
+            raise ValueError("no grades loaded")
+        return self.total / self.count
+
+    def variance(self):
+        mean = self.mean()
+        return self.total_sq / self.count - mean * mean
+
+
+class LRUCache(collections.OrderedDict):
+    # Dict that holds at most maxsize entries, evicting the least
+    # recently used one. get() and assignment count as uses.
+
+    def __init__(self, maxsize):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+class GradeRecord:
+    # One student as kept by Gradebook. The plaintext password is not
+    # stored and the names are interned. The grades, in the gradebook's
+    # column order, are packed into bytes when they all fit in 0..255
+    # (indexing bytes gives ints) and kept as a tuple otherwise, as is a
+    # record with a missing (None) grade. Numeric
+    # ID numbers are stored as ints.
+
+    __slots__ = ("id_number", "last_name", "first_name", "grades")
+
+    def __init__(self, id_number, last_name, first_name, grades):
+        self.id_number = int(id_number) if id_number.isdigit() and str(int(id_number)) == id_number \
+            else id_number
+        self.last_name = sys.intern(last_name)
+        self.first_name = sys.intern(first_name)
+        self.grades = GradeRecord.pack_grades(grades)
+
+    @staticmethod
+    def pack_grades(grades):
+        if all(grade is not None and 0 <= grade <= 255 for grade in grades):
+            return bytes(grades)
+        return tuple(grades)
+
+    def memory_usage(self):
+        # The names are interned and shared, so they are not counted.
+        return sys.getsizeof(self) + sys.getsizeof(self.id_number) + sys.getsizeof(self.grades)
+
+
+class Gradebook:
+    # Student records keyed by the SHA-256 hash of ID number + password,
+    # together with one ColumnAggregate per grade column. The grade
+    # fields are converted to int once, when the record is added; blank
+    # ones are missing (None) and are not in the column's aggregate or
+    # sorted index.
+
+    DEFAULT_HISTOGRAM_BINS = 10
+    # HIST needs no credential, so the bin count is capped like the
+    # length of TOP and RANGE listings.
+    MAX_HISTOGRAM_BINS = 100
+    INGEST_CHUNK_SIZE = 1 << 20
+    INGEST_BATCH_ROWS = 10_000
+    # Files smaller than this are read without a process pool.
+    PARALLEL_INGEST_MIN_SIZE = 8 * INGEST_CHUNK_SIZE
+    # Weighting schemes whose totals are kept. The weights come from
+    # clients, and each scheme's totals take memory per student.
+    WEIGHTED_TOTALS_CACHE_SIZE = 4
+    # Weighted totals are rounded so that floating point noise does not
+    # push a total such as 90 just below a letter grade cutoff.
+    TOTAL_DECIMALS = 6
+
+    def __init__(self, columns=GRADE_HEADERS):
+        self.data = {}
+        self.columns = tuple(columns)
+        self.aggregates = {header: ColumnAggregate() for header in self.columns}
+        # Per column sorted indexes, used by the order statistics and the
+        # ranking commands, and the server's encoded GG/AVG responses.
+        # Both are dropped whenever the data changes.
+        self.sorted_indexes = {}
+        self.responses = {}
+        # Held while a sorted index is built and while a grade update
+        # changes the data and patches the index, so that the background
+        # index builder never stores an index that misses an update.
+        self.index_lock = threading.RLock()
+        # Whole-class weighted totals of the most recently used weighting
+        # schemes, also dropped when the data changes.
+        self.weighted_totals_cache = LRUCache(Gradebook.WEIGHTED_TOTALS_CACHE_SIZE)
+        # ID number -> hash, built on first use by find_student.
+        self.id_index = None
+
+    def __contains__(self, hash):
+        return hash in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def from_csv(cls, filename, print_rows=False, workers=1):
+        # The grade columns are discovered from the header and the rows,
+        # so a sheet may have any number of them. With more than one
+        # worker a large file is split into chunks that are parsed and
+        # hashed by a process pool, and the records are then added here
+        # in file order.
+        columns, records = Gradebook.read_csv_records(filename, print_rows, workers)
+        gradebook = cls(columns)
+        gradebook.add_records(records)
+        return gradebook
+
+    @staticmethod
+    def read_csv_records(filename, print_rows=False, workers=1):
+        # The grade columns of the CSV file and its compact records,
+        # found in a single pass: a column is dropped once all the rows
+        # have been read if one of them holds a value that is not a
+        # grade.
+        candidates, batches = Gradebook.read_csv_batches(filename, workers)
+        records = []
+        non_grades = set()
+        for batch, batch_non_grades in batches:
+            records.extend(batch)
+            non_grades |= batch_non_grades
+        columns = candidates
+        if non_grades:
+            positions = [i for i in range(len(candidates)) if i not in non_grades]
+            columns = tuple(candidates[i] for i in positions)
+            records = list(select_grades(records, positions))
+        if print_rows:
+            records = Gradebook.echo_records(records)
+        return columns, records
+
+    @staticmethod
+    def read_csv_batches(filename, workers=1):
+        # The candidate grade columns of the CSV file, every column
+        # other than the identity ones, and an iterator over batches of
+        # (compact records, non-grade positions) from parse_csv_rows.
+        with open(filename, newline="") as csvfile:
+            fieldnames = next(csv.reader(csvfile), [])
+        candidates = tuple(header for header in fieldnames if header not in IDENTITY_HEADERS)
+        return candidates, Gradebook.parse_csv_batches(filename, workers)
+
+    @staticmethod
+    def echo_records(records):
+        print("Data read from CSV file:")
+        for record in records:
+            hash, id_number, last_name, first_name, grades = record
+            print("  " + ",".join((id_number, last_name, first_name, *map(format_grade, grades))))
+            yield record
+
+    @staticmethod
+    def parse_csv_batches(filename, workers=1):
+        # Starting a process pool and sending the records back costs
+        # more than parsing a small file, and on a single CPU the
+        # workers only take turns.
+        workers = min(workers, os.cpu_count() or 1)
+        if workers <= 1 or os.path.getsize(filename) < Gradebook.PARALLEL_INGEST_MIN_SIZE:
+            with open(filename, newline="") as csvfile:
+                reader = csv.reader(csvfile)
+                fieldnames = next(reader, [])
+                while True:
+                    rows = list(itertools.islice(reader, Gradebook.INGEST_BATCH_ROWS))
+                    if not rows:
+                        break
+                    yield parse_csv_rows(fieldnames, rows)
+            return
+
+        header, ranges = csv_chunk_ranges(filename, Gradebook.INGEST_CHUNK_SIZE)
+        fieldnames = next(csv.reader([header]))
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            starts = [start for start, _ in ranges]
+            ends = [end for _, end in ranges]
+            yield from pool.map(functools.partial(hash_csv_chunk, filename, fieldnames), starts, ends)
+
+    @staticmethod
+    def credentials_hash(ID, password):
+        m = hashlib.sha256()
+        m.update(ID.encode("utf-8"))
+        m.update(password.encode("utf-8"))
+        return m.digest()
+
+    def add_record(self, row, hash=None):
+        if hash is None:
+            hash = Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER])
+        if hash in self.data:
+            self.remove_record(hash)
+
+        grades = tuple(parse_grade(row[header]) for header in self.columns)
+        for grade, aggregate in zip(grades, self.aggregates.values()):
+            if grade is not None:
+                aggregate.add(grade)
+
+        self.data[hash] = GradeRecord(row[ID_HEADER], row[LN_HEADER], row[FN_HEADER], grades)
+        if self.id_index is not None:
+            self.id_index[row[ID_HEADER]] = hash
+        self.data_changed()
+        return hash
+
+    def add_records(self, records):
+        # Bulk load of compact records from parse_csv_rows, with the
+        # grades in column order. The records are stored first and the
+        # aggregates of every column are then computed in one pass over
+        # all of them, rather than per record and column.
+        for hash, id_number, last_name, first_name, grades in records:
+            self.data[hash] = GradeRecord(id_number, last_name, first_name, grades)
+        self.id_index = None
+        self.compute_aggregates()
+        self.data_changed()
+
+    def compute_aggregates(self):
+        grades = [record.grades for record in self.data.values()]
+        if np is not None:
+            # Reduce every column of the count x columns array at once.
+            counts, array = present_grades(grade_matrix(grades, len(self.columns)), 0)
+            self.set_aggregates(counts, array.sum(axis=0, dtype=np.int64),
+                                np.einsum("ij,ij->j", array, array, dtype=np.int64))
+            return
+        columns = [[grade for grade in column if grade is not None] for column in zip(*grades)] \
+            or [()] * len(self.columns)
+        self.set_aggregates([len(column) for column in columns], [sum(column) for column in columns],
+                            [sum(map(operator.mul, column, column)) for column in columns])
+
+    def set_aggregates(self, counts, totals, totals_sq):
+        # Per column grade counts, sums and sums of squares.
+        self.aggregates = {header: ColumnAggregate(int(count), int(total), int(total_sq))
+                           for header, count, total, total_sq in zip(self.columns, counts, totals, totals_sq)}
+
+    def check_update(self, hash, grade_header, value):
+        # Raises ValueError or TypeError if update_grade would refuse the
+        # update, so that it can be refused before it is logged.
+        if hash not in self:
+            raise ValueError("unknown student")
+        if grade_header not in self.aggregates:
+            raise ValueError(f"unknown column {grade_header}")
+        int(value)
+
+    def update_grade(self, hash, grade_header, value):
+        with self.index_lock:
+            record = self.data[hash]
+            i = self.columns.index(grade_header)
+            value = int(value)
+            old_value = record.grades[i]
+            self.aggregates[grade_header].replace(old_value, value)
+            grades = list(record.grades)
+            grades[i] = value
+            record.grades = GradeRecord.pack_grades(grades)
+            self.grade_changed(hash, grade_header, old_value, value)
+
+    def remove_record(self, hash):
+        record = self.data.pop(hash)
+        for grade, aggregate in zip(record.grades, self.aggregates.values()):
+            if grade is not None:
+                aggregate.remove(grade)
+        if self.id_index is not None:
+            self.id_index.pop(str(record.id_number), None)
+        self.data_changed()
+        return dict(zip(self.columns, record.grades))
+
+    def data_changed(self):
+        with self.index_lock:
+            self.sorted_indexes.clear()
+        self.responses.clear()
+        self.weighted_totals_cache.clear()
+
+    def grade_changed(self, key, grade_header, old_value, new_value):
+        # A single grade changed: move the record within the column's
+        # sorted index, if there is one, rather than dropping every
+        # index. The cached responses and totals are dropped.
+        with self.index_lock:
+            index = self.sorted_indexes.get(grade_header)
+            if index is not None:
+                values, keys = index
+                if old_value is not None:
+                    position = keys.index(key, bisect.bisect_left(values, old_value),
+                                          bisect.bisect_right(values, old_value))
+                    del values[position], keys[position]
+                position = bisect.bisect_right(values, new_value)
+                values.insert(position, new_value)
+                keys.insert(position, key)
+        self.responses.clear()
+        self.weighted_totals_cache.clear()
+
+    def find_student(self, id_number):
+        # Hash of the student with this ID number, None if there is none.
+        if self.id_index is None:
+            self.id_index = {str(record.id_number): hash for hash, record in self.data.items()}
+        return self.id_index.get(id_number)
+
+    def grades(self, hash):
+        return dict(zip(self.columns, self.data[hash].grades))
+
+    def grade_rows(self):
+        # The hash and the grades, in column order, of every student.
+        return list(self.data), [record.grades for record in self.data.values()]
+
+    def weighted_totals(self, weights):
+        # Weighted total of every student for weights, a tuple of (grade
+        # header, weight) pairs: a dict of hash -> total and the totals
+        # in ascending order. The whole class is computed in one batch
+        # and kept until the data changes.
+        result = self.weighted_totals_cache.get(weights)
+        if result is None:
+            hashes, rows = self.grade_rows()
+            positions = [self.columns.index(grade_header) for grade_header, _ in weights]
+            factors = [weight / sum(weight for _, weight in weights) for _, weight in weights]
+            if np is not None:
+                if not isinstance(rows, np.ndarray):
+                    rows = grade_matrix(rows, len(self.columns))
+                _, rows = present_grades(rows[:, positions], 0)
+                totals = np.round(rows @ np.array(factors), Gradebook.TOTAL_DECIMALS).tolist()
+            else:
+                totals = [round(sum((row[i] or 0) * factor for i, factor in zip(positions, factors)),
+                                Gradebook.TOTAL_DECIMALS)
+                          for row in rows]
+            result = (dict(zip(hashes, totals)), sorted(totals))
+            self.weighted_totals_cache[weights] = result
+        return result
+
+    def weighted_total(self, hash, weights):
+        # A student's weighted total and competition rank (1 is the
+        # highest total) within the class.
+        totals, sorted_totals = self.weighted_totals(weights)
+        total = totals[hash]
+        return total, len(sorted_totals) - bisect.bisect_right(sorted_totals, total) + 1
+
+    def weighted_summary(self, weights):
+        # Mean and median of the class's weighted totals.
+        _, sorted_totals = self.weighted_totals(weights)
+        count = len(sorted_totals)
+        return sum(sorted_totals) / count, (sorted_totals[(count - 1) // 2] + sorted_totals[count // 2]) / 2
+
+    def grade_distribution(self, weights):
+        # Number of students with each letter grade, highest first.
+        _, sorted_totals = self.weighted_totals(weights)
+        distribution = []
+        upper = len(sorted_totals)
+        for cutoff, letter in LETTER_GRADES:
+            lower = bisect.bisect_left(sorted_totals, cutoff)
+            distribution.append((letter, upper - lower))
+            upper = lower
+        return distribution
+
+    def memory_usage(self):
+        # Approximate bytes held by the records and the hash index.
+        return sys.getsizeof(self.data) + sum(sys.getsizeof(hash) + record.memory_usage()
+                                              for hash, record in self.data.items())
+
+    def cache_memory_usage(self):
+        # Approximate bytes held by the sorted indexes, the response cache
+        # and the weighted totals, which are built after the load and
+        # are not counted by memory_usage. The grades and keys in an
+        # index are shared with the records; the totals are floats.
+        indexes = sum(part.nbytes if hasattr(part, "nbytes") else sys.getsizeof(part)
+                      for index in list(self.sorted_indexes.values()) for part in index)
+        responses = sum(sys.getsizeof(key) + sys.getsizeof(response) for key, response in list(self.responses.items()))
+        totals = sum(sys.getsizeof(part) + (len(part) * sys.getsizeof(0.0) if isinstance(part, dict) else 0)
+                     for value in list(self.weighted_totals_cache.values()) for part in value)
+        return indexes + responses + totals
+
+    def average(self, grade_header):
+        return self.aggregates[grade_header].mean()
+
+    def std_dev(self, grade_header):
+        return math.sqrt(self.aggregates[grade_header].variance())
+
+    def build_indexes(self):
+        for grade_header in self.aggregates:
+            self.sorted_index(grade_header)
+
+    def sorted_index(self, grade_header):
+        # The column's grades in ascending order and, in the same order,
+        # the key of the record each grade belongs to. Missing grades are
+        # left out.
+        with self.index_lock:
+            if grade_header not in self.sorted_indexes:
+                i = self.columns.index(grade_header)
+                keys = sorted((hash for hash, record in self.data.items() if record.grades[i] is not None),
+                              key=lambda hash: self.data[hash].grades[i])
+                self.sorted_indexes[grade_header] = ([self.data[hash].grades[i] for hash in keys], keys)
+            return self.sorted_indexes[grade_header]
+
+    def sorted_column(self, grade_header):
+        return self.sorted_index(grade_header)[0]
+
+    def search_sorted(self, grade_header, value, right=False):
+        # Position of value in the sorted column, before any equal grades
+        # or, if right is set, after them.
+        if right:
+            return bisect.bisect_right(self.sorted_column(grade_header), value)
+        return bisect.bisect_left(self.sorted_column(grade_header), value)
+
+    def rank(self, hash, grade_header):
+        # Competition rank (1 is the highest grade, equal grades share a
+        # rank) and percentile rank (percentage of students below the
+        # grade, counting equal grades as half).
+        grade = self.grades(hash)[grade_header]
+        if grade is None:
+            raise ValueError(f"no {grade_header} grade")
+        count = self.graded(grade_header)
+        below = self.search_sorted(grade_header, grade)
+        not_above = self.search_sorted(grade_header, grade, right=True)
+        return count - not_above + 1, (below + not_above) / 2 / count * 100
+
+    def graded(self, grade_header):
+        # The number of students with a grade in the column.
+        return self.aggregates[grade_header].count
+
+    def ranked_students(self, grade_header, start, end, limit=None):
+        # (rank, grade) for the sorted index positions in [start, end),
+        # highest grade first and at most limit of them. Who holds each
+        # grade is never listed: TOP and RANGE need no credential.
+        values = self.sorted_column(grade_header)
+        if limit is not None:
+            start = max(start, end - limit)
+        students = []
+        for position in range(end - 1, start - 1, -1):
+            grade = int(values[position])
+            rank = self.graded(grade_header) - self.search_sorted(grade_header, grade, right=True) + 1
+            students.append((rank, grade))
+        return students
+
+    def top_positions(self, grade_header, count):
+        # Sorted index positions of the count highest grades.
+        if count < 1:
+            raise ValueError("count must be positive")
+        return max(self.graded(grade_header) - count, 0), self.graded(grade_header)
+
+    def range_positions(self, grade_header, low, high):
+        # Sorted index positions of the grades between low and high,
+        # inclusive.
+        return self.search_sorted(grade_header, low), \
+            max(self.search_sorted(grade_header, high, right=True), self.search_sorted(grade_header, low))
+
+    def percentile(self, grade_header, percent):
+        # Linear interpolation between the closest ranks, as done by
+        # numpy.percentile.
+        if not 0 <= percent <= 100:
+            raise ValueError("percentile must be between 0 and 100")
+        values = self.graded_column(grade_header)
+        position = (len(values) - 1) * percent / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return float(values[lower] + (values[upper] - values[lower]) * (position - lower))
+
+    def median(self, grade_header):
+        return self.percentile(grade_header, 50)
+
+    def minimum(self, grade_header):
+        return int(self.graded_column(grade_header)[0])
+
+    def maximum(self, grade_header):
+        return int(self.graded_column(grade_header)[-1])
+
+    def graded_column(self, grade_header):
+        # The sorted column, for the statistics that need a grade.
+        values = self.sorted_column(grade_header)
+        if not len(values):
+            raise ValueError(f"no {grade_header} grades")
+        return values
+
+    def histogram_edges(self, grade_header, bins):
+        if not 1 <= bins <= Gradebook.MAX_HISTOGRAM_BINS:
+            raise ValueError(f"number of bins must be between 1 and {Gradebook.MAX_HISTOGRAM_BINS}")
+        low = self.minimum(grade_header)
+        high = self.maximum(grade_header)
+        if low == high:
+            high = low + 1
+        width = (high - low) / bins
+        return [low + i * width for i in range(bins)] + [high]
+
+    def histogram(self, grade_header, bins=DEFAULT_HISTOGRAM_BINS):
+        # Equal width bins between the minimum and maximum grade. Every
+        # bin is half open except the last, which includes the maximum.
+        edges = self.histogram_edges(grade_header, bins)
+        positions = [self.search_sorted(grade_header, edge) for edge in edges[:-1]] + [self.graded(grade_header)]
+        return [(edges[i], edges[i + 1], positions[i + 1] - positions[i]) for i in range(bins)]
+
+
+class ColumnarGradebook(Gradebook):
+    # Gradebook variant that keeps the students' hashes in one sorted
+    # fixed-width numpy array, looked up with searchsorted, and the grade
+    # columns in another (one row per column, in hash order). Names, ID
+    # numbers and passwords are not retained. Adding or removing a
+    # record shifts the students after it. Missing grades are stored as
+    # MISSING_GRADE.
+
+    INITIAL_CAPACITY = 1024
+    GRADE_DTYPE = "int16"
+    # Raw SHA-256 digests; unlike "S32", a void dtype keeps trailing
+    # zero bytes.
+    HASH_LEN = 32
+    HASH_DTYPE = f"V{HASH_LEN}"
+
+    def __init__(self, columns=GRADE_HEADERS):
+        if np is None:
+            raise RuntimeError("The columnar grade store requires numpy")
+        super().__init__(columns)
+        self.count = 0
+        self.hashes = np.zeros(ColumnarGradebook.INITIAL_CAPACITY, dtype=ColumnarGradebook.HASH_DTYPE)
+        self.grade_array = np.zeros((len(self.columns), ColumnarGradebook.INITIAL_CAPACITY),
+                                    dtype=ColumnarGradebook.GRADE_DTYPE)
+
+    def __contains__(self, hash):
+        return self.find(hash) is not None
+
+    def __len__(self):
+        return self.count
+
+    def find(self, hash):
+        # Position of hash in the sorted hashes, None if absent.
+        if len(hash) != ColumnarGradebook.HASH_LEN:
+            return None
+        key = np.void(hash)
+        position = int(np.searchsorted(self.hashes[:self.count], key))
+        if position < self.count and self.hashes[position] == key:
+            return position
+        return None
+
+    def position(self, hash):
+        position = self.find(hash)
+        if position is None:
+            raise KeyError(hash)
+        return position
+
+    def column(self, grade_header):
+        return self.grade_array[self.columns.index(grade_header), :self.count]
+
+    def add_record(self, row, hash=None):
+        if hash is None:
+            hash = Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER])
+        if hash in self:
+            self.remove_record(hash)
+
+        grades = [parse_grade(row[header]) for header in self.columns]
+        for grade, aggregate in zip(grades, self.aggregates.values()):
+            if grade is not None:
+                aggregate.add(grade)
+
+        position = int(np.searchsorted(self.hashes[:self.count], np.void(hash)))
+        self.reserve(self.count + 1)
+        self.hashes[position + 1:self.count + 1] = self.hashes[position:self.count]
+        self.grade_array[:, position + 1:self.count + 1] = self.grade_array[:, position:self.count]
+        self.hashes[position] = np.void(hash)
+        self.grade_array[:, position] = [MISSING_GRADE if grade is None else grade for grade in grades]
+        self.count += 1
+        self.data_changed()
+        return hash
+
+    def add_records(self, records):
+        # Students already present are updated in place. New ones are
+        # collected, merged with the existing students in one sort, and
+        # every column is then reduced with a single numpy call per
+        # aggregate.
+        pending = {}
+        for hash, id_number, last_name, first_name, grades in records:
+            if None in grades:
+                grades = [MISSING_GRADE if grade is None else grade for grade in grades]
+            position = self.find(hash)
+            if position is None:
+                pending[hash] = grades
+            else:
+                self.grade_array[:, position] = grades
+
+        if pending:
+            hashes = np.concatenate((self.hashes[:self.count],
+                                     np.array(list(pending), dtype=ColumnarGradebook.HASH_DTYPE)))
+            grade_array = np.concatenate((self.grade_array[:, :self.count],
+                                          np.array(list(pending.values()), dtype=ColumnarGradebook.GRADE_DTYPE)
+                                          .reshape(len(pending), len(self.columns)).T), axis=1)
+            del pending
+            order = np.argsort(hashes)
+            self.count = len(order)
+            self.hashes = hashes[order]
+            self.grade_array = grade_array[:, order]
+        counts, array = present_grades(self.grade_array[:, :self.count], 1)
+        self.set_aggregates(counts, array.sum(axis=1, dtype=np.int64),
+                            np.square(array, dtype=np.int64).sum(axis=1))
+        self.data_changed()
+
+    def reserve(self, capacity):
+        # Grow the hash and grade arrays, doubling them, to hold capacity
+        # students.
+        if capacity <= len(self.hashes):
+            return
+        size = max(capacity, 2 * len(self.hashes))
+        hashes = np.zeros(size, dtype=ColumnarGradebook.HASH_DTYPE)
+        hashes[:self.count] = self.hashes[:self.count]
+        grown = np.zeros((len(self.columns), size), dtype=ColumnarGradebook.GRADE_DTYPE)
+        grown[:, :self.count] = self.grade_array[:, :self.count]
+        self.hashes = hashes
+        self.grade_array = grown
+
+    def update_grade(self, hash, grade_header, value):
+        with self.index_lock:
+            i = self.columns.index(grade_header)
+            position = self.position(hash)
+            value = int(value)
+            old_value = self.grades(hash)[grade_header]
+            self.aggregates[grade_header].replace(old_value, value)
+            self.grade_array[i, position] = value
+            self.grade_changed(position, grade_header, old_value, value)
+
+    def remove_record(self, hash):
+        removed = self.grades(hash)
+        position = self.position(hash)
+        for header, aggregate in self.aggregates.items():
+            if removed[header] is not None:
+                aggregate.remove(removed[header])
+
+        self.hashes[position:self.count - 1] = self.hashes[position + 1:self.count]
+        self.grade_array[:, position:self.count - 1] = self.grade_array[:, position + 1:self.count]
+        self.count -= 1
+        self.data_changed()
+        return removed
+
+    def grades(self, hash):
+        position = self.position(hash)
+        return {header: None if grade == MISSING_GRADE else grade
+                for header, grade in zip(self.columns, self.grade_array[:, position].tolist())}
+
+    def grade_changed(self, key, grade_header, old_value, new_value):
+        # The sorted indexes are numpy arrays, only the changed column's
+        # is dropped.
+        with self.index_lock:
+            self.sorted_indexes.pop(grade_header, None)
+        self.responses.clear()
+        self.weighted_totals_cache.clear()
+
+    def find_student(self, id_number):
+        # ID numbers are not kept, so students can only be found by hash.
+        raise ValueError("the columnar store does not keep ID numbers, give the student's ID/password hash")
+
+    def grade_rows(self):
+        return self.hashes[:self.count].tolist(), self.grade_array[:, :self.count].T
+
+    def memory_usage(self):
+        return self.hashes.nbytes + self.grade_array.nbytes
+
+    def sorted_index(self, grade_header):
+        # The keys are positions in the grade array.
+        with self.index_lock:
+            if grade_header not in self.sorted_indexes:
+                column = self.column(grade_header)
+                positions = np.flatnonzero(column != MISSING_GRADE)
+                positions = positions[np.argsort(column[positions], kind="stable")]
+                self.sorted_indexes[grade_header] = (column[positions], positions)
+            return self.sorted_indexes[grade_header]
+
+    def search_sorted(self, grade_header, value, right=False):
+        return int(np.searchsorted(self.sorted_column(grade_header), value, side="right" if right else "left"))
+
+    def histogram(self, grade_header, bins=Gradebook.DEFAULT_HISTOGRAM_BINS):
+        values = self.sorted_column(grade_header)
+        edges = np.array(self.histogram_edges(grade_header, bins))
+        positions = np.searchsorted(values, edges, side="left")
+        positions[-1] = len(values)
+        counts = np.diff(positions)
+        return [(float(edges[i]), float(edges[i + 1]), int(counts[i])) for i in range(bins)]
+
+
+class SnapshotGradebook(Gradebook):
+    # Read-only gradebook served straight from a memory-mapped snapshot
+    # file written by compile_snapshot, so nothing is parsed at startup.
+    #
+    # ---------------------------------------------------------------
+    # | header | column names | aggregates | records sorted by hash |
+    # ---------------------------------------------------------------
+    #
+    # The header holds the magic, the mtime and size of the CSV file the
+    # snapshot was compiled from, the record count, the column count and
+    # the length of the column names block (newline separated UTF-8).
+    # There is one count/sum/sum of squares aggregate per column, and
+    # each record is the 32 byte ID/password hash followed by one 16 bit
+    # grade per column, MISSING_GRADE if it is missing. Lookups binary
+    # search the records in place.
+
+    MAGIC = b"GRADES01"
+    HEADER = struct.Struct("<8sqqqII")
+    AGGREGATE = struct.Struct("<qqq")
+    HASH_LEN = 32
+
+    def __init__(self, filename, csv_signature=None):
+        super().__init__()
+        with open(filename, "rb") as snapshot:
+            self.mmap = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, mtime_ns, size, self.count, column_count, names_len = \
+            SnapshotGradebook.HEADER.unpack_from(self.mmap, 0)
+        if magic != SnapshotGradebook.MAGIC:
+            raise ValueError(f"{filename} is not a gradebook snapshot")
+        if csv_signature is not None and (mtime_ns, size) != tuple(csv_signature):
+            raise ValueError(f"{filename} is stale, the CSV file has changed since it was compiled")
+
+        offset = SnapshotGradebook.HEADER.size
+        self.columns = tuple(bytes(self.mmap[offset:offset + names_len]).decode("utf-8").split("\n"))
+        offset += names_len
+
+        self.aggregates = {}
+        for header in self.columns:
+            aggregate = ColumnAggregate()
+            aggregate.count, aggregate.total, aggregate.total_sq = \
+                SnapshotGradebook.AGGREGATE.unpack_from(self.mmap, offset)
+            self.aggregates[header] = aggregate
+            offset += SnapshotGradebook.AGGREGATE.size
+
+        self.record = SnapshotGradebook.record_struct(column_count)
+        self.records_offset = offset
+
+    @staticmethod
+    def record_struct(column_count):
+        return struct.Struct(f"<{SnapshotGradebook.HASH_LEN}s{column_count}h")
+
+    @staticmethod
+    def write(gradebook, filename, csv_signature):
+        # Write to a temporary name and rename, so that a server starting
+        # up never maps a half written snapshot.
+        columns = gradebook.columns
+        names = "\n".join(columns).encode("utf-8")
+        record = SnapshotGradebook.record_struct(len(columns))
+        partial_filename = filename + ".partial"
+        with open(partial_filename, "wb") as snapshot:
+            snapshot.write(SnapshotGradebook.HEADER.pack(SnapshotGradebook.MAGIC, *csv_signature,
+                                                         len(gradebook), len(columns), len(names)))
+            snapshot.write(names)
+            for aggregate in gradebook.aggregates.values():
+                snapshot.write(SnapshotGradebook.AGGREGATE.pack(aggregate.count, aggregate.total, aggregate.total_sq))
+            hashes, rows = gradebook.grade_rows()
+            for i in sorted(range(len(hashes)), key=hashes.__getitem__):
+                snapshot.write(record.pack(hashes[i], *(MISSING_GRADE if grade is None else int(grade)
+                                                        for grade in rows[i])))
+        os.replace(partial_filename, filename)
+
+    def __contains__(self, hash):
+        return self.find(hash) is not None
+
+    def __len__(self):
+        return self.count
+
+    def find(self, hash):
+        # Binary search for the record offset of hash, None if absent.
+        if len(hash) != SnapshotGradebook.HASH_LEN:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.records_offset + middle * self.record.size
+            if self.mmap[offset:offset + SnapshotGradebook.HASH_LEN] < hash:
+                low = middle + 1
+            else:
+                high = middle
+        offset = self.records_offset + low * self.record.size
+        if low < self.count and self.mmap[offset:offset + SnapshotGradebook.HASH_LEN] == hash:
+            return offset
+        return None
+
+    def add_record(self, row, hash=None):
+        raise TypeError("A gradebook snapshot is read-only")
+
+    def check_update(self, hash, grade_header, value):
+        raise TypeError("A gradebook snapshot is read-only")
+
+    def update_grade(self, hash, grade_header, value):
+        raise TypeError("A gradebook snapshot is read-only")
+
+    def remove_record(self, hash):
+        raise TypeError("A gradebook snapshot is read-only")
+
+    def grades(self, hash):
+        offset = self.find(hash)
+        if offset is None:
+            raise KeyError(hash)
+        return {header: None if grade == MISSING_GRADE else grade
+                for header, grade in zip(self.columns, self.record.unpack_from(self.mmap, offset)[1:])}
+
+    def sorted_index(self, grade_header):
+        # The keys are record numbers in the snapshot.
+        with self.index_lock:
+            if grade_header not in self.sorted_indexes:
+                i = self.columns.index(grade_header) + 1
+                records = self.mmap[self.records_offset:self.records_offset + self.count * self.record.size]
+                column = [values[i] for values in self.record.iter_unpack(records)]
+                keys = sorted((key for key in range(self.count) if column[key] != MISSING_GRADE),
+                              key=column.__getitem__)
+                self.sorted_indexes[grade_header] = ([column[key] for key in keys], keys)
+            return self.sorted_indexes[grade_header]
+
+    def find_student(self, id_number):
+        return None
+
+    def grade_rows(self):
+        records = list(self.record.iter_unpack(self.mmap[self.records_offset:
+                                                         self.records_offset + self.count * self.record.size]))
+        return [values[0] for values in records], \
+            [values[1:] if MISSING_GRADE not in values else
+             tuple(None if grade == MISSING_GRADE else grade for grade in values[1:]) for values in records]
+
+    def memory_usage(self):
+        # Only the mapping's pages that have been touched are resident.
+        return len(self.mmap)
+
+
+class SqliteSortedColumn:
+    # Read-only sequence view of one grade column in ascending order,
+    # answered by the column's index, so that the order statistics of
+    # Gradebook work without loading the column.
+
+    def __init__(self, gradebook, grade_header):
+        self.gradebook = gradebook
+        self.grade_header = grade_header
+        self.column = gradebook.column_name(grade_header)
+
+    def __len__(self):
+        return self.gradebook.graded(self.grade_header)
+
+    def __getitem__(self, position):
+        # Negative positions walk the index from the top end.
+        order, offset = ("DESC", -position - 1) if position < 0 else ("ASC", position)
+        row = self.gradebook.query_one(f"SELECT {self.column} FROM grades WHERE {self.column} IS NOT NULL "
+                                       f"ORDER BY {self.column} {order} LIMIT 1 OFFSET ?", (offset,))
+        if row is None:
+            raise IndexError(position)
+        return row[0]
+
+
+class SqliteGradebook(Gradebook):
+    # Gradebook kept in an SQLite database file instead of in memory, for
+    # rosters that do not fit in RAM. The grades table has the credential
+    # hash as its primary key, one indexed column per grade column
+    # (c0, c1, ... in the order of the columns table) and the ID number
+    # and names; missing grades are NULL. The count/sum/sum of squares of
+    # every column are kept in the aggregates table and updated with the
+    # records. The database is built from the CSV file by from_csv and
+    # reused while the CSV file's mtime and size, stored in the meta
+    # table, are unchanged.
+    #
+    # Memory use is bounded by memory_budget bytes: half of it goes to
+    # SQLite's page cache, the rest to LRU caches of hot records, of the
+    # server's encoded responses and of the class's sorted weighted
+    # totals.
+
+    DEFAULT_MEMORY_BUDGET = 64 << 20
+    RECORD_CACHE_ENTRY_BYTES = 256
+    RESPONSE_CACHE_ENTRY_BYTES = 256
+    WEIGHTED_TOTAL_BYTES = 8
+    INSERT_BATCH_SIZE = 10_000
+
+    def __init__(self, filename, memory_budget=DEFAULT_MEMORY_BUDGET):
+        super().__init__()
+        self.filename = filename
+        self.memory_budget = memory_budget
+        # Requests, the CSV watcher and the index builder may use the
+        # gradebook from different threads.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute(f"PRAGMA cache_size = {-(memory_budget // 2 >> 10)}")
+
+        try:
+            self.columns = tuple(header for header, in self.query_all("SELECT header FROM columns ORDER BY position"))
+            self.csv_signature = self.query_one("SELECT csv_mtime_ns, csv_size FROM meta")
+            self.aggregates = {header: ColumnAggregate(*self.query_one(
+                "SELECT count, total, total_sq FROM aggregates WHERE position = ?", (i,)))
+                for i, header in enumerate(self.columns)}
+        except (sqlite3.Error, TypeError) as err:
+            self.connection.close()
+            raise ValueError(f"{filename} is not a gradebook database: {err}") from None
+        self.count = self.query_one("SELECT COUNT(*) FROM grades")[0]
+        self.select_grades = "SELECT " + ", ".join(self.column_names()) + " FROM grades WHERE hash = ?"
+
+        self.records = LRUCache(memory_budget // 8 // (SqliteGradebook.RECORD_CACHE_ENTRY_BYTES + 8 * len(self.columns)))
+        self.responses = LRUCache(memory_budget // 4 // SqliteGradebook.RESPONSE_CACHE_ENTRY_BYTES)
+        # Weighting scheme -> every student's weighted total, in
+        # ascending order, so that a FINAL rank is a bisection rather
+        # than a scan of the table. As many schemes are kept as fit in
+        # an eighth of the budget, none for a class too large for it.
+        self.sorted_totals = LRUCache(0)
+
+    @classmethod
+    def from_csv(cls, filename, print_rows=False, workers=1, database=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+        # Reuse the database if it was built from the current CSV file,
+        # otherwise build a new one under a temporary name and rename it
+        # into place. The rows are streamed into SQLite in batches, so
+        # the roster is never held in memory.
+        if database is None:
+            database = path.splitext(filename)[0] + ".db"
+        stat = os.stat(filename)
+        csv_signature = (stat.st_mtime_ns, stat.st_size)
+        try:
+            gradebook = cls(database, memory_budget)
+            if gradebook.csv_signature == csv_signature:
+                return gradebook
+            gradebook.close()
+        except (OSError, ValueError):
+            pass
+
+        # The rows are streamed into the database rather than held in
+        # memory, so the grade columns are found by a first pass over
+        # the file.
+        columns = read_grade_columns(filename)
+        candidates, batches = Gradebook.read_csv_batches(filename, workers)
+        positions = [i for i, header in enumerate(candidates) if header in columns]
+        records = select_grades(itertools.chain.from_iterable(records for records, _ in batches), positions)
+        if print_rows:
+            records = Gradebook.echo_records(records)
+        partial_database = database + ".partial"
+        if path.exists(partial_database):
+            os.remove(partial_database)
+        SqliteGradebook.build(partial_database, columns, records, csv_signature)
+        os.replace(partial_database, database)
+        return cls(database, memory_budget)
+
+    @staticmethod
+    def build(filename, columns, records, csv_signature):
+        column_names = [f"c{i}" for i in range(len(columns))]
+        connection = sqlite3.connect(filename)
+        try:
+            # The file is renamed into place only once it is complete,
+            # so it does not need a journal.
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("CREATE TABLE meta (csv_mtime_ns INTEGER, csv_size INTEGER)")
+            connection.execute("CREATE TABLE columns (position INTEGER PRIMARY KEY, header TEXT)")
+            connection.execute("CREATE TABLE aggregates (position INTEGER PRIMARY KEY, "
+                               "count INTEGER, total INTEGER, total_sq INTEGER)")
+            connection.execute("CREATE TABLE grades (hash BLOB PRIMARY KEY, id_number TEXT, last_name TEXT, "
+                               "first_name TEXT, " + ", ".join(f"{name} INTEGER" for name in column_names)
+                               + ") WITHOUT ROWID")
+            connection.execute("INSERT INTO meta VALUES (?, ?)", csv_signature)
+            connection.executemany("INSERT INTO columns VALUES (?, ?)", enumerate(columns))
+
+            insert = f"INSERT OR REPLACE INTO grades VALUES ({', '.join('?' * (4 + len(columns)))})"
+            values = ((hash, id_number, last_name, first_name, *grades)
+                      for hash, id_number, last_name, first_name, grades in records)
+            while True:
+                batch = list(itertools.islice(values, SqliteGradebook.INSERT_BATCH_SIZE))
+                if not batch:
+                    break
+                connection.executemany(insert, batch)
+
+            for name in column_names:
+                connection.execute(f"CREATE INDEX grades_{name} ON grades ({name})")
+            connection.execute("CREATE INDEX grades_id_number ON grades (id_number)")
+            # Every column's aggregates in a single scan.
+            if column_names:
+                sums = connection.execute("SELECT " + ", ".join(
+                    f"COUNT({name}), COALESCE(SUM({name}), 0), COALESCE(SUM({name} * {name}), 0)"
+                    for name in column_names) + " FROM grades").fetchone()
+                connection.executemany("INSERT INTO aggregates VALUES (?, ?, ?, ?)",
+                                       ((i, *sums[3 * i:3 * i + 3]) for i in range(len(columns))))
+            connection.commit()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def record_values(hash, row, columns):
+        if hash is None:
+            hash = Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER])
+        return (hash, row[ID_HEADER], row[LN_HEADER], row[FN_HEADER], *(parse_grade(row[header]) for header in columns))
+
+    def close(self):
+        # Taken under the lock, so that a query already running on
+        # another thread finishes first.
+        with self.lock:
+            self.connection.close()
+
+    def column_names(self):
+        return [f"c{i}" for i in range(len(self.columns))]
+
+    def column_name(self, grade_header):
+        return f"c{self.columns.index(grade_header)}"
+
+    def query_one(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchone()
+
+    def query_all(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def __contains__(self, hash):
+        try:
+            self.grades(hash)
+            return True
+        except KeyError:
+            return False
+
+    def __len__(self):
+        return self.count
+
+    def grades(self, hash):
+        grades = self.records.get(hash)
+        if grades is None:
+            grades = self.query_one(self.select_grades, (hash,))
+            if grades is None:
+                raise KeyError(hash)
+            self.records[hash] = grades
+        return dict(zip(self.columns, grades))
+
+    def grade_rows(self):
+        # Reads the whole table, it is only used to write a snapshot.
+        rows = self.query_all("SELECT hash, " + ", ".join(self.column_names()) + " FROM grades")
+        return [row[0] for row in rows], [row[1:] for row in rows]
+
+    def find_student(self, id_number):
+        row = self.query_one("SELECT hash FROM grades WHERE id_number = ?", (id_number,))
+        return row and row[0]
+
+    def add_record(self, row, hash=None):
+        return self.add_values(SqliteGradebook.record_values(hash, row, self.columns))
+
+    def add_values(self, values):
+        hash = values[0]
+        if hash in self:
+            self.remove_record(hash)
+        with self.lock, self.connection:
+            self.connection.execute(f"INSERT INTO grades VALUES ({', '.join('?' * len(values))})", values)
+        for grade, aggregate in zip(values[4:], self.aggregates.values()):
+            if grade is not None:
+                aggregate.add(grade)
+        self.count += 1
+        self.aggregates_changed()
+        return hash
+
+    def add_records(self, records):
+        for hash, id_number, last_name, first_name, grades in records:
+            self.add_values((hash, id_number, last_name, first_name, *grades))
+
+    def update_grade(self, hash, grade_header, value):
+        old_value = self.grades(hash)[grade_header]
+        value = int(value)
+        with self.lock, self.connection:
+            self.connection.execute(f"UPDATE grades SET {self.column_name(grade_header)} = ? WHERE hash = ?",
+                                    (value, hash))
+        self.aggregates[grade_header].replace(old_value, value)
+        self.aggregates_changed()
+
+    def remove_record(self, hash):
+        removed = self.grades(hash)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM grades WHERE hash = ?", (hash,))
+        for header, aggregate in self.aggregates.items():
+            if removed[header] is not None:
+                aggregate.remove(removed[header])
+        self.count -= 1
+        self.aggregates_changed()
+        return removed
+
+    def aggregates_changed(self):
+        # Write the aggregates back to the summary table.
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE aggregates SET count = ?, total = ?, total_sq = ? WHERE position = ?",
+                ((aggregate.count, aggregate.total, aggregate.total_sq, i)
+                 for i, aggregate in enumerate(self.aggregates.values())))
+        self.data_changed()
+
+    def data_changed(self):
+        super().data_changed()
+        self.records.clear()
+        self.sorted_totals.clear()
+
+    def memory_usage(self):
+        # The page cache is counted at its configured size, or the size
+        # of the database if that is smaller.
+        return min(self.memory_budget // 2, os.path.getsize(self.filename)) + sys.getsizeof(self.records) + sys.getsizeof(self.responses) \
+            + sum(sys.getsizeof(hash) + sys.getsizeof(grades) for hash, grades in self.records.items()) \
+            + sum(sys.getsizeof(response) for response in self.responses.values()) \
+            + sum(sys.getsizeof(totals) for totals in self.sorted_totals.values())
+
+    def cache_memory_usage(self):
+        # The record and response caches are counted by memory_usage,
+        # and the grade columns are indexed in the database.
+        return 0
+
+    def build_indexes(self):
+        # The grade columns are indexed in the database.
+        pass
+
+    def sorted_index(self, grade_header):
+        raise TypeError("The SQLite grade store has no in-memory sorted indexes")
+
+    def sorted_column(self, grade_header):
+        return SqliteSortedColumn(self, grade_header)
+
+    def search_sorted(self, grade_header, value, right=False):
+        return self.query_one(f"SELECT COUNT(*) FROM grades WHERE {self.column_name(grade_header)} "
+                              f"{'<=' if right else '<'} ?", (value,))[0]
+
+    def ranked_students(self, grade_header, start, end, limit=None):
+        if limit is not None:
+            start = max(start, end - limit)
+        column = self.column_name(grade_header)
+        rows = self.query_all(f"SELECT {column} FROM grades WHERE {column} IS NOT NULL "
+                              f"ORDER BY {column} DESC LIMIT ? OFFSET ?",
+                              (end - start, self.graded(grade_header) - end))
+        ranks = {}
+        students = []
+        for grade, in rows:
+            if grade not in ranks:
+                ranks[grade] = self.graded(grade_header) - self.search_sorted(grade_header, grade, right=True) + 1
+            students.append((ranks[grade], grade))
+        return students
+
+    def weighted_expression(self, weights):
+        # SQL for a student's weighted total, rounded as in Gradebook,
+        # with missing (NULL) grades counted as 0.
+        weight_sum = sum(weight for _, weight in weights)
+        terms = [f"COALESCE({self.column_name(grade_header)}, 0) * {weight / weight_sum!r}"
+                 for grade_header, weight in weights]
+        return f"ROUND({' + '.join(terms)}, {Gradebook.TOTAL_DECIMALS})"
+
+    def weighted_total(self, hash, weights):
+        expression = self.weighted_expression(weights)
+        total = self.query_one(f"SELECT {expression} FROM grades WHERE hash = ?", (hash,))[0]
+        sorted_totals = self.sorted_totals.get(weights)
+        if sorted_totals is None:
+            self.sorted_totals.maxsize = min(Gradebook.WEIGHTED_TOTALS_CACHE_SIZE, self.memory_budget // 8 // max(
+                1, SqliteGradebook.WEIGHTED_TOTAL_BYTES * len(self)))
+            if not self.sorted_totals.maxsize:
+                above = self.query_one(f"SELECT COUNT(*) FROM grades WHERE {expression} > ?", (total,))[0]
+                return total, above + 1
+            with self.lock:
+                sorted_totals = array.array("d", (value for value, in self.connection.execute(
+                    f"SELECT {expression} AS total FROM grades ORDER BY total")))
+            self.sorted_totals[weights] = sorted_totals
+        return total, len(sorted_totals) - bisect.bisect_right(sorted_totals, total) + 1
+
+    def weighted_summary(self, weights):
+        key = ("summary", weights)
+        result = self.weighted_totals_cache.get(key)
+        if result is None:
+            expression = self.weighted_expression(weights)
+            mean = self.query_one(f"SELECT AVG({expression}) FROM grades")[0]
+            middle = [total for total, in self.query_all(
+                f"SELECT {expression} AS total FROM grades ORDER BY total LIMIT ? OFFSET ?",
+                (2 - len(self) % 2, (len(self) - 1) // 2))]
+            result = (mean, sum(middle) / len(middle))
+            self.weighted_totals_cache[key] = result
+        return result
+
+    def grade_distribution(self, weights):
+        # Students at or above each cutoff, counted in one scan.
+        key = ("distribution", weights)
+        result = self.weighted_totals_cache.get(key)
+        if result is None:
+            at_least = self.query_one("SELECT " + ", ".join(f"COALESCE(SUM(total >= {cutoff}), 0)"
+                                                            for cutoff, _ in LETTER_GRADES)
+                                      + f" FROM (SELECT {self.weighted_expression(weights)} AS total FROM grades)")
+            result = [(letter, at_least[i] - (at_least[i - 1] if i else 0))
+                      for i, (_, letter) in enumerate(LETTER_GRADES)]
+            self.weighted_totals_cache[key] = result
+        return result
+
+
+def compile_snapshot(csv_filename, snapshot_filename, workers=1):
+    # Compile step for the server's --snapshot option.
+    start = time.perf_counter()
+    csv_stat = os.stat(csv_filename)
+    gradebook = Gradebook.from_csv(csv_filename, workers=workers)
+    SnapshotGradebook.write(gradebook, snapshot_filename, (csv_stat.st_mtime_ns, csv_stat.st_size))
+    print(f"Compiled {len(gradebook)} records from {csv_filename} into {snapshot_filename} "
+          f"in {time.perf_counter() - start:.2f} s")
+
+
+class GradeUpdateLog:
+    # Write-ahead log of the grade updates made since the CSV file was
+    # last compacted, one line per update:
+    #
+    #   <CRC-32 of the rest of the line> <student hash> <grade> <column>
+    #
+    # (CRC and hash in hex). append() only buffers the line; sync() does
+    # group commit: a single flush and fsync makes every entry appended
+    # so far durable, and callers whose entries were covered by another
+    # caller's fsync return without one. A line cut short by a crash
+    # fails its CRC, and the log is truncated there when it is replayed.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.file = open(filename, "ab")
+        self.appended = 0
+        self.synced = 0
+        self.entries = 0
+
+    @staticmethod
+    def encode_entry(hash, grade_header, value):
+        line = f"{hash.hex()} {value} {grade_header}".encode("utf-8")
+        return f"{zlib.crc32(line):08x} ".encode("utf-8") + line + b"\n"
+
+    @staticmethod
+    def read_entries(filename):
+        # The valid entries of a log file, as {(hash, grade header):
+        # grade} (later entries replace earlier ones), and the length of
+        # the valid part of the file.
+        entries = {}
+        valid_length = 0
+        with open(filename, "rb") as log:
+            for line in log:
+                crc, _, rest = line.rstrip(b"\n").partition(b" ")
+                if not line.endswith(b"\n") or crc != f"{zlib.crc32(rest):08x}".encode("utf-8"):
+                    break
+                hash, value, grade_header = rest.decode("utf-8").split(" ", 2)
+                entries[bytes.fromhex(hash), grade_header] = int(value)
+                valid_length += len(line)
+        return entries, valid_length
+
+    @staticmethod
+    def replay(filename, gradebook):
+        # Apply a log file to gradebook, truncating a torn tail. Only
+        # the last update of each grade is applied. Returns the number
+        # of grades updated.
+        if not path.exists(filename):
+            return 0
+        entries, valid_length = GradeUpdateLog.read_entries(filename)
+        if valid_length < os.path.getsize(filename):
+            with open(filename, "r+b") as log:
+                log.truncate(valid_length)
+        applied = 0
+        for (hash, grade_header), value in entries.items():
+            if hash in gradebook and grade_header in gradebook.aggregates:
+                gradebook.update_grade(hash, grade_header, value)
+                applied += 1
+        return applied
+
+    def append(self, hash, grade_header, value):
+        # Returns the entry's sequence number, for sync().
+        with self.lock:
+            self.file.write(GradeUpdateLog.encode_entry(hash, grade_header, value))
+            self.appended += 1
+            self.entries += 1
+            return self.appended
+
+    def sync(self, sequence):
+        with self.sync_lock:
+            if self.synced >= sequence:
+                return
+            with self.lock:
+                self.file.flush()
+                appended = self.appended
+            os.fsync(self.file.fileno())
+            self.synced = appended
+
+    def rotate(self, old_filename):
+        # Move the current entries to old_filename and start an empty
+        # log, so that compaction can write them out while new updates
+        # keep being logged.
+        with self.sync_lock, self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.appended
+            self.file.close()
+            os.replace(self.filename, old_filename)
+            self.file = open(self.filename, "ab")
+            self.entries = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class CourseStats:
+    # Per course counters reported by the COURSES command. A request
+    # that finds the course loaded is a hit, one that loads it a miss.
+    __slots__ = ("requests", "loads", "load_time", "evictions", "memory")
+
+    def __init__(self):
+        self.requests = 0
+        self.loads = 0
+        self.load_time = 0.0
+        self.evictions = 0
+        self.memory = 0
+
+    def hit_rate(self):
+        return (self.requests - self.loads) / self.requests if self.requests else 0.0
+
+
+class CourseCatalog:
+    # The courses in a directory, one grades CSV file per course, named
+    # after the file: ece4dn4.csv holds course ece4dn4. A course's
+    # gradebook is loaded on its first request and the loaded courses
+    # are kept in LRU order. Once their gradebooks use more than
+    # memory_limit bytes, the least recently used ones are evicted; the
+    # course just requested is always kept.
+
+    CSV_SUFFIX = ".csv"
+    DEFAULT_MEMORY_LIMIT = 256 << 20
+    # A course's memory is measured again once its indexes are built,
+    # and then every MEASURE_INTERVAL requests as its caches fill.
+    MEASURE_INTERVAL = 256
+
+    def __init__(self, directory, store, store_options=None, memory_limit=DEFAULT_MEMORY_LIMIT, workers=1):
+        if not path.isdir(directory):
+            raise RuntimeError(f"Course directory {directory} does not exist")
+        self.directory = directory
+        self.store = store
+        self.store_options = store_options or {}
+        self.memory_limit = memory_limit
+        self.workers = workers
+        self.gradebooks = collections.OrderedDict()
+        self.stats = {}
+        self.memory = 0
+        # Held while the loaded courses are looked up or changed, and
+        # load_lock while a course is loaded, so that a course requested
+        # by several connections at once is loaded once and requests for
+        # loaded courses do not wait for a load.
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        # Gradebooks handed out by gradebook() and not yet released, and
+        # the evicted SQLite gradebooks that are closed once the last of
+        # their users releases them.
+        self.leases = collections.Counter()
+        self.retired = set()
+
+    def course_names(self):
+        return sorted(name[:-len(CourseCatalog.CSV_SUFFIX)] for name in os.listdir(self.directory)
+                      if name.endswith(CourseCatalog.CSV_SUFFIX) and not name.startswith("."))
+
+    def csv_filename(self, course):
+        # Course names are plain file names, never paths.
+        if not course or course.startswith(".") or path.basename(course) != course:
+            raise ValueError(f"invalid course name {course}")
+        return path.join(self.directory, course + CourseCatalog.CSV_SUFFIX)
+
+    def is_loaded(self, course):
+        with self.lock:
+            return course in self.gradebooks
+
+    def gradebook(self, course, load=True):
+        # The course's gradebook, loading it first unless load is False,
+        # in which case a course that is not loaded is a ValueError. The
+        # caller must release() the gradebook once it is done with it.
+        while True:
+            with self.lock:
+                gradebook = self.gradebooks.get(course)
+                if gradebook is not None:
+                    self.gradebooks.move_to_end(course)
+                    stats = self.stats[course]
+                    stats.requests += 1
+                    measure = stats.requests % CourseCatalog.MEASURE_INTERVAL == 0
+                    self.leases[gradebook] += 1
+            if gradebook is not None:
+                if measure:
+                    self.measure(course, gradebook)
+                return gradebook
+            if not load:
+                raise ValueError(f"course {course} is not loaded")
+            # Looked up again, as another load may evict it first.
+            self.load(course)
+
+    def release(self, gradebook):
+        with self.lock:
+            self.leases[gradebook] -= 1
+            if self.leases[gradebook] > 0:
+                return
+            del self.leases[gradebook]
+            if gradebook in self.retired:
+                self.retired.remove(gradebook)
+                gradebook.close()
+
+    def load(self, course):
+        # Load the course unless it is loaded already and return its
+        # gradebook. The asyncio server calls this in a worker thread.
+        with self.load_lock:
+            with self.lock:
+                gradebook = self.gradebooks.get(course)
+            if gradebook is not None:
+                return gradebook
+
+            filename = self.csv_filename(course)
+            if not path.isfile(filename):
+                raise ValueError(f"unknown course {course}, {GET_COURSES_CMD} lists the courses")
+            start = time.perf_counter()
+            try:
+                gradebook = self.store.from_csv(filename, workers=self.workers, **self.store_options)
+            except (OSError, KeyError, ValueError, csv.Error, sqlite3.Error) as err:
+                raise ValueError(f"cannot load course {course}: {err}")
+            memory = gradebook.memory_usage()
+            with self.lock:
+                stats = self.stats.setdefault(course, CourseStats())
+                stats.loads += 1
+                stats.load_time += time.perf_counter() - start
+                stats.memory = memory
+                self.gradebooks[course] = gradebook
+                self.memory += memory
+                # Held by the index builder.
+                self.leases[gradebook] += 1
+                self.evict()
+            print(f"Loaded course {course} ({len(gradebook)} records, {memory} bytes) "
+                  f"in {(time.perf_counter() - start) * 1e3:.1f} ms")
+        threading.Thread(target=self.build_indexes, args=(course, gradebook), daemon=True).start()
+        return gradebook
+
+    def build_indexes(self, course, gradebook):
+        try:
+            gradebook.build_indexes()
+            self.measure(course, gradebook)
+        finally:
+            self.release(gradebook)
+
+    def measure(self, course, gradebook):
+        # Count the course's indexes and caches, which grow after the
+        # load, and evict other courses if they no longer fit.
+        memory = gradebook.memory_usage() + gradebook.cache_memory_usage()
+        with self.lock:
+            if self.gradebooks.get(course) is not gradebook:
+                return
+            stats = self.stats[course]
+            self.memory += memory - stats.memory
+            stats.memory = memory
+            self.evict()
+
+    def evict(self):
+        while self.memory > self.memory_limit and len(self.gradebooks) > 1:
+            course, gradebook = self.gradebooks.popitem(last=False)
+            stats = self.stats[course]
+            self.memory -= stats.memory
+            stats.evictions += 1
+            if isinstance(gradebook, SqliteGradebook):
+                # A request or the index builder may still be querying
+                # it, in which case the last of them closes it.
+                if self.leases[gradebook]:
+                    self.retired.add(gradebook)
+                else:
+                    gradebook.close()
+            print(f"Evicted course {course} ({stats.memory} bytes)")
+
+    def report(self):
+        with self.lock:
+            lines = []
+            for course in sorted(set(self.course_names()) | set(self.stats)):
+                stats = self.stats.get(course, CourseStats())
+                load_time = stats.load_time / stats.loads if stats.loads else 0.0
+                lines.append(f"{course}: {'loaded' if course in self.gradebooks else 'not loaded'}, "
+                             f"{stats.requests} requests, hit rate {stats.hit_rate():.1%}, "
+                             f"{stats.loads} loads ({load_time * 1e3:.1f} ms each), "
+                             f"{stats.evictions} evictions, {stats.memory} bytes")
+            lines.append(f"{len(self.gradebooks)} courses loaded, {self.memory} of {self.memory_limit} bytes")
+            return "\n".join(lines)
+
+
+class Subscription:
+    # A connection's SUB request: the columns whose averages are pushed
+    # to it and the averages it was last sent. A notification has one
+    # "<header>: <average>" line per changed column and ends with an
+    # empty line, so that unframed clients can split them.
+
+    def __init__(self, writer, framed):
+        self.writer = writer
+        self.framed = framed
+        self.columns = ()
+        self.averages = {}
+
+    def changes(self, gradebook):
+        # Update the averages and return the encoded notification, or
+        # None if none of them changed.
+        changed = {}
+        for grade_header in self.columns:
+            aggregate = gradebook.aggregates.get(grade_header)
+            if aggregate is None or aggregate.count == 0:
+                continue
+            average = aggregate.mean()
+            if self.averages.get(grade_header) != average:
+                self.averages[grade_header] = average
+                changed[grade_header] = average
+        if not changed:
+            return None
+        return "".join(f"{grade_header}: {average}\n" for grade_header, average in changed.items()) \
+            .encode(GradeRetrievalServer.MSG_ENCODING) + b"\n"
+
+    def push(self, gradebook):
+        notification = self.changes(gradebook)
+        if notification is not None and not self.writer.is_closing():
+            self.writer.write(encode_frame("notification", notification) if self.framed else notification)
+
+
+class GradeDatagramProtocol(asyncio.DatagramProtocol):
+    # The UDP endpoint of the asyncio server.
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        # A datagram that cannot be answered is dropped; the client
+        # resends or gives up.
+        try:
+            response = self.server.process_datagram(data)
+        except Exception as msg:
+            print(msg)
+            return
+        if response is not None:
+            self.transport.sendto(response, address)
+
 
 class GradeRetrievalServer:
     HOSTNAME = "0.0.0.0"
     PORT = 50000
 
     RECV_BUFFER_SIZE = 1024
+    FRAMED_RECV_BUFFER_SIZE = 65536
     MAX_CONNECTION_BACKLOG = 10
+    ASYNCIO_CONNECTION_BACKLOG = 4096
 
     MSG_ENCODING = "utf-8"
 
+    INCORRECT_ID_PASSWORD_MSG = "Incorrect ID/Password".encode(MSG_ENCODING)
+
     AVG_COMMANDS = {
         GET_MIDTERM_AVG_CMD.encode(MSG_ENCODING): MT_HEADER,
         GET_LAB_1_AVG_CMD.encode(MSG_ENCODING): L1_HEADER,
@@ -49,45 +1889,425 @@ class GradeRetrievalServer:
         GET_LAB_4_AVG_CMD.encode(MSG_ENCODING): L4_HEADER,
     }
 
+    # Statistics commands take a column code and, for PCT and HIST, one
+    # numeric argument: "MED MT", "PCT L2 90", "HIST L1 5".
+    STAT_COMMANDS = {
+        GET_MEDIAN_CMD.encode(MSG_ENCODING): "median",
+        GET_STD_DEV_CMD.encode(MSG_ENCODING): "std_dev",
+        GET_PERCENTILE_CMD.encode(MSG_ENCODING): "percentile",
+        GET_MIN_CMD.encode(MSG_ENCODING): "minimum",
+        GET_MAX_CMD.encode(MSG_ENCODING): "maximum",
+        GET_HISTOGRAM_CMD.encode(MSG_ENCODING): "histogram",
+    }
+
+    # "AGG <column> <statistic> [argument]" answers any statistic for
+    # any grade column, named by its code or its CSV header, quoted if
+    # it contains spaces: 'AGG "Quiz 3" mean', "AGG L2 pct 90". COLS
+    # lists the grade columns.
+    AGGREGATE_COMMAND = GET_AGGREGATE_CMD.encode(MSG_ENCODING)
+    AGGREGATE_STATISTICS = {
+        "mean": "average",
+        "std": "std_dev",
+        "median": "median",
+        "pct": "percentile",
+        "min": "minimum",
+        "max": "maximum",
+        "hist": "histogram",
+    }
+    COLUMNS_COMMAND = GET_COLUMNS_CMD.encode(MSG_ENCODING)
+
+    # "FINAL <ID/password hash in hex> [column=weight ...]" and
+    # "DIST [column=weight ...]": a student's weighted total and letter
+    # grade, and the class's letter grade distribution. Without weights
+    # the server's weighting scheme (--weights, or equal weights) is used.
+    FINAL_GRADE_COMMANDS = {
+        GET_FINAL_GRADE_CMD.encode(MSG_ENCODING),
+        GET_DISTRIBUTION_CMD.encode(MSG_ENCODING),
+    }
+
+    # "UPDATE <instructor ID/password hash in hex> <student> <column>
+    # <grade>", where the student is an ID number or an ID/password hash
+    # in hex (only a hash with the columnar store, which keeps no ID
+    # numbers). Only enabled with --instructors.
+    UPDATE_COMMAND = UPDATE_GRADE_CMD.encode(MSG_ENCODING)
+    # Grades fit the 16 bit grade arrays, whose lowest value is MISSING_GRADE.
+    GRADE_LIMIT = 1 << 15
+
+    CACHE_STATS_COMMAND = GET_CACHE_STATS_CMD.encode(MSG_ENCODING)
+    MEMORY_COMMAND = GET_MEMORY_CMD.encode(MSG_ENCODING)
+    COURSES_COMMAND = GET_COURSES_CMD.encode(MSG_ENCODING)
+    COURSE_PREFIX = COURSE_PREFIX.encode(MSG_ENCODING)
+
+    # "RANK <ID/password hash in hex> [column]", "TOP <column> <count>"
+    # and "RANGE <column> <low> <high>".
+    RANK_COMMANDS = {
+        GET_RANK_CMD.encode(MSG_ENCODING),
+        GET_TOP_CMD.encode(MSG_ENCODING),
+        GET_RANGE_CMD.encode(MSG_ENCODING),
+    }
+    MAX_LISTED_STUDENTS = 100
+
+    # "SUB [column ...]" (asyncio server only) answers with the current
+    # averages of the columns, all of them by default, and then keeps
+    # pushing the averages that a reload or an update changes. Changes
+    # are collected for SUBSCRIPTION_DELAY seconds after the first one
+    # and pushed together, so a burst of updates is one notification.
+    SUBSCRIBE_COMMAND = SUBSCRIBE_CMD.encode(MSG_ENCODING)
+    SUBSCRIPTION_DELAY = 0.5
+
+    # Commands answered over UDP: the statistics anyone may ask for,
+    # which are idempotent, so a client can simply resend a request
+    # whose response was lost.
+    DATAGRAM_COMMANDS = {
+        AGGREGATE_COMMAND,
+        GET_DISTRIBUTION_CMD.encode(MSG_ENCODING),
+        *STAT_COMMANDS,
+    }
+
+    STORES = {
+        "dict": Gradebook,
+        "columnar": ColumnarGradebook,
+        "sqlite": SqliteGradebook,
+    }
+
     SOCKET_ADDRESS = (HOSTNAME, PORT)
 
-    def __init__(self):
+    CSV_FILENAME = path.join(path.dirname(__file__), "grades.csv")
+    WEIGHTS_COLUMN_HEADER = "Column"
+    WEIGHTS_WEIGHT_HEADER = "Weight"
+    SNAPSHOT_FILENAME = path.join(path.dirname(__file__), "grades.snapshot")
+    RELOAD_POLL_INTERVAL = 1.0
+    # The update log is compacted into the CSV file once it has this
+    # many entries, or after this many seconds if it has any.
+    LOG_COMPACT_ENTRIES = 100_000
+    LOG_COMPACT_INTERVAL = 60.0
+    LOG_CHECK_INTERVAL = 1.0
+    WORKER_RESTART_DELAY = 1.0
+
+    def __init__(self, store="dict", use_asyncio=False, framed=False,
+                 csv_filename=CSV_FILENAME, watch=False, snapshot_filename=None,
+                 ingest_workers=1, processes=1, weights_filename=None, database_filename=None,
+                 memory_budget=SqliteGradebook.DEFAULT_MEMORY_BUDGET, instructors_filename=None,
+                 update_log_filename=None, courses_directory=None,
+                 course_memory=CourseCatalog.DEFAULT_MEMORY_LIMIT, udp=False):
         self.socket = None
-        self.data = {}
-        self.load_csv_data()
-        self.create_listen_socket()
-        self.process_connections_forever()
+        self.udp = udp
+        self.udp_socket = None
+        self.loop = None
+        self.subscriptions = set()
+        self.notification_handle = None
+        self.reuse_port = processes > 1
+        self.ingest_workers = ingest_workers
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.framed = framed
+        self.store = GradeRetrievalServer.STORES[store]
+        self.store_options = {}
+        if self.store is SqliteGradebook:
+            self.store_options = {"database": database_filename, "memory_budget": memory_budget}
+        self.csv_filename = csv_filename
+        self.csv_signature = None
+        self.snapshot_filename = snapshot_filename
+        self.update_log = None
+        self.update_log_filename = update_log_filename or csv_filename + ".wal"
+        # Held while an update is logged and applied, and while the
+        # gradebook is swapped or the log rotated.
+        self.update_lock = threading.Lock()
+        try:
+            self.weights = self.load_weights(weights_filename)
+            self.instructors = self.load_instructors(instructors_filename)
+            if self.instructors is not None and processes > 1:
+                raise RuntimeError("Grade updates cannot be combined with --processes")
+            # The default course is the CSV file; with a course directory
+            # its other courses are served read-only, loaded on demand.
+            self.courses = None
+            if courses_directory is not None:
+                # Every sqlite course keeps its own database next to its CSV file.
+                course_options = dict(self.store_options, database=None) if self.store_options else None
+                self.courses = CourseCatalog(courses_directory, self.store, course_options, course_memory,
+                                             ingest_workers)
+            if processes > 1:
+                self.load_shared_gradebook()
+            else:
+                self.load_gradebook()
+        except RuntimeError as err:
+            print(err)
+            sys.exit(1)
+        if processes > 1:
+            self.supervise_workers_forever(processes, use_asyncio, watch)
+        else:
+            self.serve_forever(use_asyncio, watch)
 
-    def load_csv_data(self):
-        with open(path.join(path.dirname(__file__), "grades.csv")) as csvfile:
-            reader = csv.DictReader(csvfile)
-            print("Data read from CSV file:")
+    def serve_forever(self, use_asyncio, watch):
+        if watch:
+            self.start_csv_watcher()
+        if self.update_log is not None:
+            self.start_update_log_compactor()
+        if use_asyncio:
+            self.serve_asyncio_forever()
+        else:
+            if self.udp:
+                self.start_datagram_server()
+            self.create_listen_socket()
+            self.process_connections_forever()
+
+    def load_gradebook(self, build_indexes_in_background=True):
+        # Map the compiled snapshot if there is one and it is up to date
+        # with the CSV file, otherwise fall back to parsing the CSV.
+        loaded = False
+        # Updates need a mutable store, so the snapshot is not mapped
+        # when they are enabled.
+        if self.snapshot_filename is not None and self.instructors is None:
+            try:
+                self.load_snapshot()
+                loaded = True
+            except (OSError, ValueError, struct.error) as msg:
+                print(f"Not using snapshot: {msg}")
+        if not loaded:
+            self.load_csv_data()
+        if self.instructors is not None:
+            self.recover_updates()
+        if build_indexes_in_background:
+            # Sorting every column can take longer than the load itself
+            # (a mapped snapshot, or a sheet with hundreds of columns), so
+            # the indexes are built in the background. Until a column's
+            # index is ready, the first request that needs it builds it.
+            self.start_index_builder(self.gradebook)
+        else:
+            self.gradebook.build_indexes()
+
+    def start_index_builder(self, gradebook):
+        threading.Thread(target=gradebook.build_indexes, daemon=True).start()
+
+    def load_weights(self, weights_filename):
+        # The default weighting scheme, a CSV file with Column and Weight
+        # headers, e.g. "Midterm,40". The columns are checked against the
+        # gradebook when the scheme is used, as a reload may change them.
+        if weights_filename is None:
+            return None
+        try:
+            with open(weights_filename, newline="") as csvfile:
+                return [(row[GradeRetrievalServer.WEIGHTS_COLUMN_HEADER], row[GradeRetrievalServer.WEIGHTS_WEIGHT_HEADER])
+                        for row in csv.DictReader(csvfile)]
+        except (OSError, KeyError, csv.Error) as err:
+            raise RuntimeError(f"Cannot read weights from {weights_filename}: {err}")
+
+    def load_instructors(self, instructors_filename):
+        # ID/password hashes of the instructors allowed to update grades,
+        # from a CSV file with ID Number and Password headers.
+        if instructors_filename is None:
+            return None
+        try:
+            with open(instructors_filename, newline="") as csvfile:
+                return {Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER]) for row in csv.DictReader(csvfile)}
+        except (OSError, KeyError, csv.Error) as err:
+            raise RuntimeError(f"Cannot read instructors from {instructors_filename}: {err}")
+
+    def recover_updates(self):
+        # Replay the updates logged since the last compaction onto the
+        # grades just loaded from the CSV file, then keep logging to the
+        # same file. A compaction that did not finish left its entries
+        # in the .old log; it is replayed first and compacted again.
+        start = time.perf_counter()
+        old_filename = self.update_log_filename + ".old"
+        try:
+            applied = GradeUpdateLog.replay(old_filename, self.gradebook) \
+                + GradeUpdateLog.replay(self.update_log_filename, self.gradebook)
+            self.update_log = GradeUpdateLog(self.update_log_filename)
+        except (OSError, ValueError, UnicodeDecodeError) as err:
+            raise RuntimeError(f"Cannot recover updates from {self.update_log_filename}: {err}")
+        print(f"Replayed {applied} grade updates from {self.update_log_filename} "
+              f"in {(time.perf_counter() - start) * 1e3:.1f} ms")
+        if path.exists(old_filename):
+            self.compact_update_log()
+
+    def start_update_log_compactor(self):
+        compactor_thread = threading.Thread(target=self.compact_update_log_forever, daemon=True)
+        compactor_thread.start()
+
+    def compact_update_log_forever(self):
+        last_compaction = time.monotonic()
+        while True:
+            time.sleep(GradeRetrievalServer.LOG_CHECK_INTERVAL)
+            entries = self.update_log.entries
+            if entries >= GradeRetrievalServer.LOG_COMPACT_ENTRIES or \
+                    (entries and time.monotonic() - last_compaction >= GradeRetrievalServer.LOG_COMPACT_INTERVAL):
+                self.compact_update_log()
+                last_compaction = time.monotonic()
+
+    def compact_update_log(self):
+        # Write the current grades back to the CSV file (and the snapshot,
+        # if the server has one) and drop the log entries they include.
+        # The log is rotated under the update lock, so every entry in the
+        # rotated log has been applied to the grades that are written.
+        start = time.perf_counter()
+        old_filename = self.update_log_filename + ".old"
+        with self.update_lock:
+            if not path.exists(old_filename):
+                self.update_log.rotate(old_filename)
+            gradebook = self.gradebook
+        try:
+            self.write_csv_grades(gradebook)
+            self.csv_signature = self.read_csv_signature()
+            if self.snapshot_filename is not None:
+                SnapshotGradebook.write(gradebook, self.snapshot_filename, self.csv_signature)
+        except (OSError, KeyError, ValueError, csv.Error) as msg:
+            print(f"Compaction of {self.update_log_filename} failed, keeping the log: {msg}")
+            return
+        os.remove(old_filename)
+        print(f"Compacted grade updates into {self.csv_filename} in {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    def write_csv_grades(self, gradebook):
+        # Rewrite the CSV file with gradebook's grades. The names and
+        # passwords only exist in the CSV file, so it is copied row by
+        # row with the grades replaced.
+        partial_filename = self.csv_filename + ".partial"
+        with open(self.csv_filename, newline="") as source, open(partial_filename, "w", newline="") as target:
+            reader = csv.DictReader(source)
+            writer = csv.DictWriter(target, fieldnames=reader.fieldnames)
+            writer.writeheader()
             for row in reader:
-                print(
-                    "  " + row[ID_HEADER],
-                    row[PW_HEADER],
-                    row[LN_HEADER],
-                    row[FN_HEADER],
-                    row[MT_HEADER],
-                    row[L1_HEADER],
-                    row[L2_HEADER],
-                    row[L3_HEADER],
-                    row[L4_HEADER],
-                    sep=",",
-                )
-                password = row[PW_HEADER].encode("utf-8")
-                ID = row[ID_HEADER].encode("utf-8")
-                m = hashlib.sha256()
-                m.update(ID)
-                m.update(password)
-                hash = m.digest()
-                self.data[hash] = row
+                hash = Gradebook.credentials_hash(row[ID_HEADER], row[PW_HEADER])
+                if hash in gradebook:
+                    for grade_header, grade in gradebook.grades(hash).items():
+                        if grade_header in row:
+                            row[grade_header] = "" if grade is None else str(grade)
+                writer.writerow(row)
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(partial_filename, self.csv_filename)
+
+    def load_snapshot(self):
+        start = time.perf_counter()
+        self.csv_signature = self.read_csv_signature()
+        self.gradebook = SnapshotGradebook(self.snapshot_filename, self.csv_signature)
+        print(f"Mapped {len(self.gradebook)} records from {self.snapshot_filename} "
+              f"in {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    def load_shared_gradebook(self):
+        # The worker processes share one read-only snapshot mapping (and
+        # the indexes built here before they are forked), so the snapshot
+        # is compiled first if it is missing or out of date.
+        if self.snapshot_filename is None:
+            self.snapshot_filename = GradeRetrievalServer.SNAPSHOT_FILENAME
+        try:
+            SnapshotGradebook(self.snapshot_filename, self.read_csv_signature())
+        except (OSError, ValueError, struct.error) as msg:
+            print(f"Compiling snapshot: {msg}")
+            compile_snapshot(self.csv_filename, self.snapshot_filename, workers=self.ingest_workers)
+        self.load_gradebook(build_indexes_in_background=False)
+
+    def supervise_workers_forever(self, processes, use_asyncio, watch):
+        # Pre-fork mode: every worker binds the server port with
+        # SO_REUSEPORT and the kernel spreads the incoming connections
+        # across them. Workers that exit are restarted.
+        workers = {}
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        try:
+            for number in range(processes):
+                self.start_worker(workers, number, use_asyncio, watch)
+            while True:
+                pid, status = os.wait()
+                number = workers.pop(pid, None)
+                if number is None:
+                    continue
+                print(f"Worker {number} (pid {pid}) exited with status {status}, restarting ...")
+                time.sleep(GradeRetrievalServer.WORKER_RESTART_DELAY)
+                self.start_worker(workers, number, use_asyncio, watch)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            sys.exit(1)
+
+    def start_worker(self, workers, number, use_asyncio, watch):
+        # Flush first so buffered output is not written twice.
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                print(f"Worker {number} started (pid {os.getpid()})")
+                self.serve_forever(use_asyncio, watch)
+            finally:
+                os._exit(1)
+        workers[pid] = number
+
+    def load_csv_data(self):
+        self.csv_signature = self.read_csv_signature()
+        self.gradebook = self.store.from_csv(self.csv_filename, print_rows=True, workers=self.ingest_workers,
+                                             **self.store_options)
+
+    def read_csv_signature(self):
+        stat = os.stat(self.csv_filename)
+        return stat.st_mtime_ns, stat.st_size
+
+    def start_csv_watcher(self):
+        watcher_thread = threading.Thread(target=self.watch_csv_forever, daemon=True)
+        watcher_thread.start()
+        print(f"Watching {self.csv_filename} for changes")
+
+    def watch_csv_forever(self):
+        # Poll the CSV file's modification time and size. The signature
+        # is taken before the file is read, so a write that races with a
+        # reload is picked up again on the next poll, and it is only
+        # recorded once the reload has succeeded, so a file read half
+        # way through being rewritten is read again.
+        while True:
+            time.sleep(GradeRetrievalServer.RELOAD_POLL_INTERVAL)
+            try:
+                signature = self.read_csv_signature()
+                if signature != self.csv_signature and self.reload_csv_data():
+                    self.csv_signature = signature
+            except OSError:
+                # The file may briefly not exist while it is replaced.
+                continue
+            except Exception as msg:
+                # The watcher must outlive any one bad reload.
+                print(f"Reload of {self.csv_filename} failed: {msg}")
+
+    def reload_csv_data(self):
+        # Build a complete new gradebook on the watcher thread and then
+        # swap it in with a single assignment. Requests take one
+        # reference to self.gradebook, so they see either the old or
+        # the new table, never a partially built one. Returns whether
+        # the new grades were swapped in.
+        start = time.perf_counter()
+        try:
+            gradebook = self.store.from_csv(self.csv_filename, workers=self.ingest_workers, **self.store_options)
+        except (OSError, KeyError, ValueError, csv.Error, sqlite3.Error) as msg:
+            print(f"Reload of {self.csv_filename} failed, keeping the current grades: {msg}")
+            return False
+        with self.update_lock:
+            if self.update_log is not None:
+                # Logged updates that are not in the CSV file yet are
+                # applied to the new grades too.
+                self.update_log.sync(self.update_log.appended)
+                GradeUpdateLog.replay(self.update_log_filename + ".old", gradebook)
+                GradeUpdateLog.replay(self.update_log_filename, gradebook)
+            old_gradebook = self.gradebook
+            self.gradebook = gradebook
+        if isinstance(old_gradebook, SqliteGradebook):
+            # The old database file has been replaced, but stays on disk
+            # for as long as its connection is open.
+            old_gradebook.close()
+        self.start_index_builder(gradebook)
+        self.statistics_changed()
+        print(f"Reloaded {len(gradebook)} records from {self.csv_filename} "
+              f"in {(time.perf_counter() - start) * 1e3:.1f} ms")
+        return True
 
     def create_listen_socket(self):
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
             self.socket.bind(GradeRetrievalServer.SOCKET_ADDRESS)
 
@@ -98,6 +2318,32 @@ class GradeRetrievalServer:
             print(err)
             sys.exit(1)
 
+    def start_datagram_server(self):
+        # The blocking server answers datagrams on their own thread, so
+        # UDP queries are not held up by a TCP client.
+        try:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if self.reuse_port:
+                self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.bind(GradeRetrievalServer.SOCKET_ADDRESS)
+        except Exception as err:
+            print(err)
+            sys.exit(1)
+        datagram_thread = threading.Thread(target=self.process_datagrams_forever, daemon=True)
+        datagram_thread.start()
+        print(f"Listening for datagrams on port {GradeRetrievalServer.PORT}")
+
+    def process_datagrams_forever(self):
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(MAX_DATAGRAM_LEN)
+                response = self.process_datagram(data)
+                if response is not None:
+                    self.udp_socket.sendto(response, address)
+            except Exception as msg:
+                # One bad datagram must not stop the endpoint.
+                print(msg)
+
     def process_connections_forever(self):
         try:
             while True:
@@ -118,52 +2364,556 @@ class GradeRetrievalServer:
         connection, address_port = client
         print(f"Connection received from {address_port[0]} on port {address_port[1]}.")
 
+        frame_buffer = bytearray()
         while True:
             try:
-                recvd_bytes = connection.recv(GradeRetrievalServer.RECV_BUFFER_SIZE)
+                recvd_bytes = connection.recv(self.recv_buffer_size())
 
                 if len(recvd_bytes) == 0:
                     print("Closing client connection ... ")
                     connection.close()
                     break
 
-                if recvd_bytes in GradeRetrievalServer.AVG_COMMANDS:
-                    print(f"Received {recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING)} command from client")
-                    average_str = str(self.calculate_average(GradeRetrievalServer.AVG_COMMANDS[recvd_bytes]))
-                    bytes_to_send = average_str.encode(GradeRetrievalServer.MSG_ENCODING)
+                logged = self.logged_updates()
+                if self.framed:
+                    frame_buffer += recvd_bytes
+                    bytes_to_send = self.process_frames(frame_buffer)
                 else:
-                    print(f"Received IP/password hash {str(recvd_bytes)} from client")
-                    if recvd_bytes in self.data:
-                        print("Correct password, record found")
-                        bytes_to_send = self.format_grades(recvd_bytes)
-                    else:
-                        print("Incorrect ID/Password")
-                        bytes_to_send = "Incorrect ID/Password".encode(GradeRetrievalServer.MSG_ENCODING)
+                    bytes_to_send = self.process_request(recvd_bytes)
+                # Updates are acknowledged once they are durable.
+                if self.logged_updates() != logged:
+                    self.update_log.sync(self.logged_updates())
 
-                connection.sendall(bytes_to_send)
+                if bytes_to_send:
+                    connection.sendall(bytes_to_send)
 
+            except Exception as msg:
+                # Whatever goes wrong with one connection, the server
+                # carries on with the next.
+                print(msg)
+                print("Closing client connection ... ")
+                connection.close()
+                break
             except KeyboardInterrupt:
                 print()
                 print("Closing client connection ... ")
                 connection.close()
                 break
 
-    def calculate_average(self, grade_header):
-        total = 0
-        entries = 0
-        for entry in self.data.values():
-            entries += 1
-            total += int(entry[grade_header])
+    def recv_buffer_size(self):
+        if self.framed:
+            return GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE
+        return GradeRetrievalServer.RECV_BUFFER_SIZE
+
+    def serve_asyncio_forever(self):
+        # Alternative to create_listen_socket/process_connections_forever
+        # where every connection is a coroutine on a single event loop,
+        # so a client idling at its prompt does not hold up the others.
+        raise_open_file_limit()
+        try:
+            asyncio.run(self.asyncio_accept_connections())
+        except Exception as msg:
+            print(msg)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            sys.exit(1)
+
+    async def asyncio_accept_connections(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.asyncio_connection_handler,
+                                            GradeRetrievalServer.HOSTNAME,
+                                            GradeRetrievalServer.PORT,
+                                            backlog=GradeRetrievalServer.ASYNCIO_CONNECTION_BACKLOG,
+                                            reuse_address=True,
+                                            reuse_port=self.reuse_port)
+        print(f"Listening for connections on port "
+              f"{GradeRetrievalServer.PORT} (asyncio)")
+        if self.udp:
+            await asyncio.get_running_loop().create_datagram_endpoint(lambda: GradeDatagramProtocol(self),
+                                                                      local_addr=GradeRetrievalServer.SOCKET_ADDRESS,
+                                                                      reuse_port=self.reuse_port)
+            print(f"Listening for datagrams on port {GradeRetrievalServer.PORT} (asyncio)")
+        async with server:
+            await server.serve_forever()
+
+    async def asyncio_connection_handler(self, reader, writer):
+        address_port = writer.get_extra_info("peername")
+        print(f"Connection received from {address_port[0]} on port {address_port[1]}.")
+
+        frame_buffer = bytearray()
+        subscription = Subscription(writer, self.framed)
+        try:
+            while True:
+                recvd_bytes = await reader.read(self.recv_buffer_size())
+
+                if len(recvd_bytes) == 0:
+                    break
+
+                if self.framed:
+                    frame_buffer += recvd_bytes
+                    await self.load_courses([payload for frame_type, payload
+                                             in decode_frames(bytearray(frame_buffer))])
+                else:
+                    await self.load_courses([recvd_bytes])
+
+                logged = self.logged_updates()
+                if self.framed:
+                    bytes_to_send = self.process_frames(frame_buffer, subscription)
+                else:
+                    bytes_to_send = self.process_request(recvd_bytes, subscription)
+                # Connections that updated grades while an fsync was in
+                # progress share the next one (group commit).
+                if self.logged_updates() != logged:
+                    await asyncio.get_running_loop().run_in_executor(None, self.update_log.sync,
+                                                                     self.logged_updates())
+                writer.write(bytes_to_send)
+                await writer.drain()
+        except Exception as msg:
+            print(msg)
+        finally:
+            self.subscriptions.discard(subscription)
+            print("Closing client connection ... ")
+            writer.close()
+
+    async def load_courses(self, requests):
+        # Loading a course reads its CSV file, which would stall every
+        # connection if it ran on the event loop, so the courses that
+        # requests name and that are not loaded yet are loaded in a
+        # worker thread first. Errors are left for process_request to
+        # report.
+        if self.courses is None:
+            return
+        for request in requests:
+            if not request.startswith(GradeRetrievalServer.COURSE_PREFIX):
+                continue
+            course, separator, _ = request[len(GradeRetrievalServer.COURSE_PREFIX):].partition(b" ")
+            course = course.decode(GradeRetrievalServer.MSG_ENCODING, "replace")
+            if separator and not self.courses.is_loaded(course):
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.courses.load, course)
+                except ValueError:
+                    pass
+
+    def logged_updates(self):
+        return self.update_log.appended if self.update_log is not None else 0
+
+    def process_request(self, recvd_bytes, subscription=None):
+        # Handle one command or ID/password hash and return the bytes to
+        # send back. Shared by the blocking and asyncio servers; only the
+        # asyncio server passes the connection's subscription.
+        try:
+            course, gradebook, recvd_bytes = self.course_gradebook(recvd_bytes)
+        except ValueError as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        try:
+            if self.is_command(recvd_bytes):
+                return self.process_command(recvd_bytes, gradebook, course, subscription)
+            return self.process_grades_request(recvd_bytes, gradebook)
+        finally:
+            self.release_gradebook(course, gradebook)
+
+    def course_gradebook(self, recvd_bytes, load=True):
+        # Returns (course, gradebook, request) for a request that may be
+        # prefixed with "@<course> "; the course is None for the default
+        # one. An unprefixed request always goes to the default course,
+        # so nothing changes for servers without --courses. Without load,
+        # a course that is not loaded is refused rather than loaded. A
+        # course's gradebook is passed to release_gradebook when done.
+        gradebook = self.gradebook
+        if self.courses is None or not recvd_bytes.startswith(GradeRetrievalServer.COURSE_PREFIX):
+            return None, gradebook, recvd_bytes
+        # An unframed GG request is a bare hash, which may start with "@".
+        is_hash = len(recvd_bytes) == SnapshotGradebook.HASH_LEN
+        if is_hash and recvd_bytes in gradebook:
+            return None, gradebook, recvd_bytes
+        course, separator, request = recvd_bytes[len(GradeRetrievalServer.COURSE_PREFIX):].partition(b" ")
+        try:
+            if not separator:
+                raise ValueError(f"expected {COURSE_PREFIX}<course> <request>")
+            course = course.decode(GradeRetrievalServer.MSG_ENCODING)
+            return course, self.courses.gradebook(course, load), request
+        except ValueError:
+            if is_hash:
+                return None, gradebook, recvd_bytes
+            raise
+
+    def release_gradebook(self, course, gradebook):
+        if course is not None:
+            self.courses.release(gradebook)
+
+    def process_datagram(self, data):
+        # Answer one request datagram; datagrams too short to carry a
+        # request ID are dropped.
+        if len(data) < DATAGRAM_REQUEST_ID_LEN:
+            return None
+        request_id, recvd_bytes = data[:DATAGRAM_REQUEST_ID_LEN], data[DATAGRAM_REQUEST_ID_LEN:]
+        try:
+            # Loading a course would stall the asyncio server's event
+            # loop, and anyone could make the server load and evict
+            # courses with spoofed datagrams.
+            course, gradebook, recvd_bytes = self.course_gradebook(recvd_bytes, load=False)
+        except ValueError as err:
+            return request_id + f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        try:
+            if not self.is_datagram_command(recvd_bytes):
+                raise ValueError("only the public statistics commands are answered over UDP")
+            response = self.process_command(recvd_bytes, gradebook, course)
+        except ValueError as err:
+            return request_id + f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        finally:
+            self.release_gradebook(course, gradebook)
+        if DATAGRAM_REQUEST_ID_LEN + len(response) > MAX_DATAGRAM_LEN:
+            response = "Error: response too long for a datagram".encode(GradeRetrievalServer.MSG_ENCODING)
+        return request_id + response
+
+    def is_datagram_command(self, recvd_bytes):
+        return recvd_bytes in GradeRetrievalServer.AVG_COMMANDS \
+            or recvd_bytes == GradeRetrievalServer.COLUMNS_COMMAND \
+            or recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.DATAGRAM_COMMANDS
+
+    def process_frames(self, frame_buffer, subscription=None):
+        # Answer every complete frame in the buffer. The responses are
+        # concatenated so a pipelined batch goes out in one send.
+        responses = []
+        for frame_type, payload in decode_frames(frame_buffer):
+            try:
+                course, gradebook, payload = self.course_gradebook(payload)
+            except ValueError as err:
+                response = f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+            else:
+                try:
+                    if frame_type == FRAME_TYPE["command"]:
+                        response = self.process_command(payload, gradebook, course, subscription)
+                    elif frame_type == FRAME_TYPE["grades"]:
+                        response = self.process_grades_request(payload, gradebook)
+                    else:
+                        response = f"Error: unknown frame type {frame_type}".encode(GradeRetrievalServer.MSG_ENCODING)
+                finally:
+                    self.release_gradebook(course, gradebook)
+            responses.append(encode_frame("response", response))
+        return b"".join(responses)
+
+    def is_command(self, recvd_bytes):
+        return recvd_bytes in GradeRetrievalServer.AVG_COMMANDS \
+            or recvd_bytes == GradeRetrievalServer.CACHE_STATS_COMMAND \
+            or recvd_bytes == GradeRetrievalServer.MEMORY_COMMAND \
+            or recvd_bytes == GradeRetrievalServer.COLUMNS_COMMAND \
+            or recvd_bytes == GradeRetrievalServer.COURSES_COMMAND \
+            or recvd_bytes.split(b" ", 1)[0] == GradeRetrievalServer.SUBSCRIBE_COMMAND \
+            or recvd_bytes.split(b" ", 1)[0] == GradeRetrievalServer.AGGREGATE_COMMAND \
+            or recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.FINAL_GRADE_COMMANDS \
+            or recvd_bytes.split(b" ", 1)[0] == GradeRetrievalServer.UPDATE_COMMAND \
+            or recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.STAT_COMMANDS \
+            or recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.RANK_COMMANDS
+
+    def process_command(self, recvd_bytes, gradebook, course=None, subscription=None):
+        if recvd_bytes in GradeRetrievalServer.AVG_COMMANDS:
+            print(f"Received {recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING)} command from client")
+            response = gradebook.responses.get(recvd_bytes)
+            if response is None:
+                grade_header = GradeRetrievalServer.AVG_COMMANDS[recvd_bytes]
+                if grade_header not in gradebook.aggregates:
+                    return f"Error: no {grade_header} column".encode(GradeRetrievalServer.MSG_ENCODING)
+                if gradebook.graded(grade_header) == 0:
+                    # An empty roster, e.g. after a reload.
+                    return "Error: no grades loaded".encode(GradeRetrievalServer.MSG_ENCODING)
+                response = str(gradebook.average(grade_header)).encode(GradeRetrievalServer.MSG_ENCODING)
+                self.cache_response(gradebook, recvd_bytes, response)
+            else:
+                self.cache_hits += 1
+            return response
+
+        if recvd_bytes == GradeRetrievalServer.CACHE_STATS_COMMAND:
+            print(f"Received {GET_CACHE_STATS_CMD} command from client")
+            return f"hits: {self.cache_hits}, misses: {self.cache_misses}, " \
+                   f"cached: {len(gradebook.responses)}".encode(GradeRetrievalServer.MSG_ENCODING)
+
+        if recvd_bytes == GradeRetrievalServer.MEMORY_COMMAND:
+            print(f"Received {GET_MEMORY_CMD} command from client")
+            memory = gradebook.memory_usage()
+            return f"{type(gradebook).__name__}: {len(gradebook)} students, {memory} bytes, " \
+                   f"{memory / max(len(gradebook), 1):.1f} bytes per student" \
+                .encode(GradeRetrievalServer.MSG_ENCODING)
+
+        if recvd_bytes == GradeRetrievalServer.COLUMNS_COMMAND:
+            print(f"Received {GET_COLUMNS_CMD} command from client")
+            return "\n".join(gradebook.columns).encode(GradeRetrievalServer.MSG_ENCODING)
+
+        if recvd_bytes == GradeRetrievalServer.COURSES_COMMAND:
+            print(f"Received {GET_COURSES_CMD} command from client")
+            if self.courses is None:
+                return "Error: this server has no course directory".encode(GradeRetrievalServer.MSG_ENCODING)
+            return self.courses.report().encode(GradeRetrievalServer.MSG_ENCODING)
+
+        if recvd_bytes.split(b" ", 1)[0] == GradeRetrievalServer.AGGREGATE_COMMAND:
+            print(f"Received {recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING, 'replace')} command from client")
+            return self.calculate_aggregate(recvd_bytes, gradebook)
+
+        if recvd_bytes.split(b" ", 1)[0] == GradeRetrievalServer.SUBSCRIBE_COMMAND:
+            print(f"Received {SUBSCRIBE_CMD} command from client")
+            return self.subscribe(recvd_bytes, gradebook, course, subscription)
+
+        if recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.FINAL_GRADE_COMMANDS:
+            print(f"Received {recvd_bytes.split(b' ', 1)[0].decode(GradeRetrievalServer.MSG_ENCODING)} "
+                  f"command from client")
+            return self.calculate_final_grades(recvd_bytes, gradebook)
 
-        return total / entries
+        if recvd_bytes.split(b" ", 1)[0] == GradeRetrievalServer.UPDATE_COMMAND:
+            print(f"Received {UPDATE_GRADE_CMD} command from client")
+            if course is not None:
+                return "Error: grade updates are only enabled for the default course" \
+                    .encode(GradeRetrievalServer.MSG_ENCODING)
+            return self.update_grade(recvd_bytes)
 
-    def format_grades(self, recvd_hash):
-        entry = self.data[recvd_hash]
-        formatted_str = f"Midterm: {entry[MT_HEADER]}\n" \
-            + f"Lab 1: {entry[L1_HEADER]}\n" \
-            + f"Lab 2: {entry[L2_HEADER]}\n" \
-            + f"Lab 3: {entry[L3_HEADER]}\n" \
-            + f"Lab 4: {entry[L4_HEADER]}\n"
+        if recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.STAT_COMMANDS:
+            print(f"Received {recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING, 'replace')} command from client")
+            return self.calculate_statistic(recvd_bytes, gradebook)
+
+        if recvd_bytes.split(b" ", 1)[0] in GradeRetrievalServer.RANK_COMMANDS:
+            print(f"Received {recvd_bytes.split(b' ', 1)[0].decode(GradeRetrievalServer.MSG_ENCODING)} "
+                  f"command from client")
+            return self.calculate_ranking(recvd_bytes, gradebook)
+
+        print(f"Received unknown command {str(recvd_bytes)} from client")
+        return f"Error: unknown command {recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING, 'replace')}" \
+            .encode(GradeRetrievalServer.MSG_ENCODING)
+
+    def process_grades_request(self, recvd_bytes, gradebook):
+        print(f"Received IP/password hash {str(recvd_bytes)} from client")
+        # Responses for valid hashes are encoded once and then served
+        # from the gradebook's response cache until the data changes.
+        response = gradebook.responses.get(recvd_bytes)
+        if response is not None:
+            print("Correct password, record found")
+            self.cache_hits += 1
+            return response
+
+        if recvd_bytes in gradebook:
+            print("Correct password, record found")
+            response = self.format_grades(gradebook.grades(recvd_bytes))
+            self.cache_response(gradebook, recvd_bytes, response)
+            return response
+
+        print("Incorrect ID/Password")
+        return GradeRetrievalServer.INCORRECT_ID_PASSWORD_MSG
+
+    def cache_response(self, gradebook, key, response):
+        self.cache_misses += 1
+        gradebook.responses[key] = response
+
+    def calculate_statistic(self, recvd_bytes, gradebook):
+        try:
+            cmd, *args = shlex.split(recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING))
+        except ValueError as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        statistic = GradeRetrievalServer.STAT_COMMANDS[cmd.encode(GradeRetrievalServer.MSG_ENCODING)]
+        return self.statistic_response(gradebook, statistic, args[0] if args else None, args[1:])
+
+    def calculate_aggregate(self, recvd_bytes, gradebook):
+        try:
+            cmd, *args = shlex.split(recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING))
+            if len(args) not in (2, 3) or args[1] not in GradeRetrievalServer.AGGREGATE_STATISTICS:
+                raise ValueError(f"usage: {GET_AGGREGATE_CMD} <column> "
+                                 f"<{'|'.join(GradeRetrievalServer.AGGREGATE_STATISTICS)}> [argument]")
+        except ValueError as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        return self.statistic_response(gradebook, GradeRetrievalServer.AGGREGATE_STATISTICS[args[1]], args[0], args[2:])
+
+    def statistic_response(self, gradebook, statistic, column, args):
+        arg_type = float if statistic == "percentile" else int
+        try:
+            grade_header = self.column_header(gradebook, column)
+            if gradebook.graded(grade_header) == 0:
+                raise ValueError("no grades loaded")
+            numeric_args = [arg_type(arg) for arg in args]
+            result = getattr(gradebook, statistic)(grade_header, *numeric_args)
+        except (ValueError, TypeError) as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+
+        if statistic == "histogram":
+            result = "\n".join(f"[{low:g}, {high:g}): {count}" for low, high, count in result)
+        return str(result).encode(GradeRetrievalServer.MSG_ENCODING)
+
+    def calculate_ranking(self, recvd_bytes, gradebook):
+        try:
+            cmd, *args = shlex.split(recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING))
+            if cmd == GET_RANK_CMD:
+                if not args:
+                    raise ValueError("expected an ID/password hash")
+                hash = bytes.fromhex(args[0])
+                if hash not in gradebook:
+                    return GradeRetrievalServer.INCORRECT_ID_PASSWORD_MSG
+                headers = [self.column_header(gradebook, column) for column in args[1:2]] or gradebook.columns
+                grades = gradebook.grades(hash)
+                lines = []
+                for grade_header in headers:
+                    if grades[grade_header] is None:
+                        lines.append(f"{grade_header}: no grade")
+                        continue
+                    rank, percentile = gradebook.rank(hash, grade_header)
+                    lines.append(f"{grade_header}: rank {rank} of {gradebook.graded(grade_header)}, "
+                                 f"percentile {percentile:.1f}")
+                return "\n".join(lines).encode(GradeRetrievalServer.MSG_ENCODING)
+
+            if len(args) != (2 if cmd == GET_TOP_CMD else 3):
+                raise ValueError(f"usage: {GET_TOP_CMD} <column> <count> or {GET_RANGE_CMD} <column> <low> <high>")
+            grade_header = self.column_header(gradebook, args[0])
+            if cmd == GET_TOP_CMD:
+                start, end = gradebook.top_positions(grade_header, int(args[1]))
+            else:
+                start, end = gradebook.range_positions(grade_header, float(args[1]), float(args[2]))
+        except ValueError as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+
+        students = gradebook.ranked_students(grade_header, start, end, limit=GradeRetrievalServer.MAX_LISTED_STUDENTS)
+        lines = [f"{rank}. {grade}" for rank, grade in students]
+        if end - start > len(students):
+            lines.append(f"... and {end - start - len(students)} more")
+        return ("\n".join(lines) or "No students").encode(GradeRetrievalServer.MSG_ENCODING)
+
+    def calculate_final_grades(self, recvd_bytes, gradebook):
+        try:
+            cmd, *args = shlex.split(recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING))
+            if cmd == GET_FINAL_GRADE_CMD:
+                if not args:
+                    raise ValueError("expected an ID/password hash")
+                hash = bytes.fromhex(args.pop(0))
+                if hash not in gradebook:
+                    return GradeRetrievalServer.INCORRECT_ID_PASSWORD_MSG
+            if len(gradebook) == 0:
+                raise ValueError("no grades loaded")
+            if any("=" not in arg for arg in args):
+                raise ValueError("expected weights as column=weight")
+            weights = self.weighting_scheme(gradebook, [arg.rpartition("=")[::2] for arg in args] or self.weights)
+        except ValueError as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+
+        if cmd == GET_FINAL_GRADE_CMD:
+            total, rank = gradebook.weighted_total(hash, weights)
+            return f"Weighted total: {total:.2f}, letter grade {letter_grade(total)}, " \
+                   f"rank {rank} of {len(gradebook)}".encode(GradeRetrievalServer.MSG_ENCODING)
+
+        # The distribution only depends on the data and the weights, so
+        # for the configured weighting scheme it is kept in the
+        # gradebook's response cache. Schemes chosen by the client are
+        # not, as they would add an entry for every scheme tried.
+        key = (GET_DISTRIBUTION_CMD, weights)
+        response = gradebook.responses.get(key) if not args else None
+        if response is not None:
+            self.cache_hits += 1
+            return response
+        mean, median = gradebook.weighted_summary(weights)
+        lines = ["Weights: " + ", ".join(f"{grade_header} {weight:g}" for grade_header, weight in weights),
+                 f"Mean: {mean:.2f}, median: {median:.2f}"]
+        lines += [f"{letter}: {count}" for letter, count in gradebook.grade_distribution(weights)]
+        response = "\n".join(lines).encode(GradeRetrievalServer.MSG_ENCODING)
+        if not args:
+            self.cache_response(gradebook, key, response)
+        return response
+
+    def weighting_scheme(self, gradebook, weights):
+        # Normalize (column, weight) pairs into the hashable form used
+        # as the cache key: (grade header, weight) in column order, with
+        # zero weights left out. None means equal weights.
+        if weights is None:
+            return tuple((grade_header, 1.0) for grade_header in gradebook.columns)
+        scheme = {}
+        for column, weight in weights:
+            grade_header = self.column_header(gradebook, column)
+            if grade_header in scheme:
+                raise ValueError(f"{column} is weighted twice")
+            scheme[grade_header] = float(weight)
+            if scheme[grade_header] < 0 or not math.isfinite(scheme[grade_header]):
+                raise ValueError(f"invalid weight {weight} for {column}")
+        if sum(scheme.values()) <= 0:
+            raise ValueError("the weights must not all be zero")
+        return tuple((grade_header, scheme[grade_header]) for grade_header in gradebook.columns
+                     if scheme.get(grade_header))
+
+    def subscribe(self, recvd_bytes, gradebook, course, subscription):
+        try:
+            cmd, *columns = shlex.split(recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING))
+            if subscription is None:
+                raise ValueError("subscriptions need the asyncio server (--asyncio)")
+            if course is not None:
+                raise ValueError("subscriptions are only available for the default course")
+            grade_headers = [self.column_header(gradebook, column) for column in columns] or gradebook.columns
+        except ValueError as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        # A repeated SUB replaces the connection's columns, and is
+        # answered with all of their current averages.
+        subscription.columns = tuple(grade_headers)
+        subscription.averages = {}
+        self.subscriptions.add(subscription)
+        return subscription.changes(gradebook) or b"\n"
+
+    def statistics_changed(self):
+        # Called after a reload or an update, on any thread.
+        if self.subscriptions and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.schedule_notifications)
+
+    def schedule_notifications(self):
+        if self.notification_handle is None:
+            self.notification_handle = self.loop.call_later(GradeRetrievalServer.SUBSCRIPTION_DELAY,
+                                                            self.push_notifications)
+
+    def push_notifications(self):
+        self.notification_handle = None
+        gradebook = self.gradebook
+        for subscription in self.subscriptions:
+            subscription.push(gradebook)
+
+    def update_grade(self, recvd_bytes):
+        try:
+            cmd, *args = shlex.split(recvd_bytes.decode(GradeRetrievalServer.MSG_ENCODING))
+            if self.update_log is None:
+                raise ValueError("grade updates are not enabled on this server")
+            if len(args) != 4:
+                raise ValueError(f"usage: {UPDATE_GRADE_CMD} <student> <column> <grade>")
+            if bytes.fromhex(args[0]) not in self.instructors:
+                return GradeRetrievalServer.INCORRECT_ID_PASSWORD_MSG
+            student, column, value = args[1:]
+            value = int(value)
+            if not -GradeRetrievalServer.GRADE_LIMIT < value < GradeRetrievalServer.GRADE_LIMIT:
+                raise ValueError(f"grade {value} is out of range")
+            with self.update_lock:
+                gradebook = self.gradebook
+                grade_header = self.column_header(gradebook, column)
+                hash = self.student_hash(gradebook, student)
+                old_value = gradebook.grades(hash)[grade_header]
+                # Checked, so that an error response means nothing was
+                # logged or changed, then logged before it is applied;
+                # the response is sent once the log has been synced.
+                gradebook.check_update(hash, grade_header, value)
+                self.update_log.append(hash, grade_header, value)
+                gradebook.update_grade(hash, grade_header, value)
+        except (ValueError, TypeError) as err:
+            return f"Error: {err}".encode(GradeRetrievalServer.MSG_ENCODING)
+        self.statistics_changed()
+        return f"{grade_header}: {format_grade(old_value)} -> {value}".encode(GradeRetrievalServer.MSG_ENCODING)
+
+    def student_hash(self, gradebook, student):
+        # An ID/password hash in hex, or an ID number.
+        if len(student) == 2 * SnapshotGradebook.HASH_LEN:
+            hash = bytes.fromhex(student)
+        else:
+            hash = gradebook.find_student(student)
+        if hash is None or hash not in gradebook:
+            raise ValueError(f"unknown student {student}")
+        return hash
+
+    def column_header(self, gradebook, column):
+        # A column code (MT, L1, ...) or any grade column's header.
+        if column is None:
+            raise ValueError("expected a column")
+        grade_header = COLUMN_CODES.get(column, column)
+        if grade_header not in gradebook.aggregates:
+            raise ValueError(f"unknown column {column}, {GET_COLUMNS_CMD} lists the grade columns")
+        return grade_header
+
+    def format_grades(self, entry):
+        formatted_str = "".join(f"{header}: {format_grade(grade)}\n" for header, grade in entry.items())
 
         return formatted_str.encode(GradeRetrievalServer.MSG_ENCODING)
 
@@ -173,7 +2923,9 @@ class GradeRetrievalClient:
 
     RECV_BUFFER_SIZE = 1024
 
-    def __init__(self):
+    def __init__(self, framed=False):
+        self.framed = framed
+        self.frame_buffer = bytearray()
         self.get_socket()
         self.connect_to_server()
         self.send_console_input_forever()
@@ -207,8 +2959,13 @@ class GradeRetrievalClient:
         while True:
             try:
                 self.get_console_input()
-                self.connection_send()
-                self.connection_receive()
+                if self.framed:
+                    self.framed_send_receive()
+                else:
+                    self.connection_send()
+                    self.connection_receive()
+                if self.input_text.split()[0] == SUBSCRIBE_CMD:
+                    self.receive_notifications_forever()
             except (KeyboardInterrupt, EOFError):
                 print()
                 print("Closing server connection ...")
@@ -220,8 +2977,9 @@ class GradeRetrievalClient:
             # Send string objects over the connection. The string must
             # be encoded into bytes objects first.
 
-            if (self.input_text == GET_GRADES):
-                self.get_grades_send()
+            course, command = self.split_course(self.input_text)
+            if command == GET_GRADES:
+                self.get_grades_send(course)
             else:
                 self.normal_send()
 
@@ -250,6 +3008,49 @@ class GradeRetrievalClient:
             print(msg)
             sys.exit(1)
 
+    def framed_send_receive(self):
+        # With the framed protocol several commands can be entered on one
+        # line, separated by ";". They are all sent before any response
+        # is read, and the responses arrive in the same order.
+        frames = []
+        for command in self.input_text.split(";"):
+            course, command = self.split_course(command.strip())
+            if command == GET_GRADES:
+                frames.append(encode_frame("grades", course + self.get_grades_hash()))
+            elif command:
+                frames.append(encode_frame("command", self.command_bytes(command)))
+
+        try:
+            self.socket.sendall(b"".join(frames))
+            for frame_type, payload in self.receive_frames(len(frames)):
+                print("Received: ", payload.decode(GradeRetrievalServer.MSG_ENCODING))
+        except Exception as msg:
+            print(msg)
+            sys.exit(1)
+
+    def receive_notifications_forever(self):
+        # After SUB the server pushes the averages that change, until
+        # the client is stopped.
+        print("Waiting for grade changes (Ctrl-C to stop) ...")
+        while True:
+            if self.framed:
+                for frame_type, payload in self.receive_frames(1):
+                    print("Received: ", payload.decode(GradeRetrievalServer.MSG_ENCODING))
+            else:
+                self.connection_receive()
+
+    def receive_frames(self, count):
+        frames = []
+        while len(frames) < count:
+            recvd_bytes = self.socket.recv(GradeRetrievalServer.FRAMED_RECV_BUFFER_SIZE)
+            if len(recvd_bytes) == 0:
+                print("Closing server connection ... ")
+                self.socket.close()
+                sys.exit(1)
+            self.frame_buffer += recvd_bytes
+            frames += decode_frames(self.frame_buffer)
+        return frames
+
     def normal_send(self):
         try:
             # Send string objects over the connection. The string must
@@ -265,40 +3066,136 @@ class GradeRetrievalClient:
             if self.input_text == GET_LAB_4_AVG_CMD:
                 print("fetching lab 4 average:")
 
-            self.socket.sendall(self.input_text.encode(GradeRetrievalServer.MSG_ENCODING))
+            self.socket.sendall(self.command_bytes(self.input_text))
         except Exception as msg:
             print(msg)
             sys.exit(1)
 
-    def get_grades_send(self):
-        try:
-            ID = input('What is your username? ')
-            password = getpass.getpass(prompt='What is your password? ')
-            print(f"ID number {ID} and password {password} received.")
+    def command_bytes(self, command):
+        # RANK, FINAL and UPDATE are authenticated: the ID/password hash
+        # is inserted into the command in hex, e.g. "RANK MT" is sent as
+        # "RANK <hash> MT". For UPDATE these are the instructor's.
+        course, command = self.split_course(command)
+        cmd, *args = command.split()
+        if cmd in (GET_RANK_CMD, GET_FINAL_GRADE_CMD, UPDATE_GRADE_CMD):
+            command = " ".join([cmd, self.get_grades_hash().hex(), *args])
+        return course + command.encode(GradeRetrievalServer.MSG_ENCODING)
 
-            password = password.encode(GradeRetrievalServer.MSG_ENCODING)
-            ID = ID.encode(GradeRetrievalServer.MSG_ENCODING)
-            m = hashlib.sha256()
-            m.update(ID)
-            m.update(password)
-            hash = m.digest()
+    def split_course(self, command):
+        # "@ece4dn4 GG" asks course ece4dn4; returns the encoded course
+        # prefix (empty for the default course) and the command.
+        if command.startswith(COURSE_PREFIX):
+            course, _, command = command.partition(" ")
+            return (course + " ").encode(GradeRetrievalServer.MSG_ENCODING), command.strip()
+        return b"", command
 
-            self.socket.sendall(hash)
+    def get_grades_send(self, course=b""):
+        try:
+            hash = self.get_grades_hash()
+
+            self.socket.sendall(course + hash)
             print(f"ID/password hash {hash} sent to server")
 
         except Exception as msg:
             print(msg)
             sys.exit(1)
 
+    def get_grades_hash(self):
+        ID = input('What is your username? ')
+        password = getpass.getpass(prompt='What is your password? ')
+        print(f"ID number {ID} and password {password} received.")
+
+        password = password.encode(GradeRetrievalServer.MSG_ENCODING)
+        ID = ID.encode(GradeRetrievalServer.MSG_ENCODING)
+        m = hashlib.sha256()
+        m.update(ID)
+        m.update(password)
+        return m.digest()
+
 
 if __name__ == '__main__':
-    roles = {'client': GradeRetrievalClient,'server': GradeRetrievalServer}
+    roles = {'client': GradeRetrievalClient, 'server': GradeRetrievalServer, 'compile': compile_snapshot}
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-r', '--role',
                         choices=roles,
-                        help='server or client role',
+                        help='server, client or compile (snapshot) role',
                         required=True, type=str)
+    parser.add_argument('--store',
+                        choices=GradeRetrievalServer.STORES,
+                        default='dict',
+                        help='server grade store (columnar requires numpy, sqlite keeps the grades '
+                             'on disk in --database)',
+                        type=str)
+    parser.add_argument('-a', '--asyncio',
+                        action='store_true',
+                        help='serve each connection as an asyncio coroutine')
+    parser.add_argument('-f', '--framed',
+                        action='store_true',
+                        help='use the length-prefixed framed protocol (client and server must match)')
+    parser.add_argument('--csv',
+                        default=GradeRetrievalServer.CSV_FILENAME,
+                        help='grades CSV file served by the server',
+                        type=str)
+    parser.add_argument('--snapshot',
+                        help='binary gradebook snapshot written by the compile role '
+                             'and mapped by the server at startup',
+                        type=str)
+    parser.add_argument('-p', '--processes',
+                        default=1,
+                        help='pre-forked server processes sharing the port with SO_REUSEPORT '
+                             '(compiles --snapshot if needed)',
+                        type=int)
+    parser.add_argument('-j', '--ingest-workers',
+                        default=1,
+                        help='processes used to parse and hash the CSV file',
+                        type=int)
+    parser.add_argument('--database',
+                        help='SQLite database of the sqlite store, built from the CSV file when it '
+                             'is missing or out of date (default: the CSV file name with .db)',
+                        type=str)
+    parser.add_argument('--memory-budget',
+                        default=SqliteGradebook.DEFAULT_MEMORY_BUDGET >> 20,
+                        help='memory budget of the sqlite store in MB (page cache and LRU caches)',
+                        type=int)
+    parser.add_argument('--weights',
+                        help='CSV file (Column,Weight) with the default weighting scheme '
+                             'for the FINAL and DIST commands',
+                        type=str)
+    parser.add_argument('--instructors',
+                        help='CSV file (ID Number,Password) of the instructors allowed to UPDATE grades; '
+                             'enables updates',
+                        type=str)
+    parser.add_argument('--update-log',
+                        help='write-ahead log of grade updates (default: the CSV file name with .wal)',
+                        type=str)
+    parser.add_argument('--courses',
+                        help='directory of course CSV files served alongside --csv; requests prefixed '
+                             'with "@<course> " are answered from <course>.csv, loaded on first use',
+                        type=str)
+    parser.add_argument('--course-memory',
+                        default=CourseCatalog.DEFAULT_MEMORY_LIMIT >> 20,
+                        help='memory in MB the loaded courses may use before the least recently '
+                             'used ones are evicted',
+                        type=int)
+    parser.add_argument('-u', '--udp',
+                        action='store_true',
+                        help='also answer the public statistics commands in single UDP datagrams')
+    parser.add_argument('-w', '--watch',
+                        action='store_true',
+                        help='reload the CSV file in the background when it changes')
 
     args = parser.parse_args()
-    roles[args.role]()
+    if args.role == 'server':
+        roles[args.role](store=args.store, use_asyncio=args.asyncio, framed=args.framed,
+                         csv_filename=args.csv, watch=args.watch, snapshot_filename=args.snapshot,
+                         ingest_workers=args.ingest_workers, processes=args.processes,
+                         weights_filename=args.weights, database_filename=args.database,
+                         memory_budget=args.memory_budget << 20, instructors_filename=args.instructors,
+                         update_log_filename=args.update_log, courses_directory=args.courses,
+                         course_memory=args.course_memory << 20, udp=args.udp)
+    elif args.role == 'compile':
+        roles[args.role](args.csv, args.snapshot or GradeRetrievalServer.SNAPSHOT_FILENAME,
+                         workers=args.ingest_workers)
+    else:
+        roles[args.role](framed=args.framed)
@@ -0,0 +1,454 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the file sharing server in file_transfer_protocol.py.
+
+Run from this directory, e.g.:
+
+    python3 benchmark.py -b get
+    python3 benchmark.py -b put
+    python3 benchmark.py -b resume
+    python3 benchmark.py -b segmented
+    python3 benchmark.py -b parallel-put
+"""
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from file_transfer_protocol import (
+    CMD,
+    CMD_FIELD_LEN,
+    CRC_FIELD_LEN,
+    FILE_CHUNK_SIZE,
+    FILE_SIZE_FIELD_LEN,
+    MSG_ENCODING,
+    OFFSET_FIELD_LEN,
+    Client,
+    Server,
+    file_crc,
+    filename_fields,
+    recv_file,
+    recv_int,
+    upload_partial_filename,
+)
+
+
+FILE_SIZES_MB = (1, 16, 128)
+CLIENT_RECV_SIZE = 1 << 20
+CHUNK_SIZES = (1 << 10, 1 << 12, 1 << 16, 1 << 20, 1 << 22)
+INTERRUPTED_AT = (0.25, 0.5, 0.9)
+CONNECTIONS = (1, 2, 4, 8)
+PACE_CHUNK_SIZE = 1 << 16
+
+
+def offline_server():
+    # A Server that is not listening, for running its connection
+    # handler on sockets set up by the benchmark.
+    server = Server.__new__(Server)
+    server.chunked_uploads = {}
+    server.chunked_uploads_lock = threading.Lock()
+    return server
+
+
+def read_and_send_get(connection):
+    # GET as the server handled it before it used sendfile: the whole
+    # file is read into memory and copied again into the packet.
+    cmd = int.from_bytes(connection.recv(CMD_FIELD_LEN), byteorder='big')
+    if cmd != CMD["get"]:
+        return
+    filename = connection.recv(Server.RECV_SIZE).decode(MSG_ENCODING)
+    with open(filename, 'rb') as file:
+        file_bytes = file.read()
+    connection.sendall(len(file_bytes).to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big') + file_bytes)
+
+
+def accumulate_and_write(connection, file, file_size):
+    # How PUT was received before recv_file: 1024 byte recv calls
+    # appended to a bytearray, written out once the whole file is in.
+    recvd_bytes_total = bytearray()
+    while len(recvd_bytes_total) < file_size:
+        recvd_bytes_total += connection.recv(Server.RECV_SIZE)
+    file.write(recvd_bytes_total)
+
+
+class CountingConnection:
+    # Counts the receive calls made on a socket.
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.calls = 0
+
+    def recv(self, size):
+        self.calls += 1
+        return self.connection.recv(size)
+
+    def recv_into(self, buffer, size):
+        self.calls += 1
+        return self.connection.recv_into(buffer, size)
+
+
+def write_file(filename, size):
+    chunk = os.urandom(1 << 20)
+    with open(filename, "wb") as file:
+        for offset in range(0, size, len(chunk)):
+            file.write(chunk[:size - offset])
+
+
+def receive_exactly(connection, buffer, size):
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = connection.recv_into(view[received:size])
+        if count == 0:
+            raise ConnectionError("Server closed the connection")
+        received += count
+
+
+def get_file(connection, filename, buffer):
+    # One GET from the client side. The file is received into a reused
+    # buffer and dropped, so that the client costs as little as possible.
+    connection.sendall(CMD["get"].to_bytes(CMD_FIELD_LEN, byteorder='big') + filename.encode(MSG_ENCODING))
+    header = bytearray(FILE_SIZE_FIELD_LEN)
+    receive_exactly(connection, header, FILE_SIZE_FIELD_LEN)
+    file_size = int.from_bytes(header, byteorder='big')
+    for offset in range(0, file_size, len(buffer)):
+        receive_exactly(connection, buffer, min(len(buffer), file_size - offset))
+    return file_size
+
+
+def time_gets(handler, filename, repeat):
+    # Run handler for repeat GETs of filename on one loopback
+    # connection. Returns the throughput in MB/s and the peak Python
+    # memory allocated on the server side.
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        peaks = []
+
+        def serve():
+            connection, address = listener.accept()
+            with connection:
+                tracemalloc.start()
+                for _ in range(repeat):
+                    handler(connection)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+
+        server_thread = threading.Thread(target=serve)
+        server_thread.start()
+        buffer = bytearray(CLIENT_RECV_SIZE)
+        with socket.create_connection(listener.getsockname()) as connection:
+            start = time.perf_counter()
+            total = sum(get_file(connection, filename, buffer) for _ in range(repeat))
+            elapsed = time.perf_counter() - start
+        server_thread.join()
+    return total / elapsed / (1 << 20), peaks[0]
+
+
+def bench_get(args):
+    # GET throughput on loopback of the sendfile path against reading
+    # the file into memory first, with the server's peak Python memory.
+    server = offline_server()
+    handlers = {"read": read_and_send_get, "sendfile": server.connection_handler}
+    print(f"{'size (MB)':>10} {'path':>9} {'MB/s':>8} {'peak (MB)':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            for size_mb in args.sizes:
+                filename = f"file_{size_mb}MB.bin"
+                write_file(filename, size_mb << 20)
+                for name, handler in handlers.items():
+                    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                        throughput, peak = time_gets(handler, filename, args.repeat)
+                    print(f"{size_mb:>10} {name:>9} {throughput:>8.0f} {peak / (1 << 20):>10.1f}")
+                os.remove(filename)
+        finally:
+            os.chdir(cwd)
+
+
+def time_receive(receive, filename, target_filename):
+    # Send filename over a loopback connection with sendfile and time
+    # receive(connection, file, file_size) writing it to target_filename.
+    # Returns the throughput in MB/s, the peak Python memory of the
+    # receiver and its number of receive calls.
+    file_size = os.path.getsize(filename)
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+
+        def send():
+            with socket.create_connection(listener.getsockname()) as connection, open(filename, "rb") as file:
+                connection.sendfile(file)
+
+        sender_thread = threading.Thread(target=send)
+        sender_thread.start()
+        connection, address = listener.accept()
+        with connection, open(target_filename, "wb") as file:
+            counting_connection = CountingConnection(connection)
+            tracemalloc.start()
+            start = time.perf_counter()
+            receive(counting_connection, file, file_size)
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        sender_thread.join()
+    return file_size / elapsed / (1 << 20), peak, counting_connection.calls
+
+
+def bench_put(args):
+    # Receiving an upload and writing it to disk: the previous
+    # accumulate-then-write loop against recv_file with each buffer
+    # (chunk) size.
+    receivers = {"accumulate": accumulate_and_write}
+    for chunk_size in args.chunk_sizes:
+        receivers[f"{chunk_size >> 10} KB"] = \
+            lambda connection, file, file_size, chunk_size=chunk_size: \
+            recv_file(connection, file, file_size, bytearray(chunk_size))
+    print(f"{'size (MB)':>10} {'receiver':>11} {'MB/s':>8} {'peak (MB)':>10} {'recv calls':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size_mb in args.sizes:
+            filename = os.path.join(directory, f"file_{size_mb}MB.bin")
+            target_filename = os.path.join(directory, "received.bin")
+            write_file(filename, size_mb << 20)
+            for name, receive in receivers.items():
+                throughput, peak, calls = time_receive(receive, filename, target_filename)
+                print(f"{size_mb:>10} {name:>11} {throughput:>8.0f} {peak / (1 << 20):>10.2f} {calls:>11}")
+            os.remove(filename)
+
+
+def upload(connection, filename, target_filename, resume):
+    # Upload filename as target_filename, from the offset the server
+    # reports if resume is set and from the start otherwise. Returns the
+    # number of file bytes sent.
+    file_size = os.path.getsize(filename)
+    offset = 0
+    if resume:
+        connection.sendall(CMD["pstat"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                           + filename_fields(target_filename)
+                           + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big'))
+        offset = recv_int(connection, OFFSET_FIELD_LEN)
+        crc = recv_int(connection, CRC_FIELD_LEN)
+        with open(filename, "rb") as file:
+            if crc != file_crc(file.fileno(), 0, offset, bytearray(FILE_CHUNK_SIZE)):
+                offset = 0
+    connection.sendall(CMD["rput"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                       + filename_fields(target_filename)
+                       + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                       + offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big'))
+    with open(filename, "rb") as file:
+        if file_size > offset:
+            connection.sendfile(file, offset=offset, count=file_size - offset)
+    if recv_int(connection, OFFSET_FIELD_LEN) != file_size:
+        raise RuntimeError("Upload incomplete")
+    return file_size - offset
+
+
+def bench_resume(args):
+    # Finishing an upload that was interrupted part of the way through:
+    # starting over against resuming from the partial file the server
+    # kept. The interruption is simulated by writing the partial file.
+    server = offline_server()
+    print(f"{'size (MB)':>10} {'done':>5} {'upload':>8} {'sent (MB)':>10} {'s':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with socket.create_server(("127.0.0.1", 0)) as listener:
+
+                def serve():
+                    connection, address = listener.accept()
+                    with connection, contextlib.suppress(ConnectionError):
+                        while True:
+                            server.connection_handler(connection)
+
+                server_thread = threading.Thread(target=serve, daemon=True)
+                server_thread.start()
+                with socket.create_connection(listener.getsockname()) as connection:
+                    for size_mb in args.sizes:
+                        filename = f"file_{size_mb}MB.bin"
+                        write_file(filename, size_mb << 20)
+                        with open(filename, "rb") as file:
+                            data = file.read()
+                        for done in INTERRUPTED_AT:
+                            for name, resume in (("restart", False), ("resume", True)):
+                                with open(upload_partial_filename("uploaded.bin", len(data)), "wb") as partial:
+                                    partial.write(data[:int(done * len(data))])
+                                # The server is done printing before it answers.
+                                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                                    start = time.perf_counter()
+                                    sent = upload(connection, filename, "uploaded.bin", resume)
+                                    elapsed = time.perf_counter() - start
+                                print(f"{size_mb:>10} {done:>5.0%} {name:>8} {sent / (1 << 20):>10.1f} {elapsed:>8.3f}")
+                        os.remove(filename)
+        finally:
+            os.chdir(cwd)
+
+
+class PacedConnection:
+    # A server connection whose sendfile and recv_into are held to rate
+    # bytes/s, like a TCP stream limited by its window over a long
+    # round trip time.
+
+    def __init__(self, connection, rate):
+        self.connection = connection
+        self.rate = rate
+
+    def recv(self, size):
+        return self.connection.recv(size)
+
+    def recv_into(self, buffer, size):
+        recvd_len = self.connection.recv_into(buffer, size)
+        time.sleep(recvd_len / self.rate)
+        return recvd_len
+
+    def sendall(self, data):
+        self.connection.sendall(data)
+
+    def close(self):
+        self.connection.close()
+
+    def sendfile(self, file, offset=0, count=None):
+        start = time.perf_counter()
+        sent = 0
+        while sent < count:
+            chunk = os.pread(file.fileno(), min(PACE_CHUNK_SIZE, count - sent), offset + sent)
+            self.connection.sendall(chunk)
+            sent += len(chunk)
+            delay = start + sent / self.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+
+def serve_directory(listener, directory, rate):
+    # Serve each connection on listener from its own thread, as the
+    # Server does, with files looked up in directory. Runs in its own
+    # process, so its output can be dropped for good.
+    os.chdir(directory)
+    sys.stdout = open(os.devnull, "w")
+    server = offline_server()
+
+    def serve(connection):
+        if rate:
+            connection = PacedConnection(connection, rate)
+        server.process_connections_forever(connection)
+
+    while True:
+        connection, address = listener.accept()
+        threading.Thread(target=serve, args=(connection,), daemon=True).start()
+
+
+@contextlib.contextmanager
+def client_and_server(stream_rate):
+    # A Client, working in its own directory, connected to a server in
+    # its own process and directory. Yields the client and the server's
+    # directory. With stream_rate (MB/s) each server connection is paced
+    # to emulate a long, fat link where one TCP stream cannot fill the
+    # pipe.
+    rate = stream_rate * (1 << 20)
+    print(f"stream rate: {f'{stream_rate} MB/s' if rate else 'unlimited'}")
+    with tempfile.TemporaryDirectory() as directory:
+        server_directory = os.path.join(directory, "Server")
+        client_directory = os.path.join(directory, "Client")
+        os.mkdir(server_directory)
+        os.mkdir(client_directory)
+        cwd = os.getcwd()
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            server_process = multiprocessing.Process(target=serve_directory,
+                                                     args=(listener, server_directory, rate), daemon=True)
+            server_process.start()
+            os.chdir(client_directory)
+            try:
+                client = Client.__new__(Client)
+                client.transfer_socket = socket.create_connection(listener.getsockname())
+                with client.transfer_socket:
+                    yield client, server_directory
+            finally:
+                os.chdir(cwd)
+                server_process.terminate()
+
+
+def time_transfers(transfers, filename, size_mb, target_filename):
+    # Run each of the transfers of filename, checking that all of the
+    # file arrives at target_filename.
+    for name, transfer in transfers.items():
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            transfer(filename)
+            elapsed = time.perf_counter() - start
+        if os.path.getsize(target_filename) != size_mb << 20:
+            raise RuntimeError(f"{name} transfer incomplete")
+        os.remove(target_filename)
+        print(f"{size_mb:>10} {name:>15} {(size_mb << 20) / elapsed / (1 << 20):>8.0f}")
+
+
+def bench_segmented(args):
+    # Single stream GET against segmented downloads over more and more
+    # connections.
+    with client_and_server(args.stream_rate) as (client, server_directory):
+        downloads = {"single": client.get_file}
+        for connections in args.connections:
+            downloads[f"{connections} segments"] = \
+                lambda filename, connections=connections: client.get_file_segmented(filename, connections)
+        print(f"{'size (MB)':>10} {'download':>15} {'MB/s':>8}")
+        for size_mb in args.sizes:
+            filename = f"file_{size_mb}MB.bin"
+            server_filename = os.path.join(server_directory, filename)
+            write_file(server_filename, size_mb << 20)
+            time_transfers(downloads, filename, size_mb, filename)
+            os.remove(server_filename)
+
+
+def bench_parallel_put(args):
+    # Single stream PUT against parallel chunked uploads over more and
+    # more connections.
+    with client_and_server(args.stream_rate) as (client, server_directory):
+        uploads = {"single": client.put_file}
+        for connections in args.connections:
+            uploads[f"{connections} connections"] = \
+                lambda filename, connections=connections: client.put_file_parallel(filename, connections)
+        print(f"{'size (MB)':>10} {'upload':>15} {'MB/s':>8}")
+        for size_mb in args.sizes:
+            filename = f"file_{size_mb}MB.bin"
+            write_file(filename, size_mb << 20)
+            time_transfers(uploads, filename, size_mb, os.path.join(server_directory, filename))
+            os.remove(filename)
+
+
+BENCHMARKS = {
+    "get": bench_get,
+    "put": bench_put,
+    "resume": bench_resume,
+    "segmented": bench_segmented,
+    "parallel-put": bench_parallel_put,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-b', '--bench',
+                        choices=BENCHMARKS,
+                        help='benchmark to run',
+                        required=True, type=str)
+    parser.add_argument('-n', '--sizes',
+                        nargs='+', type=int, default=FILE_SIZES_MB,
+                        help='file sizes in MB')
+    parser.add_argument('--chunk-sizes',
+                        nargs='+', type=int, default=CHUNK_SIZES,
+                        help='receive buffer sizes in bytes (put)')
+    parser.add_argument('-c', '--connections',
+                        nargs='+', type=int, default=CONNECTIONS,
+                        help='maximum connections per transfer (segmented, parallel-put)')
+    parser.add_argument('--stream-rate',
+                        type=int, default=50,
+                        help='MB/s each server connection is held to, 0 for no limit (segmented, parallel-put)')
+    parser.add_argument('--repeat',
+                        type=int, default=5,
+                        help='transfers per measurement')
+
+    args = parser.parse_args()
+    BENCHMARKS[args.bench](args)
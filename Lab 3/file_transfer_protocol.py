@@ -23,6 +23,8 @@ import sys
 import argparse
 import os
 import threading
+import time
+import zlib
 
 ########################################################################
 
@@ -46,19 +48,264 @@ FILENAME_SIZE_FIELD_LEN = 8  # 8 byte filename size field.
 # | 8 byte file size | ... file ... |
 # -----------------------------------
 
+# Resumable transfers. A ranged GET asks for length bytes of the file
+# from offset on (length 2**64 - 1 for the rest of the file):
+
+# ---------------------------------------------------------------------
+# | 1 byte RGET | 8 byte offset | 8 byte length | 8 byte filename size |
+# | ... file name ... |
+# ---------------------------------------------------------------------
+
+# and is answered with the whole file's size, the length of the range
+# (clipped to the end of the file) and the range itself. The file size
+# is FILE_NOT_FOUND_SIZE if there is no such file.
+
+# ------------------------------------------------------------
+# | 8 byte file size | 8 byte range length | ... range ... |
+# ------------------------------------------------------------
+
+# Uploads are written to a partial file, named after the file and its
+# size, which is renamed to the file once it is complete. PSTAT asks
+# how many bytes of an upload the server already has, and RPUT sends
+# the rest of the file from that offset on:
+
+# ---------------------------------------------------------------------------
+# | 1 byte PSTAT | 8 byte filename size | ... file name ... | 8 byte file size |
+# ---------------------------------------------------------------------------
+
+# -----------------------------------------------------------------------
+# | 1 byte RPUT | 8 byte filename size | ... file name ... |
+# | 8 byte file size | 8 byte offset | ... file from offset on ... |
+# -----------------------------------------------------------------------
+
+# Both are answered with an 8 byte offset: the bytes of the upload the
+# server has (for RPUT, after receiving this part). A plain PUT is an
+# RPUT from offset 0 without the answer. PSTAT's offset is followed by
+# the 4 byte CRC-32 of those bytes, and the client only resumes if its
+# own file starts with the same bytes.
+
+# Before resuming a download, the client checks that the file on the
+# server still starts with the bytes it has. CRC asks for the CRC-32
+# of the first length bytes of the file (clipped to the end of the
+# file):
+
+# ----------------------------------------------------------------------
+# | 1 byte CRC | 8 byte filename size | ... file name ... | 8 byte length |
+# ----------------------------------------------------------------------
+
+# and is answered with the 8 byte file size (FILE_NOT_FOUND_SIZE if
+# there is no such file) and the 4 byte CRC-32.
+
+# Parallel uploads send the file in chunks over several connections
+# at once. The server writes each chunk at its offset into a temporary
+# file, preallocated to the file's size once the first chunk is in,
+# and keeps it once its CRC-32 checks out:
+
+# ------------------------------------------------------------------------
+# | 1 byte PPUT | 8 byte filename size | ... file name ... |
+# | 8 byte file size | 8 byte offset | 8 byte length | 4 byte CRC-32 |
+# | ... chunk ... |
+# ------------------------------------------------------------------------
+
+# Each chunk is answered with an 8 byte length: the chunk's length if
+# it was received intact and 0 otherwise. Once all chunks are in,
+# PCOMMIT moves the temporary file into place if the chunks cover the
+# whole file:
+
+# -----------------------------------------------------------------------------
+# | 1 byte PCOMMIT | 8 byte filename size | ... file name ... | 8 byte file size |
+# -----------------------------------------------------------------------------
+
+# and is answered with the 8 byte number of bytes of the file the
+# server has, which is the file size if it was committed. A client
+# that gives up on a parallel upload sends PABORT, which deletes the
+# temporary file and is not answered:
+
+# ----------------------------------------------------------------------------
+# | 1 byte PABORT | 8 byte filename size | ... file name ... | 8 byte file size |
+# ----------------------------------------------------------------------------
+
+# Uploads that are neither committed nor aborted are deleted once no
+# chunk has arrived for CHUNKED_UPLOAD_TIMEOUT seconds.
+
 # Define a dictionary of commands. The actual command field value must
-# be a 1-byte integer. For now, we only define the "GET" command,
-# which tells the server to send a file.
+# be a 1-byte integer.
 
 CMD = {
     "get": 1,
     "put": 2,
     "list": 3,
     "bye": 4,
+    "rget": 5,
+    "pstat": 6,
+    "rput": 7,
+    "pput": 8,
+    "pcommit": 9,
+    "crc": 10,
+    "pabort": 11,
 }
 
+OFFSET_FIELD_LEN = 8  # 8 byte file offset field.
+RANGE_LEN_FIELD_LEN = 8  # 8 byte range length field.
+CRC_FIELD_LEN = 4  # 4 byte CRC-32 field.
+TO_END_OF_FILE = (1 << 8 * RANGE_LEN_FIELD_LEN) - 1
+FILE_NOT_FOUND_SIZE = (1 << 8 * FILE_SIZE_FIELD_LEN) - 1
+
+PARTIAL_SUFFIX = ".part"
+# Segmented downloads fill in their partial file out of order, so it
+# is kept apart from the one a plain get resumes from.
+SEGMENTED_SUFFIX = ".segmented" + PARTIAL_SUFFIX
+
 MSG_ENCODING = "utf-8"
 
+# Received files are written to disk one chunk at a time from a buffer
+# of this size, so a transfer uses the same memory whatever the file
+# size.
+FILE_CHUNK_SIZE = 1 << 20
+
+# Segmented downloads fetch disjoint ranges of a file over several
+# connections at once. A file gets one segment per SEGMENT_MIN_SIZE
+# bytes, up to the number of connections asked for, so small files
+# are still fetched over a single connection.
+SEGMENT_MIN_SIZE = 8 << 20
+MAX_SEGMENTS = 8
+
+
+def recv_file(connection, file, file_size, buffer):
+    # Receive file_size bytes from connection into the open file, using
+    # buffer (a bytearray) for every chunk.
+    view = memoryview(buffer)
+    remaining = file_size
+    while remaining > 0:
+        recvd_len = connection.recv_into(view, min(len(view), remaining))
+        if recvd_len == 0:
+            raise ConnectionError(f"Connection closed with {remaining} bytes of the file left")
+        file.write(view[:recvd_len])
+        remaining -= recvd_len
+
+
+def recv_file_at(connection, fd, offset, length, buffer):
+    # Like recv_file, but writes the bytes at offset on in the file
+    # descriptor fd with positional writes, so that several connections
+    # can fill in the same file. Returns the CRC-32 of the bytes.
+    view = memoryview(buffer)
+    end = offset + length
+    crc = 0
+    while offset < end:
+        recvd_len = connection.recv_into(view, min(len(view), end - offset))
+        if recvd_len == 0:
+            raise ConnectionError(f"Connection closed with {end - offset} bytes of the range left")
+        written = 0
+        while written < recvd_len:
+            written += os.pwrite(fd, view[written:recvd_len], offset + written)
+        crc = zlib.crc32(view[:recvd_len], crc)
+        offset += recvd_len
+    return crc
+
+
+def file_crc(fd, offset, length, buffer):
+    # CRC-32 of length bytes of the file descriptor fd from offset on.
+    view = memoryview(buffer)
+    end = offset + length
+    crc = 0
+    while offset < end:
+        read_len = os.preadv(fd, [view[:min(len(view), end - offset)]], offset)
+        if read_len == 0:
+            raise EOFError(f"File ends {end - offset} bytes short of the chunk")
+        crc = zlib.crc32(view[:read_len], crc)
+        offset += read_len
+    return crc
+
+
+def preallocate(fd, size):
+    # Reserve the file's disk space up front, so that writes at any
+    # offset do not fail half way through or fragment the file.
+    if hasattr(os, "posix_fallocate") and size > 0:
+        os.posix_fallocate(fd, 0, size)
+    else:
+        os.ftruncate(fd, size)
+
+
+def segment_bounds(file_size, max_segments):
+    # Split the file into between 1 and max_segments ranges of at least
+    # SEGMENT_MIN_SIZE bytes each. Returns the (offset, length) pairs.
+    segments = max(1, min(max_segments, file_size // SEGMENT_MIN_SIZE))
+    offsets = [file_size * i // segments for i in range(segments + 1)]
+    return [(offsets[i], offsets[i + 1] - offsets[i]) for i in range(segments)]
+
+
+def request_range(connection, filename, offset, length):
+    # Send a ranged GET and return the file size and range length of
+    # the response; the range itself is left to be received.
+    connection.sendall(CMD["rget"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                       + offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big')
+                       + length.to_bytes(RANGE_LEN_FIELD_LEN, byteorder='big')
+                       + filename_fields(filename))
+    file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+    range_len = recv_int(connection, RANGE_LEN_FIELD_LEN)
+    return file_size, range_len
+
+
+def request_crc(connection, filename, length):
+    # Ask for the CRC-32 of the first length bytes of the file and
+    # return the file size and the CRC.
+    connection.sendall(CMD["crc"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                       + filename_fields(filename)
+                       + length.to_bytes(RANGE_LEN_FIELD_LEN, byteorder='big'))
+    file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+    crc = recv_int(connection, CRC_FIELD_LEN)
+    return file_size, crc
+
+
+def send_bye(connection):
+    # End a helper connection of a parallel transfer, even after an
+    # error, so that its server thread exits.
+    try:
+        connection.sendall(CMD["bye"].to_bytes(CMD_FIELD_LEN, byteorder='big'))
+    except socket.error:
+        pass
+
+
+def recv_exactly(connection, length):
+    # Receive a whole fixed length field.
+    field = bytearray()
+    while len(field) < length:
+        recvd_bytes = connection.recv(length - len(field))
+        if len(recvd_bytes) == 0:
+            raise ConnectionError("Connection closed in the middle of a packet")
+        field += recvd_bytes
+    return bytes(field)
+
+
+def recv_int(connection, length):
+    return int.from_bytes(recv_exactly(connection, length), byteorder='big')
+
+
+def recv_filename(connection):
+    # An 8 byte filename size field followed by the file name.
+    return recv_exactly(connection, recv_int(connection, FILENAME_SIZE_FIELD_LEN)).decode(MSG_ENCODING)
+
+
+def filename_fields(filename):
+    filename_field = filename.encode(MSG_ENCODING)
+    return len(filename_field).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big') + filename_field
+
+
+def upload_partial_filename(filename, file_size):
+    # The size is part of the name, so that an upload of a different
+    # version of the file does not resume from this one. A version of
+    # the same size is caught by PSTAT's CRC of the partial file.
+    return f"{filename}.{file_size}{PARTIAL_SUFFIX}"
+
+
+CHUNKED_SUFFIX = ".chunked" + PARTIAL_SUFFIX
+
+
+def chunked_upload_filename(filename, file_size):
+    # Kept apart from the resumable upload's partial file, which only
+    # ever holds a prefix of the file.
+    return f"{filename}.{file_size}{CHUNKED_SUFFIX}"
+
 
 ########################################################################
 # SERVER
@@ -80,10 +327,25 @@ class Server:
 
     FOLDER_PREFIX = "Server/"
 
+    # Seconds a parallel upload can go without a chunk arriving before
+    # its temporary file is deleted.
+    CHUNKED_UPLOAD_TIMEOUT = 600
+
     def __init__(self):
+        # Parallel uploads in progress, by temporary file: the chunks
+        # that have arrived intact, as an {offset: length} dict, the
+        # number of chunks being received and when one last arrived.
+        # Shared by the connection threads.
+        self.chunked_uploads = {}
+        self.chunked_uploads_lock = threading.Lock()
         self.create_discovery_socket()
         self.create_listen_socket()
         os.chdir(Server.FOLDER_PREFIX)
+        # The chunks in temporary files left by an earlier run are not
+        # known, so those files can never be committed.
+        for filename in os.listdir():
+            if filename.endswith(CHUNKED_SUFFIX):
+                os.remove(filename)
         print(os.listdir())
 
         discovery_thread = threading.Thread(target=self.process_discovery_connections_forever)
@@ -153,6 +415,8 @@ class Server:
             while True:
                 client = self.socket.accept()
                 connection, address = client
+                with self.chunked_uploads_lock:
+                    self.expire_chunked_uploads()
                 print("-" * 72)
                 print("Connection received from {}.".format(address))
                 new_connection_thread = threading.Thread(target=self.process_connections_forever, args=(connection,))
@@ -181,7 +445,11 @@ class Server:
     def connection_handler(self, connection):
 
         # Read the command and see if it is a GET.
-        cmd = int.from_bytes(connection.recv(CMD_FIELD_LEN), byteorder='big')
+        cmd_field = connection.recv(CMD_FIELD_LEN)
+        if len(cmd_field) == 0:
+            # The client has closed the connection without a BYE.
+            raise ConnectionError("Connection closed by the client")
+        cmd = int.from_bytes(cmd_field, byteorder='big')
         if cmd == CMD["get"]:
             filename_bytes = connection.recv(Server.RECV_SIZE)
             filename = filename_bytes.decode(MSG_ENCODING)
@@ -192,21 +460,19 @@ class Server:
                 print(Server.FILE_NOT_FOUND_MSG)
                 return
 
-            # Encode the file contents into bytes, record its size and
-            # generate the file size field used for transmission.
-            file_bytes = file.read()
-            file.close()
-            file_size_bytes = len(file_bytes)
-            print(f"Found file! File size: {file_size_bytes} bytes")
-            file_size_field = file_size_bytes.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
-
-            # Create the packet to be sent with the header field.
-            pkt = file_size_field + file_bytes
-
-            # Send the packet to the connected client.
-            connection.sendall(pkt)
-            # print("Sent packet bytes: \n", pkt)
-            print("Sending file: ", filename)
+            with file:
+                # Record the file size and generate the file size field
+                # used for transmission.
+                file_size_bytes = os.fstat(file.fileno()).st_size
+                print(f"Found file! File size: {file_size_bytes} bytes")
+                file_size_field = file_size_bytes.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+
+                # Send the header field, then have the kernel copy the
+                # file from the page cache to the socket (sendfile), so
+                # the file is never read into memory here.
+                connection.sendall(file_size_field)
+                print("Sending file: ", filename)
+                connection.sendfile(file, count=file_size_bytes)
 
         if cmd == CMD["put"]:
             filename_len_bytes = connection.recv(FILENAME_SIZE_FIELD_LEN)
@@ -220,24 +486,94 @@ class Server:
             file_size_bytes = connection.recv(FILE_SIZE_FIELD_LEN)
             file_size = int.from_bytes(file_size_bytes, byteorder='big')
             print(f"File Size: {file_size} bytes")
-            recvd_bytes_total = bytearray()
+            self.receive_upload(connection, filename, file_size, 0)
+
+        if cmd == CMD["rget"]:
+            offset = recv_int(connection, OFFSET_FIELD_LEN)
+            range_len = recv_int(connection, RANGE_LEN_FIELD_LEN)
+            filename = recv_filename(connection)
+
             try:
-                # Keep doing recv until the entire file is downloaded.
-                while len(recvd_bytes_total) < file_size:
-                    recvd_bytes_total += connection.recv(Server.RECV_SIZE)
-                print(f"Received {len(recvd_bytes_total)} bytes")
-                try:
-                    file = open(filename, 'wb+')
-                    file.write(recvd_bytes_total)
-                    file.close()
-                except FileNotFoundError:
-                    print(Server.FILE_NOT_FOUND_MSG)
-                    file.close()
-            except KeyboardInterrupt:
-                print("YOOOOOOOO")
-                file.close()
-                os.remove("./", file)
-                exit(1)
+                file = open(filename, 'rb')
+            except FileNotFoundError:
+                print(Server.FILE_NOT_FOUND_MSG)
+                connection.sendall(FILE_NOT_FOUND_SIZE.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                                   + (0).to_bytes(RANGE_LEN_FIELD_LEN, byteorder='big'))
+                return
+
+            with file:
+                # Clip the range to the end of the file.
+                file_size = os.fstat(file.fileno()).st_size
+                offset = min(offset, file_size)
+                range_len = min(range_len, file_size - offset)
+                print(f"Sending bytes {offset} to {offset + range_len} of {filename}")
+                connection.sendall(file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                                   + range_len.to_bytes(RANGE_LEN_FIELD_LEN, byteorder='big'))
+                if range_len > 0:
+                    connection.sendfile(file, offset=offset, count=range_len)
+
+        if cmd == CMD["crc"]:
+            filename = recv_filename(connection)
+            length = recv_int(connection, RANGE_LEN_FIELD_LEN)
+
+            try:
+                file = open(filename, 'rb')
+            except FileNotFoundError:
+                print(Server.FILE_NOT_FOUND_MSG)
+                connection.sendall(FILE_NOT_FOUND_SIZE.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                                   + (0).to_bytes(CRC_FIELD_LEN, byteorder='big'))
+                return
+
+            with file:
+                file_size = os.fstat(file.fileno()).st_size
+                crc = file_crc(file.fileno(), 0, min(length, file_size), bytearray(FILE_CHUNK_SIZE))
+            connection.sendall(file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                               + crc.to_bytes(CRC_FIELD_LEN, byteorder='big'))
+
+        if cmd == CMD["pstat"]:
+            filename = recv_filename(connection)
+            file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+            try:
+                with open(upload_partial_filename(filename, file_size), 'rb') as file:
+                    offset = os.fstat(file.fileno()).st_size
+                    crc = file_crc(file.fileno(), 0, offset, bytearray(FILE_CHUNK_SIZE))
+            except OSError:
+                offset = 0
+                crc = 0
+            print(f"Have {offset} of {file_size} bytes of {filename}")
+            connection.sendall(offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big')
+                               + crc.to_bytes(CRC_FIELD_LEN, byteorder='big'))
+
+        if cmd == CMD["rput"]:
+            filename = recv_filename(connection)
+            file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+            offset = recv_int(connection, OFFSET_FIELD_LEN)
+            print(f"Receiving bytes {offset} to {file_size} of {filename}")
+            received = self.receive_upload(connection, filename, file_size, offset)
+            connection.sendall(received.to_bytes(OFFSET_FIELD_LEN, byteorder='big'))
+
+        if cmd == CMD["pput"]:
+            filename = recv_filename(connection)
+            file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+            offset = recv_int(connection, OFFSET_FIELD_LEN)
+            length = recv_int(connection, RANGE_LEN_FIELD_LEN)
+            crc = recv_int(connection, CRC_FIELD_LEN)
+            print(f"Receiving bytes {offset} to {offset + length} of {filename}")
+            received = self.receive_chunk(connection, filename, file_size, offset, length, crc)
+            connection.sendall(received.to_bytes(RANGE_LEN_FIELD_LEN, byteorder='big'))
+
+        if cmd == CMD["pcommit"]:
+            filename = recv_filename(connection)
+            file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+            have = self.commit_chunked_upload(filename, file_size)
+            connection.sendall(have.to_bytes(OFFSET_FIELD_LEN, byteorder='big'))
+
+        if cmd == CMD["pabort"]:
+            filename = recv_filename(connection)
+            file_size = recv_int(connection, FILE_SIZE_FIELD_LEN)
+            print(f"Dropping the parallel upload of {filename}")
+            with self.chunked_uploads_lock:
+                self.remove_chunked_upload(chunked_upload_filename(filename, file_size))
 
         if cmd == CMD["list"]:
             listdir = os.listdir()
@@ -253,6 +589,125 @@ class Server:
             connection.close()
             exit()
 
+    def receive_upload(self, connection, filename, file_size, offset):
+        # Write the upload's bytes from offset on to its partial file and
+        # rename that to filename once the file is complete. Returns the
+        # number of bytes of the file the server has. If the upload is
+        # interrupted, the partial file is kept so that it can be resumed.
+        partial_filename = upload_partial_filename(filename, file_size)
+        try:
+            file = open(partial_filename, 'r+b' if offset else 'wb')
+        except FileNotFoundError:
+            file = None
+        have = 0 if file is None else os.fstat(file.fileno()).st_size
+        if file is None or offset > have or offset > file_size:
+            print(f"Cannot write {filename} from byte {offset}, the server has {have} bytes")
+            # The upload is still received, and discarded.
+            file = open(os.devnull, 'wb')
+            partial_filename = None
+        with file:
+            if partial_filename is not None:
+                file.seek(offset)
+                file.truncate()
+            try:
+                recv_file(connection, file, file_size - min(offset, file_size), bytearray(FILE_CHUNK_SIZE))
+            except KeyboardInterrupt:
+                print(f"Upload interrupted, keeping {partial_filename} to resume it")
+                exit(1)
+        if partial_filename is None:
+            return have
+        os.replace(partial_filename, filename)
+        print(f"Received {file_size} bytes")
+        return file_size
+
+    def receive_chunk(self, connection, filename, file_size, offset, length, crc):
+        # Write one chunk of a parallel upload at its offset in the
+        # upload's temporary file and record it if its CRC-32 matches.
+        # Returns the length kept: length, or 0 if the chunk is dropped.
+        chunked_filename = chunked_upload_filename(filename, file_size)
+        if offset + length > file_size:
+            print(f"Chunk at {offset} runs past the end of {filename}")
+            with open(os.devnull, 'wb') as devnull:
+                recv_file(connection, devnull, length, bytearray(FILE_CHUNK_SIZE))
+            return 0
+        with self.chunked_uploads_lock:
+            upload = self.chunked_uploads.get(chunked_filename)
+            flags = os.O_RDWR | os.O_CREAT
+            if upload is None:
+                # A new upload: whatever is in the file is not one of
+                # its chunks.
+                upload = {"chunks": {}, "receiving": 0}
+                flags |= os.O_TRUNC
+            fd = os.open(chunked_filename, flags, 0o644)
+            self.chunked_uploads[chunked_filename] = upload
+            upload["receiving"] += 1
+            upload["last_chunk_time"] = time.monotonic()
+        try:
+            received_crc = recv_file_at(connection, fd, offset, length, bytearray(FILE_CHUNK_SIZE))
+            with self.chunked_uploads_lock:
+                # The upload may have been aborted in the meantime.
+                kept = received_crc == crc and self.chunked_uploads.get(chunked_filename) is upload
+                if kept:
+                    if not upload["chunks"]:
+                        # Only take up the whole file's disk space once
+                        # the upload is known to be under way.
+                        preallocate(fd, file_size)
+                    upload["chunks"][offset] = length
+        finally:
+            with self.chunked_uploads_lock:
+                upload["receiving"] -= 1
+                upload["last_chunk_time"] = time.monotonic()
+            os.close(fd)
+        if received_crc != crc:
+            print(f"Chunk at {offset} of {filename} failed its CRC check")
+            return 0
+        if not kept:
+            print(f"Chunk at {offset} of {filename} arrived after the upload was dropped")
+            return 0
+        return length
+
+    def commit_chunked_upload(self, filename, file_size):
+        # Move a parallel upload's temporary file into place if its
+        # chunks cover the whole file. Returns the number of bytes from
+        # the start of the file that are in.
+        chunked_filename = chunked_upload_filename(filename, file_size)
+        with self.chunked_uploads_lock:
+            upload = self.chunked_uploads.get(chunked_filename)
+            chunks = upload["chunks"] if upload is not None else {}
+            have = 0
+            for offset in sorted(chunks):
+                if offset > have:
+                    break
+                have = max(have, offset + chunks[offset])
+            if have < file_size:
+                print(f"Cannot commit {filename}: {have} of {file_size} bytes are in")
+                return have
+            if file_size == 0:
+                open(chunked_filename, 'wb').close()
+            os.replace(chunked_filename, filename)
+            self.chunked_uploads.pop(chunked_filename, None)
+        print(f"Received {file_size} bytes in {len(chunks)} chunks")
+        return file_size
+
+    def remove_chunked_upload(self, chunked_filename):
+        # Forget a parallel upload and delete its temporary file. Called
+        # with chunked_uploads_lock held.
+        self.chunked_uploads.pop(chunked_filename, None)
+        try:
+            os.remove(chunked_filename)
+        except FileNotFoundError:
+            pass
+
+    def expire_chunked_uploads(self):
+        # Drop the parallel uploads that no chunk has arrived for in
+        # CHUNKED_UPLOAD_TIMEOUT seconds. Called with
+        # chunked_uploads_lock held.
+        now = time.monotonic()
+        for chunked_filename, upload in list(self.chunked_uploads.items()):
+            if upload["receiving"] == 0 and now - upload["last_chunk_time"] > Server.CHUNKED_UPLOAD_TIMEOUT:
+                print(f"Dropping {chunked_filename}, no chunk has arrived for {Server.CHUNKED_UPLOAD_TIMEOUT} s")
+                self.remove_chunked_upload(chunked_filename)
+
 ########################################################################
 # CLIENT
 ########################################################################
@@ -271,12 +726,14 @@ class Client:
     SCAN_CMD = "scan"
     CONNECT_CMD = "connect"
     GET_CMD = "get"
+    PGET_CMD = "pget"
     PUT_CMD = "put"
+    PPUT_CMD = "pput"
     BYE_CMD = "bye"
     LLIST_CMD = "llist"
     RLIST_CMD = "rlist"
     LOCAL_CMDS = [SCAN_CMD, CONNECT_CMD, BYE_CMD, LLIST_CMD]
-    SERVER_CMDS = [GET_CMD, PUT_CMD, RLIST_CMD]
+    SERVER_CMDS = [GET_CMD, PGET_CMD, PUT_CMD, PPUT_CMD, RLIST_CMD]
     ALL_CMDS = LOCAL_CMDS + SERVER_CMDS
 
     SERVICE_DISCOVERY_MSG = "SERVICE DISCOVERY"
@@ -423,95 +880,22 @@ class Client:
     def make_server_request(self):
 
         if self.input_cmd.cmd == Client.PUT_CMD:
-            filename = self.input_cmd.opt1
-            try:
-                with open(filename, 'rb') as f:
-                    file_bytes = f.read()
-            except FileNotFoundError:
-                print(Client.FILE_NOT_FOUND_MSG)
-                return
+            self.put_file(self.input_cmd.opt1)
 
-            # Create the packet GET field.
-            put_field = CMD["put"].to_bytes(CMD_FIELD_LEN, byteorder='big')
-
-            # Create the packet filename field.
-            filename_field = filename.encode(MSG_ENCODING)
-
-            filename_len = len(filename_field)
-            filename_len_field = filename_len.to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
-
-            # Create the packet.
-            pkt = put_field + filename_len_field + filename_field
-
-            # Send the request packet to the server.
-            self.transfer_socket.sendall(pkt)
-
-            # Encode the file contents into bytes, record its size and
-            # generate the file size field used for transmission.
-            file_size_bytes = len(file_bytes)
-            file_size_field = file_size_bytes.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
-
-            # Create the packet to be sent with the header field.
-            pkt = file_size_field + file_bytes
-
-            try:
-                # Send the packet to the connected client.
-                self.transfer_socket.sendall(pkt)
-                # print("Sent packet bytes: \n", pkt)
-                print("Sending file: ", filename)
-            except socket.error as e:
-                # If the server has closed the connection, close the
-                # socket on this end.
-                print(e)
-                print("Closing server connection ...")
-                self.connected = False
-                self.transfer_socket.close()
-                self.setup_transfer_socket()
-                return
+        if self.input_cmd.cmd == Client.PPUT_CMD:
+            # pput <filename> [<max connections>]
+            max_connections = self.connection_count()
+            if max_connections is not None:
+                self.put_file_parallel(self.input_cmd.opt1, max_connections)
 
         if self.input_cmd.cmd == Client.GET_CMD:
-            filename = self.input_cmd.opt1
-            try:
-                f = open(filename, 'wb+')
-            except FileNotFoundError:
-                print(Client.FILE_NOT_FOUND_MSG)
-                return
-
-            # Create the packet GET field.
-            get_field = CMD["get"].to_bytes(CMD_FIELD_LEN, byteorder='big')
-
-            # Create the packet filename field.
-            filename_field = filename.encode(MSG_ENCODING)
+            self.get_file(self.input_cmd.opt1)
 
-            # Create the packet.
-            pkt = get_field + filename_field
-
-            # Send the request packet to the server.
-            self.transfer_socket.sendall(pkt)
-
-            file_size_bytes = self.transfer_socket.recv(FILE_SIZE_FIELD_LEN)
-            file_size = int.from_bytes(file_size_bytes, byteorder='big')
-            print(f"File Size: {file_size} bytes")
-            recvd_bytes_total = bytearray()
-            try:
-                # Keep doing recv until the entire file is downloaded.
-                while len(recvd_bytes_total) < file_size:
-                    recvd_bytes_total += self.transfer_socket.recv(Client.RECV_SIZE)
-                print(f"Received {len(recvd_bytes_total)} bytes")
-                f.write(recvd_bytes_total)
-            except KeyboardInterrupt:
-                print()
-                exit(1)
-            # If the socket has been closed by the server, break out
-            # and close it on this end.
-            except socket.error as e:
-                print(e)
-                print("Closing server connection ...")
-                self.connected = False
-                self.transfer_socket.close()
-                self.setup_transfer_socket()
-            finally:
-                f.close()
+        if self.input_cmd.cmd == Client.PGET_CMD:
+            # pget <filename> [<max connections>]
+            max_segments = self.connection_count()
+            if max_segments is not None:
+                self.get_file_segmented(self.input_cmd.opt1, max_segments)
 
         if self.input_cmd.cmd == Client.RLIST_CMD:
             # Create the packet list field.
@@ -540,6 +924,242 @@ class Client:
 
 
 
+    def connection_count(self):
+        # The optional number of connections of a parallel transfer, or
+        # None if it is not a positive integer.
+        if not self.input_cmd.opt2:
+            return MAX_SEGMENTS
+        try:
+            count = int(self.input_cmd.opt2)
+        except ValueError:
+            count = 0
+        if count < 1:
+            print(f"{self.input_cmd.opt2} is not a valid number of connections")
+            return None
+        return count
+
+    def put_file(self, filename):
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            print(Client.FILE_NOT_FOUND_MSG)
+            return
+
+        with f:
+            file_size = os.fstat(f.fileno()).st_size
+            try:
+                # Ask how much of this upload the server already has and
+                # send the rest of the file.
+                self.transfer_socket.sendall(CMD["pstat"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                             + filename_fields(filename)
+                                             + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big'))
+                offset = recv_int(self.transfer_socket, OFFSET_FIELD_LEN)
+                crc = recv_int(self.transfer_socket, CRC_FIELD_LEN)
+                if offset and (offset > file_size
+                               or crc != file_crc(f.fileno(), 0, offset, bytearray(FILE_CHUNK_SIZE))):
+                    # The server's partial file is of another version
+                    # of the file: start over.
+                    print(f"{filename} has changed since the last upload, sending all of it")
+                    offset = 0
+                if offset:
+                    print(f"Resuming upload of {filename} at byte {offset}")
+                self.transfer_socket.sendall(CMD["rput"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                             + filename_fields(filename)
+                                             + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                                             + offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big'))
+                print("Sending file: ", filename)
+                if file_size > offset:
+                    self.transfer_socket.sendfile(f, offset=offset, count=file_size - offset)
+                received = recv_int(self.transfer_socket, OFFSET_FIELD_LEN)
+            except socket.error as e:
+                self.connection_lost(e)
+                return
+        if received == file_size:
+            print(f"Sent {file_size - offset} bytes, upload complete")
+        else:
+            print(f"Upload incomplete, the server has {received} of {file_size} bytes")
+
+    def put_file_parallel(self, filename, max_connections):
+        # Upload the file in chunks, one per connection, then have the
+        # server commit it once every chunk is in. Files are split like
+        # segmented downloads, so small files use a single connection.
+        try:
+            file_size = os.path.getsize(filename)
+        except FileNotFoundError:
+            print(Client.FILE_NOT_FOUND_MSG)
+            return
+
+        chunks = segment_bounds(file_size, max_connections)
+        print(f"Sending file: {filename} in {len(chunks)} chunks")
+        results = {}
+        threads = [threading.Thread(target=self.put_chunk, args=(filename, file_size, offset, length, results))
+                   for offset, length in chunks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        failed = [offset for offset, length in chunks if results.get(offset) != length]
+        if failed:
+            print(f"{len(failed)} of {len(chunks)} chunks failed, dropping the upload")
+            try:
+                self.transfer_socket.sendall(CMD["pabort"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                             + filename_fields(filename)
+                                             + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big'))
+            except socket.error as e:
+                self.connection_lost(e)
+            return
+
+        try:
+            self.transfer_socket.sendall(CMD["pcommit"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                         + filename_fields(filename)
+                                         + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big'))
+            have = recv_int(self.transfer_socket, OFFSET_FIELD_LEN)
+        except socket.error as e:
+            self.connection_lost(e)
+            return
+        if have == file_size:
+            print(f"Sent {file_size} bytes, upload complete")
+        else:
+            print(f"Upload incomplete, the server has {have} of {file_size} bytes")
+
+    def put_chunk(self, filename, file_size, offset, length, results):
+        # Send one chunk of a parallel upload on its own connection to
+        # the server and record the length the server kept.
+        try:
+            with open(filename, 'rb') as file, \
+                    socket.create_connection(self.transfer_socket.getpeername()) as connection:
+                try:
+                    crc = file_crc(file.fileno(), offset, length, bytearray(FILE_CHUNK_SIZE))
+                    connection.sendall(CMD["pput"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+                                       + filename_fields(filename)
+                                       + file_size.to_bytes(FILE_SIZE_FIELD_LEN, byteorder='big')
+                                       + offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big')
+                                       + length.to_bytes(RANGE_LEN_FIELD_LEN, byteorder='big')
+                                       + crc.to_bytes(CRC_FIELD_LEN, byteorder='big'))
+                    if length > 0:
+                        connection.sendfile(file, offset=offset, count=length)
+                    results[offset] = recv_int(connection, RANGE_LEN_FIELD_LEN)
+                finally:
+                    send_bye(connection)
+        except (socket.error, EOFError) as e:
+            print(f"Chunk at {offset}: {e}")
+
+    def get_file(self, filename):
+        # The download is written to a partial file, which a later get of
+        # the same file resumes from, and renamed once it is complete.
+        partial_filename = filename + PARTIAL_SUFFIX
+        try:
+            f = open(partial_filename, 'ab+')
+        except FileNotFoundError:
+            print(Client.FILE_NOT_FOUND_MSG)
+            return
+
+        with f:
+            try:
+                offset = f.seek(0, os.SEEK_END)
+                if offset:
+                    # Only resume if the file on the server still starts
+                    # with the bytes already downloaded.
+                    file_size, crc = request_crc(self.transfer_socket, filename, offset)
+                    if file_size != FILE_NOT_FOUND_SIZE and (
+                            offset > file_size
+                            or crc != file_crc(f.fileno(), 0, offset, bytearray(FILE_CHUNK_SIZE))):
+                        print(f"{filename} has changed on the server, downloading all of it")
+                        f.truncate(0)
+                        offset = 0
+                file_size, range_len = request_range(self.transfer_socket, filename, offset, TO_END_OF_FILE)
+                if file_size != FILE_NOT_FOUND_SIZE and offset > file_size:
+                    # The file on the server has changed: start over.
+                    f.truncate(0)
+                    offset = 0
+                    file_size, range_len = request_range(self.transfer_socket, filename, offset, TO_END_OF_FILE)
+                if file_size == FILE_NOT_FOUND_SIZE:
+                    print(Client.FILE_NOT_FOUND_MSG)
+                    complete = False
+                else:
+                    print(f"File Size: {file_size} bytes")
+                    if offset:
+                        print(f"Resuming download of {filename} at byte {offset}")
+                    # Write the download to the file as it arrives.
+                    recv_file(self.transfer_socket, f, range_len, bytearray(FILE_CHUNK_SIZE))
+                    print(f"Received {range_len} bytes")
+                    complete = True
+            except KeyboardInterrupt:
+                print()
+                print(f"Download interrupted, keeping {partial_filename} to resume it")
+                exit(1)
+            # If the socket has been closed by the server, break out
+            # and close it on this end.
+            except socket.error as e:
+                self.connection_lost(e)
+                return
+        if complete:
+            os.replace(partial_filename, filename)
+        elif os.path.getsize(partial_filename) == 0:
+            os.remove(partial_filename)
+
+    def get_file_segmented(self, filename, max_segments):
+        # Download the file over up to max_segments connections at once,
+        # each fetching its own range straight into a preallocated
+        # partial file, which is renamed once every range is in.
+        try:
+            file_size, range_len = request_range(self.transfer_socket, filename, 0, 0)
+        except socket.error as e:
+            self.connection_lost(e)
+            return
+        if file_size == FILE_NOT_FOUND_SIZE:
+            print(Client.FILE_NOT_FOUND_MSG)
+            return
+
+        segments = segment_bounds(file_size, max_segments)
+        print(f"File Size: {file_size} bytes, fetching {len(segments)} segments")
+        partial_filename = filename + SEGMENTED_SUFFIX
+        fd = os.open(partial_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        errors = []
+        try:
+            preallocate(fd, file_size)
+            threads = [threading.Thread(target=self.get_segment, args=(filename, fd, offset, length, errors))
+                       for offset, length in segments]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(fd)
+        if errors:
+            # The preallocated file is full size, so there is no
+            # telling how much of it is there: start over instead.
+            print(f"Download failed: {errors[0]}")
+            os.remove(partial_filename)
+            return
+        os.replace(partial_filename, filename)
+        print(f"Received {file_size} bytes")
+
+    def get_segment(self, filename, fd, offset, length, errors):
+        # Fetch one range of a segmented download on its own connection
+        # to the server.
+        try:
+            with socket.create_connection(self.transfer_socket.getpeername()) as connection:
+                try:
+                    file_size, range_len = request_range(connection, filename, offset, length)
+                    if range_len != length:
+                        raise ConnectionError(f"Server sent {range_len} bytes at {offset}, expected {length}")
+                    recv_file_at(connection, fd, offset, length, bytearray(FILE_CHUNK_SIZE))
+                finally:
+                    send_bye(connection)
+        except socket.error as e:
+            errors.append(e)
+
+    def connection_lost(self, e):
+        # If the server has closed the connection, close the socket on
+        # this end.
+        print(e)
+        print("Closing server connection ...")
+        self.connected = False
+        self.transfer_socket.close()
+        self.setup_transfer_socket()
+
+
 ########################################################################
 
 if __name__ == '__main__':